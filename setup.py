@@ -35,8 +35,15 @@ setup(
         "transitions",
         "deepdiff",
     ],
-    extras_require={"develop": [
-        "ipdb",
-        "ipython"
-    ]},
+    extras_require={
+        "develop": [
+            "ipdb",
+            "ipython"
+        ],
+        "fast": [
+            "waitress",
+            "zstandard",
+            "orjson",
+        ],
+    },
 )
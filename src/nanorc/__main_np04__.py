@@ -46,7 +46,7 @@ from nanorc.nano_context import NanoContext
 @click.option('--cfg-dumpdir', type=click.Path(), default="./", help='Path where the config gets copied on start')
 @click.option('--dotnanorc', type=click.Path(), default="~/.nanorc.json", help='A JSON file which has auth/socket for the DB services')
 @click.option('--kerberos/--no-kerberos', default=False, help='Whether you want to use kerberos for communicating between processes')
-@click.option('--pm', type=str, default="ssh://", help='Process manager, can be: ssh://, kind://, or k8s://np04-srv-015:31000, for example', callback=argval.validate_pm)
+@click.option('--pm', type=str, default="ssh://", help='Process manager, can be: ssh://, kind://, or k8s://np04-srv-015:31000, for example (tuning options can be added, e.g. k8s://np04-srv-015:31000?fast_terminate=true)', callback=argval.validate_pm)
 @click.option('--web/--no-web', is_flag=True, default=False, help='whether to spawn webui')
 @click.option('--tui/--no-tui', is_flag=True, default=False, help='whether to use TUI')
 @click.option('--partition-number', type=int, default=0, help='Which partition number to run', callback=argval.validate_partition_number)
@@ -136,8 +136,18 @@ def np04cli(ctx, obj, traceback, loglevel, elisa_conf, log_path, cfg_dumpdir, do
             console = obj.console,
             top_cfg = cfg_dir,
             partition_label = partition_label,
-            run_num_mgr = DBRunNumberManager(rundb_socket),
-            run_registry = DBConfigSaver(runreg_socket),
+            run_num_mgr = DBRunNumberManager(
+                rundb_socket,
+                prefetch = cern_profile['run_number_configuration'].get('prefetch', False),
+            ),
+            run_registry = DBConfigSaver(
+                runreg_socket,
+                compression = cern_profile['run_registry_configuration'].get('compression', 'gzip'),
+                compression_level = cern_profile['run_registry_configuration'].get('compression_level', 6),
+                chunked_upload = cern_profile['run_registry_configuration'].get('chunked_upload', True),
+                session = partition_label,
+                port_offset = port_offset,
+            ),
             logbook_type = elisa_conf_data,
             timeout = timeout,
             use_kerb = kerberos,
@@ -47,7 +47,7 @@ from nanorc.nano_context import NanoContext
 @click.option('--partition-number', type=int, default=0, help='Which partition number to run', callback=argval.validate_partition_number)
 @click.option('--web/--no-web', is_flag=True, default=False, help='whether to spawn webui')
 @click.option('--tui/--no-tui', is_flag=True, default=False, help='whether to use TUI')
-@click.option('--pm', type=str, default="ssh://", help='Process manager, can be: ssh://, kind://, or k8s://np04-srv-015:31000, for example', callback=argval.validate_pm)
+@click.option('--pm', type=str, default="ssh://", help='Process manager, can be: ssh://, kind://, or k8s://np04-srv-015:31000, for example (tuning options can be added, e.g. k8s://np04-srv-015:31000?fast_terminate=true)', callback=argval.validate_pm)
 @click.argument('cfg_dir', type=str, callback=argval.validate_conf)
 @click.argument('partition-label', type=str, callback=argval.validate_partition)
 @click.pass_obj
@@ -1,14 +1,15 @@
 import logging
 import requests
+import requests.adapters
 import queue
 import json
 import time
 import socket
 import socks
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, cli
-from multiprocessing import Process, Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from rich.console import Console
 from rich.pretty import Pretty
 from .sshpm import AppProcessDescriptor
@@ -16,109 +17,81 @@ from .sshpm import AppProcessDescriptor
 from typing import Union, NoReturn
 
 
-log = logging.getLogger("werkzeug")
-log.setLevel(logging.ERROR)
-cli.show_server_banner = lambda *_: None
+class ResponseHandler(BaseHTTPRequestHandler):
+    """
+    Handles the replies POSTed by the applications on /response
+    """
 
-class ResponseDispatcher(threading.Thread):
+    def _reply(self, code:int, text:str) -> NoReturn:
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    STOP="RESPONSE_QUEUE_STOP"
+    def _read_body(self) -> bytes:
+        if 'chunked' not in self.headers.get('Transfer-Encoding', '').lower():
+            return self.rfile.read(int(self.headers['Content-Length']))
 
-    def __init__(self, listener):
-        threading.Thread.__init__(self)
-        self.listener = listener
-
-    def run(self) -> NoReturn:
+        body = b''
         while True:
-            r = self.listener.response_queue.get()
-            if r == self.STOP:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if size == 0:
                 break
+            body += self.rfile.read(size)
+            self.rfile.readline() # the CRLF ending the chunk
+        while self.rfile.readline().strip(): # trailers, up to the empty line
+            pass
+        return body
+
+    def do_POST(self) -> NoReturn:
+        if self.path != '/response':
+            self._reply(404, 'Not found')
+            return
 
-            self.listener.notify(r)
-
-    def stop(self) -> NoReturn:
-        self.listener.response_queue.put_nowait(self.STOP)
-        self.join()
+        if 'chunked' not in self.headers.get('Transfer-Encoding', '').lower() and self.headers.get('Content-Length') is None:
+            self._reply(411, 'Length required')
+            return
 
-class FlaskManager(threading.Thread):
-    def __init__(self, logger, queue, port):
-        threading.Thread.__init__(self)
-        self.log = logger
-        self.flask = None
-        self.queue = queue
-        self.port = port
-        self.ready_lock = threading.Lock()
-        self.ready_lock.acquire()
-
-    def _create_flask(self) -> Process:
-        app = Flask(__name__)
-
-        def index():
-            json = request.get_json(force=True)
-            # enqueue command reply
-            self.queue.put(json)
-            return "Response received"
-
-        def get():
-            return "ready"
-
-        app.add_url_rule("/response", "index", index, methods=["POST"])
-        app.add_url_rule("/", "get", get, methods=["GET"])
-        thread_name = f'listener'
-        flask_srv = Process(target=app.run, kwargs={"host": "0.0.0.0", "port": self.port}, name=thread_name)
-        flask_srv.daemon = False
-        flask_srv.start()
-        self.log.info(f'ResponseListener Flask lives on PID: {flask_srv.pid}')
-        ## app.is_ready() would be good here, rather horrible polling inside a try
-        tries=0
-        while True:
-            if tries>20:
-                self.log.error('Cannot ping the ResponseListener\nNothing will work!!')
-                self.log.error('This can happen if the web proxy is on at NP04.'+
-                               '\nExit NanoRC and try again after executing:'+
-                               '\nsource ~np04daq/bin/web_proxy.sh -u')
-                raise RuntimeError("Cannot create a response listener")
-            tries += 1
-            try:
-                resp = requests.get(f"http://0.0.0.0:{self.port}/")
-                if resp.text == "ready":
-                    break
-            except Exception as e:
-                pass
-                # print(e)
-            time.sleep(0.5)
-
-        # We don't release that lock before we have received a "ready" from the listener
-        self.ready_lock.release()
-        return flask_srv
+        try:
+            reply = json.loads(self._read_body())
+        except Exception as e:
+            self.server.listener.log.error(f'Malformed reply received: {str(e)}')
+            self._reply(400, 'Malformed reply')
+            return
 
-    def stop(self) -> NoReturn:
-        self.flask.terminate()
-        self.flask.join()
-        self.join()
+        try:
+            self.server.listener.notify(reply)
+        except Exception as e:
+            self.server.listener.log.error(str(e))
+            self._reply(400, str(e))
+            return
 
+        self._reply(200, 'Response received')
 
-    def _create_and_join_flask(self):
-        if not self.ready_lock.locked:
-            self.ready_lock.acquire()
+    def do_GET(self) -> NoReturn:
+        if self.path != '/':
+            self._reply(404, 'Not found')
+            return
+        self._reply(200, 'ready')
 
-        self.flask = self._create_flask()
-        self.flask.join()
-        self.log.info(f'ResponseListener: Flask joined')
+    def log_message(self, format, *args) -> NoReturn:
+        self.server.listener.log.debug(format % args)
 
-    def run(self) -> NoReturn:
-        self._create_and_join_flask()
 
 class ResponseListener:
     """
     This class describes a notification listener.
+
+    The HTTP server runs in a thread of this process, the replies are dispatched
+    to the registered handlers directly from the thread serving the request.
     """
     def __init__(self, port : int ):
         self.log = logging.getLogger("ResponseListener")
         self.port = port
-        self.response_queue = None
-        self.flask_manager = None
-        self.dispatcher = None
+        self.server = None
+        self.server_thread = None
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         result = sock.connect_ex(('localhost',self.port))
@@ -126,34 +99,53 @@ class ResponseListener:
             raise RuntimeError(f'Port clash for the Response listener! Port {self.port} is already in use')
         sock.close()
 
-        self.response_queue = Queue()
         self.handlers = {}
-        self.flask_manager = self.create_manager()
-        self.dispatcher = ResponseDispatcher(self)
-        self.dispatcher.start()
-
-    def create_manager(self):
-        fm = FlaskManager(self.log, self.response_queue, self.port) # locked
-        fm.start() # should unlock
-        if not fm.ready_lock.acquire(timeout=12): # make sure that everything is ready
-            raise RuntimeError("Cannot create a response listener at port {self.port}!")
-        fm.ready_lock.release()
-        return fm
+        self.handlers_lock = threading.Lock()
+        self._start_server()
+
+    def _start_server(self) -> NoReturn:
+        try:
+            # binds (and listens) synchronously, so the listener is ready as soon as this returns
+            self.server = ThreadingHTTPServer(("0.0.0.0", self.port), ResponseHandler)
+        except OSError as e:
+            self.log.error('This can happen if the web proxy is on at NP04.'+
+                           '\nExit NanoRC and try again after executing:'+
+                           '\nsource ~np04daq/bin/web_proxy.sh -u')
+            raise RuntimeError(f"Cannot create a response listener at port {self.port}!") from e
+
+        self.server.listener = self
+        self.server_thread = threading.Thread(
+            target = self.server.serve_forever,
+            name = f'listener-{self.port}',
+            daemon = True,
+        )
+        self.server_thread.start()
+        self.log.info(f'ResponseListener lives on port {self.port}')
+
+    def is_alive(self) -> bool:
+        return self.server_thread is not None and self.server_thread.is_alive()
+
+    def restart(self) -> NoReturn:
+        self._stop_server()
+        self._start_server()
 
     def __del__(self):
         self.terminate()
 
+    def _stop_server(self) -> NoReturn:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.server_thread:
+            self.server_thread.join()
+        self.server = None
+        self.server_thread = None
+
     def terminate(self):
         """
         Terminate the listener
         """
-        if self.flask_manager:
-            self.flask_manager.stop()
-        self.flask_manager = None
-
-        if self.dispatcher:
-            self.dispatcher.stop()
-        self.dispatcher = None
+        self._stop_server()
 
 
     def register(self, app: str, handler):
@@ -169,10 +161,11 @@ class ResponseListener:
 
         :raises     RuntimeError:  { exception_description }
         """
-        if app in self.handlers:
-            raise RuntimeError(f"Handler already registered with notification listerner for app {app}")
+        with self.handlers_lock:
+            if app in self.handlers:
+                raise RuntimeError(f"Handler already registered with notification listerner for app {app}")
 
-        self.handlers[app] = handler
+            self.handlers[app] = handler
 
     def unregister(self, app: str) -> NoReturn:
         """
@@ -182,21 +175,25 @@ class ResponseListener:
             app (str): application name
 
         """
-        if not app in self.handlers:
-            return RuntimeError(f"No handler registered for app {app}")
-        del self.handlers[app]
+        with self.handlers_lock:
+            if not app in self.handlers:
+                return RuntimeError(f"No handler registered for app {app}")
+            del self.handlers[app]
 
     def notify(self, reply: dict):
         if 'appname' not in reply:
-            raise RuntimeError("No 'appname' field in reply {reply}")
+            raise RuntimeError(f"No 'appname' field in reply {reply}")
 
         app = reply["appname"]
 
-        if not app in self.handlers:
+        with self.handlers_lock:
+            handler = self.handlers.get(app)
+
+        if handler is None:
             self.log.warning(f"Received notification for unregistered app '{app}'")
             return
 
-        self.handlers[app].notify(reply)
+        handler.notify(reply)
 
 
 class ResponseTimeout(Exception):
@@ -227,15 +224,59 @@ class AppCommander:
         self.listener_port = response_port
         self.listener_host = response_host
         self.proxy = proxy
-        self.response_queue = Queue()
+        self.response_queue = queue.Queue()
+        self.completion_queue = None
         self.sent_cmd = None
         self.connection_timeout = connection_timeout
+        self.session = self._create_session()
 
     def __del__(self):
         pass
 
+    def _create_session(self) -> requests.Session:
+        # One app = one host:port, and the commands are sent one at a time,
+        # so a couple of keep-alive connections are plenty
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.proxy:
+            session.proxies = {
+                'http': f'socks5h://{self.proxy[0]}:{self.proxy[1]}',
+                'https': f'socks5h://{self.proxy[0]}:{self.proxy[1]}'
+            }
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def connection_stats(self) -> dict:
+        """
+        Statistics of the keep-alive connection pool(s) to the application
+
+        Returns:
+            dict: number of requests sent, number of connections opened and how many requests reused a connection
+        """
+        stats = {'requests': 0, 'connections': 0}
+
+        adapter = self.session.get_adapter(self.app_url)
+        managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None: continue
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+
+        stats['reused'] = stats['requests'] - stats['connections']
+        return stats
+
     def notify(self, response):
         self.response_queue.put(response)
+        # wake up whoever is waiting for this reply
+        completion_queue = self.completion_queue
+        if completion_queue is not None:
+            completion_queue.put((self.app, None))
 
     def ping(self):
 
@@ -276,15 +317,11 @@ class AppCommander:
 
         self.log.debug(headers)
 
-        ack = requests.post(
+        ack = self.session.post(
             self.app_url,
             data = json.dumps(cmd),
             headers = headers,
             timeout = self.connection_timeout,
-            proxies = {
-                'http': f'socks5h://{self.proxy[0]}:{self.proxy[1]}',
-                'https': f'socks5h://{self.proxy[0]}:{self.proxy[1]}'
-            } if self.proxy else None
         )
 
         self.log.debug(f"Ack to {self.app}: {ack.status_code}")
@@ -322,6 +359,93 @@ class AppCommander:
         return r
 
 
+class AppHealthCache:
+    """
+    Cache of the liveness of the applications of a subsystem:
+    whether their process is alive, and whether their command port answers.
+
+    The applications are probed on demand: readers get the cached values unless they are
+    older than `ttl` seconds or a refresh is forced. refresh() probes all the stale applications
+    in parallel, before e.g. printing the status of the whole subsystem.
+    """
+
+    def __init__(self, ttl:float=1., max_probes:int=16):
+        self.log = logging.getLogger("AppHealthCache")
+        self.ttl = ttl
+        self.max_probes = max_probes
+        self.supervisors = {}
+        self.entries = {} # app -> (probe time, alive, ping)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def register(self, app:str, sup) -> NoReturn:
+        with self.lock:
+            self.supervisors[app] = sup
+
+    def unregister(self, app:str) -> NoReturn:
+        with self.lock:
+            self.supervisors.pop(app, None)
+            self.entries.pop(app, None)
+
+    def _probe(self, app:str, sup) -> tuple:
+        alive = sup.desc.proc.is_alive()
+        ping = sup.commander.ping() if alive else False
+        entry = (time.monotonic(), alive, ping)
+        with self.lock:
+            if app in self.supervisors:
+                self.entries[app] = entry
+        return entry
+
+    def _is_fresh(self, entry) -> bool:
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def get(self, app:str, sup, force:bool=False) -> tuple:
+        """
+        Get the liveness of an application
+
+        Args:
+            app (str): application name
+            sup (AppSupervisor): its supervisor (used if the app needs to be probed)
+            force (bool, optional): probe the app now, regardless of the cached value
+
+        Returns:
+            tuple: (process alive, command port pinging)
+        """
+        if not force:
+            with self.lock:
+                entry = self.entries.get(app)
+            if self._is_fresh(entry):
+                return entry[1], entry[2]
+
+        _, alive, ping = self._probe(app, sup)
+        return alive, ping
+
+    def refresh(self) -> NoReturn:
+        """
+        Probe, in parallel, the applications whose cached value is stale
+        """
+        with self.lock:
+            stale = [(app, sup) for app, sup in self.supervisors.items() if not self._is_fresh(self.entries.get(app))]
+            if len(stale) > 1 and not self.executor:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_probes, thread_name_prefix='health-probe')
+
+        if len(stale) == 1:
+            self._probe(*stale[0])
+        elif stale:
+            futures = [self.executor.submit(self._probe, app, sup) for app, sup in stale]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.log.error(f'Failed to probe an application: {str(e)}')
+
+    def stop(self) -> NoReturn:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+
 class AppSupervisor:
     """
     Lightweight application wrapper
@@ -337,6 +461,7 @@ class AppSupervisor:
         response_host: str = None,
         proxy: tuple = None,
         connection_timeout:int=1,
+        health_cache: AppHealthCache = None,
     ):
         self.console = console
         self.desc = desc
@@ -354,6 +479,28 @@ class AppSupervisor:
         self.last_ok_command = None
         self.listener = listener
         self.listener.register(desc.name, self.commander)
+        self.health_cache = health_cache
+        if self.health_cache:
+            self.health_cache.register(desc.name, self)
+
+    def health(self, force:bool=False) -> tuple:
+        """
+        Returns (process alive, command port pinging), from the health cache unless force is set
+        """
+        if not self.health_cache:
+            alive = self.desc.proc.is_alive()
+            return alive, (self.commander.ping() if alive else False)
+        return self.health_cache.get(self.desc.name, self, force)
+
+    def is_alive(self, force:bool=False) -> bool:
+        return self.health(force)[0]
+
+    def pings(self, force:bool=False) -> bool:
+        return self.health(force)[1]
+
+    def is_healthy(self, force:bool=False) -> bool:
+        alive, ping = self.health(force)
+        return alive and ping
 
     def send_command(
             self,
@@ -361,8 +508,6 @@ class AppSupervisor:
             cmd_data: dict,
             entry_state: str = "ANY",
             exit_state: str = "ANY"):
-        self.listener.flask_manager.ready_lock.acquire()
-        self.listener.flask_manager.ready_lock.release()
         self.last_sent_command = cmd_id
         self.commander.send_command(cmd_id, cmd_data, entry_state, exit_state)
 
@@ -382,17 +527,68 @@ class AppSupervisor:
             exit_state: str = "ANY",
             timeout: int = 10,
         ):
-        self.listener.flask_manager.ready_lock.acquire()
-        self.listener.flask_manager.ready_lock.release()
         self.send_command(cmd_id, cmd_data, entry_state, exit_state)
         return self.check_response(timeout)
 
     def terminate(self):
         self.listener.unregister(self.desc.name)
+        if self.health_cache:
+            self.health_cache.unregister(self.desc.name)
+        self.commander.close()
         del self.commander
 
 
+class AppHealthMonitor(threading.Thread):
+    """
+    Low rate liveness checks of the applications which still owe a reply to a command.
+
+    Dead (or unresponsive) applications are reported on the completion queue as (app, failure_mode),
+    alongside the (app, None) notifications of the AppCommanders.
+    """
+
+    def __init__(self, supervisors:dict, completion_queue, interval:float=1., failed_ping_threshold:int=3):
+        threading.Thread.__init__(self, name='app-health-monitor', daemon=True)
+        self.supervisors = dict(supervisors)
+        self.completion_queue = completion_queue
+        self.interval = interval
+        self.failed_ping_threshold = failed_ping_threshold
+        self.failed_ping_count = {app:0 for app in self.supervisors}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def done(self, app:str) -> NoReturn:
+        with self.lock:
+            self.supervisors.pop(app, None)
+
+    def check(self, app:str, sup) -> Union[str, None]:
+        alive, ping = sup.health()
+        if not alive:
+            return 'app died'
+
+        if not ping:
+            self.failed_ping_count[app] += 1
+            if self.failed_ping_count[app] > self.failed_ping_threshold:
+                return 'app not pinging'
+        else:
+            self.failed_ping_count[app] = 0
+        return None
 
+    def run(self) -> NoReturn:
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                watched = list(self.supervisors.items())
+
+            for app, sup in watched:
+                if self.stop_event.is_set():
+                    return
+                failure = self.check(app, sup)
+                if failure:
+                    self.done(app)
+                    self.completion_queue.put((app, failure))
+
+    def stop(self) -> NoReturn:
+        self.stop_event.set()
+        self.join()
 
 
 def test_listener():
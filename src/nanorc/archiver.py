@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import queue
+import fcntl
+import logging
+import threading
+from pathlib import Path
+
+
+def get_spool_dir(name:str, session:str=None, port_offset:int=0) -> Path:
+    '''
+    Spool directory of the name queue of a nanorc instance, the instances of the different sessions
+    (and port offsets) don't share it
+    '''
+    state_home = os.environ.get('XDG_STATE_HOME', os.path.join(os.path.expanduser('~'), '.local', 'state'))
+    return Path(state_home)/'nanorc'/'spool'/name/f'{session if session else "default"}_{port_offset}'
+
+
+class JobDeferred(Exception):
+    '''
+    Raised by the process function of an ArchivalQueue when a job can't be done yet
+    (it depends on a job that failed), it stays in the spool without being retried in this session
+    '''
+    pass
+
+
+class ArchivalQueue(threading.Thread):
+    '''
+    Runs jobs (the ConfigSavers' archival, the logbook messages) in a background thread, one at a time and in order.
+
+    A job is a JSON serializable dict with (at least) a 'kind' and a 'run'. If there is a spool directory,
+    the job is written to it when it's submitted, and only removed once it succeeded. A job can have a (big)
+    payload, given separately: it's only written to the spool by the background thread, before the job is
+    processed, which gets it as job['payload']. A failing job is retried with an exponential backoff,
+    up to max_retries times, after which on_failure(job, error) is called.
+
+    The spool directory is locked (flock) while the queue exists. The jobs left in it, and in the other
+    spool directories next to it whose lock can be taken (their nanorc is gone), are resubmitted at the
+    next start. on_adopt(spool_dir) is called before the jobs of such an orphaned directory are moved over.
+    '''
+
+    def __init__(self, name:str, process, spool_dir:Path=None, max_retries:int=5, retry_delay:float=2., max_retry_delay:float=60., on_failure=None, on_adopt=None):
+        super().__init__(name=f'{name}-archival', daemon=True)
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.process = process
+        self.spool_dir = Path(spool_dir) if spool_dir else None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_failure = on_failure
+        self.on_adopt = on_adopt
+
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.status_lock = threading.Lock()
+        self.submit_lock = threading.Lock()
+        self.jobs_status = {} # sequence number -> status
+        self.seq = 0
+        self.spool_lock = None
+        self.own_spool_dir = False # created for this process only, removed on stop if empty
+
+        if self.spool_dir:
+            self.spool_lock = self._lock(self.spool_dir)
+            if not self.spool_lock:
+                # another nanorc of the same session is running, don't touch its jobs
+                own_dir = self.spool_dir.with_name(f'{self.spool_dir.name}_{os.getpid()}')
+                self.log.warning(f'{self.spool_dir} is used by another nanorc, spooling in {own_dir}')
+                self.spool_dir = own_dir
+                self.own_spool_dir = True
+                self.spool_lock = self._lock(self.spool_dir)
+                if not self.spool_lock:
+                    raise RuntimeError(f'Couldn\'t lock the spool directory {self.spool_dir}')
+            self._adopt_orphans()
+            self._resubmit_spooled()
+
+    @staticmethod
+    def _lock(spool_dir:Path):
+        '''
+        Lock the spool directory, returns the lock file or None if another process holds it
+        '''
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(spool_dir/'.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _spooled_jobs(spool_dir:Path) -> list:
+        return sorted(p for p in spool_dir.glob('*.json') if p.name.split('-')[0].isdigit())
+
+    def _adopt_orphans(self):
+        first_seq = max([int(p.name.split('-')[0]) for p in self._spooled_jobs(self.spool_dir)], default=-1)+1
+        for orphan_dir in sorted(self.spool_dir.parent.iterdir()):
+            if orphan_dir == self.spool_dir or not orphan_dir.is_dir():
+                continue
+            lock = self._lock(orphan_dir)
+            if not lock:
+                continue # its nanorc is running
+            try:
+                jobs = self._spooled_jobs(orphan_dir)
+                if not jobs:
+                    continue
+                self.log.warning(f'Taking over the {len(jobs)} jobs left in {orphan_dir}')
+                if self.on_adopt:
+                    self.on_adopt(orphan_dir)
+                for path in jobs:
+                    _, _, rest = path.name.partition('-')
+                    new_path = self.spool_dir/f'{first_seq:08d}-{rest}'
+                    if self._payload_path(path).exists():
+                        os.replace(self._payload_path(path), self._payload_path(new_path))
+                    os.replace(path, new_path)
+                    first_seq += 1
+            except Exception as e:
+                self.log.error(f'Couldn\'t take over the jobs left in {orphan_dir}: {str(e)}')
+            finally:
+                lock.close()
+
+    def _resubmit_spooled(self):
+        for path in self._spooled_jobs(self.spool_dir):
+            try:
+                seq = int(path.name.split('-')[0])
+                with open(path) as f:
+                    job = json.load(f)
+            except Exception as e:
+                self.log.error(f'Ignoring the unreadable spooled job {path}: {str(e)}')
+                continue
+            self.seq = max(self.seq, seq+1)
+            self.log.warning(f'Resubmitting the {job["kind"]} job of run {job["run"]}, which didn\'t complete previously')
+            self._set_status(seq, job, 'queued')
+            self.queue.put((seq, job, path, None))
+
+    def _set_status(self, seq:int, job:dict, status:str, **extra):
+        with self.status_lock:
+            self.jobs_status[seq] = {'run': job['run'], 'kind': job['kind'], 'status': status, 'time': time.time(), **extra}
+
+    def submit(self, job:dict, payload=None) -> int:
+        '''
+        Queues the job (after writing it in the spool), returns its sequence number
+        '''
+        if payload is not None:
+            job = {**job, 'has_payload': True}
+        with self.submit_lock:
+            seq = self.seq
+            self.seq += 1
+            path = self._spool(seq, job) if self.spool_dir else None
+            self._set_status(seq, job, 'queued')
+            self.queue.put((seq, job, path, payload))
+        return seq
+
+    def status(self, run:int=None) -> dict:
+        '''
+        sequence number -> {'run', 'kind', 'status', 'time', ...} of the jobs of this session (and the resubmitted ones)
+        '''
+        with self.status_lock:
+            return {k: dict(v) for k, v in self.jobs_status.items() if run is None or v['run'] == run}
+
+    def _spool(self, seq:int, job:dict) -> Path:
+        path = self.spool_dir/f'{seq:08d}-{job["run"]}-{job["kind"]}.json'
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def _payload_path(path:Path) -> Path:
+        return path.with_suffix('.payload')
+
+    def _with_payload(self, job:dict, path:Path, payload) -> dict:
+        if not job.get('has_payload'):
+            return job
+        if payload is None: # resubmitted
+            with open(self._payload_path(path)) as f:
+                payload = json.load(f)
+        elif path and not self._payload_path(path).exists():
+            tmp_path = path.with_suffix('.payload.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, self._payload_path(path))
+        return {**job, 'payload': payload}
+
+    def _remove_spooled(self, path:Path):
+        self._payload_path(path).unlink(missing_ok=True)
+        path.unlink()
+
+    def _run_job(self, seq:int, job:dict, path:Path, payload=None):
+        try:
+            job = self._with_payload(job, path, payload)
+        except FileNotFoundError as e:
+            # nanorc was stopped before the payload was written, this job can't be done anymore
+            error = f'its payload was lost: {str(e)}'
+            self.log.error(f'Run {job["run"]}: couldn\'t complete the {job["kind"]}, {error}')
+            self._set_status(seq, job, 'failed', error=error)
+            if path:
+                self._remove_spooled(path)
+            if self.on_failure:
+                self.on_failure(job, error)
+            return
+
+        delay = self.retry_delay
+        for attempt in range(1, self.max_retries+1):
+            self._set_status(seq, job, 'running', attempt=attempt)
+            start = time.perf_counter()
+            try:
+                self.process(job)
+                self._set_status(seq, job, 'done', attempt=attempt, duration=time.perf_counter()-start)
+                self.log.info(f'Run {job["run"]}: {job["kind"]} done in {time.perf_counter()-start:.2f}s')
+                if path:
+                    self._remove_spooled(path)
+                return
+            except JobDeferred as e:
+                self.log.warning(f'Run {job["run"]}: {job["kind"]} deferred to the next start: {str(e)}')
+                self._set_status(seq, job, 'deferred', error=str(e), spooled=str(path) if path else None)
+                return
+            except Exception as e:
+                error = str(e)
+                self.log.warning(f'Run {job["run"]}: {job["kind"]} attempt {attempt}/{self.max_retries} failed: {error}')
+            if attempt == self.max_retries or self.stop_event.wait(delay):
+                break
+            delay = min(delay*2, self.max_retry_delay)
+
+        where = f', it is spooled in {path} and will be retried at the next start' if path else ''
+        self.log.error(f'Run {job["run"]}: couldn\'t complete the {job["kind"]}{where}')
+        self._set_status(seq, job, 'failed', attempt=attempt, error=error, spooled=str(path) if path else None)
+        if self.on_failure:
+            self.on_failure(job, error)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                seq, job, path, payload = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._run_job(seq, job, path, payload)
+            except Exception as e:
+                self.log.error(f'Run {job["run"]}: the {job["kind"]} job failed: {str(e)}')
+                self._set_status(seq, job, 'failed', error=str(e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout:float=None) -> bool:
+        '''
+        Wait for the submitted jobs to be processed, returns whether they all were
+        '''
+        end = time.time()+timeout if timeout is not None else None
+        while self.queue.unfinished_tasks:
+            if end is not None and time.time() > end:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self, timeout:float=None) -> None:
+        if not self.flush(timeout):
+            self.log.warning(f'{self.queue.unfinished_tasks} archival jobs didn\'t complete')
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(timeout=5)
+        if self.spool_lock and not self.is_alive(): # otherwise, it's released when the process ends
+            if self.own_spool_dir and not self._spooled_jobs(self.spool_dir):
+                try:
+                    (self.spool_dir/'.lock').unlink()
+                    self.spool_dir.rmdir()
+                except OSError:
+                    pass
+            self.spool_lock.close()
+            self.spool_lock = None
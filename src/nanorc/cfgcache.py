@@ -0,0 +1,194 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+
+
+def get_cache_dir() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return Path(cache_home)/'nanorc'/'config'
+
+
+def getenv_names(boot:dict) -> list:
+    '''
+    Names of the environment variables the boot section reads (the "getenv..." values)
+    '''
+    envs = [boot.get('env', {})]
+    envs += [s.get('env', {}) for s in (boot.get('scripts') or {}).values()]
+    envs += [e.get('env', {}) for e in boot.get('exec', {}).values()]
+
+    names = set()
+    for env in envs:
+        for k, v in env.items():
+            if str(v).find('getenv') == 0:
+                names.add(k)
+    return sorted(names)
+
+
+class ConfigCache:
+    '''
+    On-disk cache of processed configurations.
+
+    Entries are keyed by a hash of the content of every file of the configuration directory,
+    and of the parameters of the processing (see `key`). Each entry also records the values
+    of the environment variables used to process it, and is ignored if any of them changed.
+    '''
+
+    def __init__(self, cache_dir:Path=None, max_entries:int=32):
+        self.log = logging.getLogger('ConfigCache')
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir()
+        self.max_entries = max_entries
+
+    def key(self, path:str, **params) -> str:
+        from nanorc import __version__
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'nanorc-{__version__}'.encode())
+        for k in sorted(params):
+            h.update(f'{k}={params[k]!r};'.encode())
+
+        root = Path(path).resolve()
+        h.update(str(root).encode())
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                f = Path(dirpath)/filename
+                h.update(str(f.relative_to(root)).encode())
+                h.update(b'\0')
+                with open(f, 'rb') as fh:
+                    h.update(fh.read())
+                h.update(b'\0')
+
+        return h.hexdigest()
+
+    def _entry_path(self, key:str) -> Path:
+        return self.cache_dir/f'{key}.pickle'
+
+    def load(self, key:str) -> dict:
+        '''
+        The cached data, or None if there isn't any valid entry for this key
+        '''
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            return None
+
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            self.log.debug(f'Ignoring the unreadable cache entry {entry_path}: {str(e)}')
+            return None
+
+        for name, value in entry['env'].items():
+            if os.environ.get(name) != value:
+                self.log.debug(f'Ignoring the cache entry {entry_path}, ${name} changed')
+                return None
+
+        os.utime(entry_path)
+        return entry['data']
+
+    def store(self, key:str, data:dict, env_names:list=[]) -> None:
+        entry = {
+            'env': {name: os.environ.get(name) for name in env_names},
+            'data': data,
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first, so concurrent nanorcs never read a half written entry
+            tmp_path = self.cache_dir/f'{key}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._entry_path(key))
+            self.prune()
+        except Exception as e:
+            self.log.debug(f'Couldn\'t store the configuration in the cache: {str(e)}')
+
+    def prune(self) -> None:
+        '''
+        Keep only the max_entries most recently used entries
+        '''
+        entries = sorted(self.cache_dir.glob('*.pickle'), key=lambda p: p.stat().st_mtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            try:
+                entry.unlink()
+            except OSError:
+                pass
+
+
+class DBConfigCache:
+    '''
+    On-disk cache of the configurations downloaded from the configuration service.
+
+    Entries are keyed by (name, version). A given version of a configuration never changes,
+    so a versioned entry is used as is. The "latest" entry (version=None) is kept with the
+    ETag/Last-Modified the service sent, to revalidate it with a conditional request.
+    The least recently used entries are removed when the cache grows above max_bytes.
+    '''
+
+    def __init__(self, cache_dir:Path=None, max_bytes:int=256*1024*1024):
+        self.log = logging.getLogger('DBConfigCache')
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir().parent/'db'
+        self.max_bytes = max_bytes
+
+    def _entry_paths(self, name:str, version:str) -> tuple:
+        key = hashlib.blake2b(f'{name}\0{version or ""}'.encode(), digest_size=20).hexdigest()
+        return self.cache_dir/f'{key}.json', self.cache_dir/f'{key}.meta'
+
+    def load(self, name:str, version:str=None) -> tuple:
+        '''
+        The cached (content, metadata) of this configuration, or None if it isn't cached
+        '''
+        data_path, meta_path = self._entry_paths(name, version)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            with open(data_path, 'rb') as f:
+                content = f.read()
+        except Exception:
+            return None
+
+        if len(content) != meta['size']:
+            self.log.debug(f'Ignoring the truncated cache entry {data_path}')
+            return None
+
+        os.utime(data_path)
+        return content, meta
+
+    def store(self, name:str, version:str, content:bytes, etag:str=None, last_modified:str=None) -> None:
+        meta = {
+            'name': name,
+            'version': version,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': len(content),
+            'time': time.time(),
+        }
+        data_path, meta_path = self._entry_paths(name, version)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for path, payload in [(data_path, content), (meta_path, pickle.dumps(meta))]:
+                tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            self.prune()
+        except Exception as e:
+            self.log.debug(f'Couldn\'t store {name} in the cache: {str(e)}')
+
+    def prune(self) -> None:
+        '''
+        Remove the least recently used entries until the cache is smaller than max_bytes
+        '''
+        entries = sorted(self.cache_dir.glob('*.json'), key=lambda p: p.stat().st_mtime, reverse=True)
+        total = 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total <= self.max_bytes:
+                continue
+            for path in [entry, entry.with_suffix('.meta')]:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
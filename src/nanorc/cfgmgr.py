@@ -2,13 +2,24 @@ import os.path
 import os
 import tempfile
 import json
+import time
 import copy as cp
 import socket
+import logging
 import requests
 import importlib.resources as resources
 from . import confdata
 from urllib.parse import urlparse
 
+_db_service_session = None
+
+def get_db_service_session() -> requests.Session:
+    # shared by all the ConfigManagers, so the connection to the service is reused
+    global _db_service_session
+    if _db_service_session is None:
+        _db_service_session = requests.Session()
+    return _db_service_session
+
 class SessionNamespaceIncompatible(Exception):
     def __init__(self, namespace, session, conf):
         super().__init__(f'Session "{session}" and namespace "{namespace}" (in your configuration "{conf}") incompatible')
@@ -19,9 +30,65 @@ class WrongConfigurationType(Exception):
         super().__init__(f'The configuration "{conf.geturl()}" is incompatible with the "{pm}" process manager')
 
 
+def touched_keys(old, new, prefix:str='') -> dict:
+    '''
+    Keys which differ between old and new: key path -> (old value, new value)
+    '''
+    if isinstance(old, dict) and isinstance(new, dict):
+        ret = {}
+        for k in old.keys() | new.keys():
+            ret.update(touched_keys(old.get(k), new.get(k), f'{prefix}.{k}' if prefix else str(k)))
+        return ret
+    if old != new:
+        return {prefix: (old, new)}
+    return {}
+
+
+class ConfigTransformationReport:
+    '''
+    What nanorc changed in a configuration when loading it.
+
+    The touched keys are recorded as the configuration is transformed, which is cheap,
+    the full diffs are only computed when they are asked for.
+    '''
+
+    def __init__(self):
+        self.steps = {}
+
+    def add_step(self, title:str, touched:dict, old:dict=None, new:dict=None):
+        '''
+        touched: key path -> (old value, new value)
+        old/new: if provided, the full diff of the step is a DeepDiff between these
+        '''
+        self.steps[title] = {
+            'touched': touched,
+            'old': old,
+            'new': new,
+            'diff': None,
+        }
+
+    def summary(self) -> dict:
+        return {title: sorted(step['touched'].keys()) for title, step in self.steps.items()}
+
+    def diff(self, title:str) -> dict:
+        step = self.steps[title]
+        if step['diff'] is None:
+            if step['old'] is not None and step['new'] is not None:
+                from deepdiff import DeepDiff
+                step['diff'] = json.loads(DeepDiff(step['old'], step['new']).to_json())
+            else:
+                step['diff'] = {
+                    'values_changed': {
+                        key: {'old_value': old, 'new_value': new}
+                        for key, (old, new) in step['touched'].items()
+                    }
+                }
+        return step['diff']
+
+
 class ConfigManager:
 
-    def __init__(self, log, config_url, process_manager_description, port_offset=0, session=None, upload_to=None):
+    def __init__(self, log, config_url, process_manager_description, port_offset=0, session=None, upload_to=None, use_cache=True, lazy=False):
         super().__init__()
         self.process_manager_description = process_manager_description
         self.log = log
@@ -32,7 +99,43 @@ class ConfigManager:
         self.scheme = None
         self.ignore_for_custom_cmd = ['init', 'conf', 'boot', 'daqconf_multiru_gen', 'dromap', 'config']
         self.conf_server = upload_to
-        self.conf_data, self.config_query_string = self.fetch_configuration(config_url)
+        self.report = ConfigTransformationReport()
+        self.use_cache = use_cache
+        self.db_service_timeout = 10
+        self.db_cache_max_bytes = 256*1024*1024
+        # only use the cached db service configurations, don't even try to reach the service
+        self.db_offline = os.environ.get('NANORC_CONFIG_OFFLINE', '0').lower() in ['1', 'true', 'yes']
+
+        # with lazy, the commands of a directory are only parsed when they are first used
+        # (by the configuration server, or when the configuration is saved at start)
+        self.lazy = lazy
+
+        # the processed configuration of a directory is cached (unless it's loaded lazily, caching parses it all),
+        # the db service one is cached as downloaded (see fetch_from_configuration_db_service)
+        self.cache = None
+        cached = None
+        if use_cache and config_url.scheme != 'db' and not lazy:
+            from .cfgcache import ConfigCache
+            self.cache = ConfigCache()
+            start = time.perf_counter()
+            cache_key = self.cache.key(
+                config_url.path,
+                port_offset = port_offset,
+                pm = 'k8s' if process_manager_description.use_k8spm() else 'ssh',
+                hostname = socket.gethostname(),
+            )
+            cached = self.cache.load(cache_key)
+            if cached:
+                self.log.info(f'Using the cached configuration of "{config_url.path}" ({time.perf_counter()-start:.3f}s)')
+
+        if cached:
+            self.conf_data = cached['conf_data']
+            self.boot = cached['boot']
+            self.config_query_string = cached['config_query_string']
+            self.report = cached.get('report', self.report)
+        else:
+            self.conf_data, self.config_query_string = self.fetch_configuration(config_url)
+        self.connection_index = self._index_connections(self.conf_data)
         self.log.debug(f'"{config_url.path}" content: {list(self.conf_data.keys())}')
 
         self._ensure_conf_pm_consistency(
@@ -46,21 +149,21 @@ class ConfigManager:
             config_url
         )
 
-        self.boot = self._load_boot(
-            self.conf_data,
-            port_offset,
-            resolve_hostname = not process_manager_description.use_k8spm()
-        )
-        self._log_diff('NanoRC\'s boot parsing', self.boot, self.conf_data['boot'])
-
-        if process_manager_description.use_sshpm():
-            new_data = self._offset_ports(self.conf_data)
-            self._log_diff('NanoRC\'s port offsetting', self.conf_data, new_data)
-            self.conf_data = new_data
-
-            new_data = self._resolve_hostnames(self.conf_data)
-            self._log_diff('NanoRC\'s host resolution', self.conf_data, new_data)
-            self.conf_data = new_data
+        if not cached:
+            self._process_configuration(port_offset)
+
+            if self.cache:
+                from .cfgcache import getenv_names
+                self.cache.store(
+                    cache_key,
+                    {
+                        'conf_data': self.conf_data,
+                        'boot': self.boot,
+                        'config_query_string': self.config_query_string,
+                        'report': self.report,
+                    },
+                    env_names = getenv_names(self.conf_data['boot']),
+                )
 
         self.custom_commands = self._get_custom_commands_from_dict(self.conf_data)
         config_url._replace(scheme = '')
@@ -71,11 +174,30 @@ class ConfigManager:
         self.conf_server.add_configuration_data(config_url, self.conf_data)
         self.conf_url = f'{self.conf_server.get_conf_address_prefix()}?name={config_url}'
 
-    def _log_diff(self, title, dict_new, dict_old):
-        from deepdiff import DeepDiff
-        dd = DeepDiff(dict_new, dict_old)
-        dd = dd.to_json()
-        self.log.debug(f'{title}:\n{json.dumps(json.loads(dd), indent=4)}')
+    def _process_configuration(self, port_offset):
+        self.boot = self._load_boot(
+            self.conf_data,
+            port_offset,
+            resolve_hostname = not self.process_manager_description.use_k8spm()
+        )
+        self.report.add_step(
+            'NanoRC\'s boot parsing',
+            touched = touched_keys(self.conf_data['boot'], self.boot),
+            old = self.conf_data['boot'],
+            new = self.boot,
+        )
+        self._log_diff('NanoRC\'s boot parsing')
+
+        if self.process_manager_description.use_sshpm():
+            self._transform_connections(self.connection_index)
+            self._log_diff('NanoRC\'s port offsetting')
+            self._log_diff('NanoRC\'s host resolution')
+
+
+    def _log_diff(self, title):
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
+        self.log.debug(f'{title}:\n{json.dumps(self.report.diff(title), indent=4)}')
 
 
     def _ensure_conf_pm_consistency(self, data, pm, conf_name):
@@ -134,6 +256,7 @@ class ConfigManager:
 
         version = config_url.query
         conf_name = config_url.netloc
+        timeout = conf_service.get('timeout', self.db_service_timeout)
         r = None
 
         if version:
@@ -143,25 +266,70 @@ class ConfigManager:
             self.log.info(f'Using latest version of \'{conf_name}\'.')
             conf_query_str = svc_url+'/retrieveLast?name='+conf_name
 
+        cache = None
+        cached = None
+        if self.use_cache:
+            from .cfgcache import DBConfigCache
+            cache = DBConfigCache(max_bytes=conf_service.get('cache_max_bytes', self.db_cache_max_bytes))
+            cached = cache.load(conf_name, version)
+
+        # a given version never changes, no need to ask the service
+        if cached and version:
+            self.log.info(f'Using the cached version {version} of \'{conf_name}\'.')
+            return (json.loads(cached[0]), conf_query_str)
+
+        if self.db_offline:
+            if cached:
+                self.log.warning(f'Offline mode, using the cached latest version of \'{conf_name}\' (downloaded on {time.ctime(cached[1]["time"])}).')
+                return (json.loads(cached[0]), conf_query_str)
+            self.log.error(f'Offline mode, and \'{conf_name}\' isn\'t in the cache')
+            exit(1)
+
+        headers = {}
+        if cached:
+            if cached[1]['etag']:
+                headers['If-None-Match'] = cached[1]['etag']
+            if cached[1]['last_modified']:
+                headers['If-Modified-Since'] = cached[1]['last_modified']
+
         try:
             self.log.debug(f'Configuration request: http://{conf_query_str}')
-            r = requests.get("http://"+conf_query_str)
-            if r.status_code == 200:
-                return (r.json(), conf_query_str)
+            start = time.perf_counter()
+            r = get_db_service_session().get("http://"+conf_query_str, headers=headers, timeout=timeout)
+            if r.status_code == 304 and cached:
+                self.log.info(f'The cached latest version of \'{conf_name}\' is up to date ({time.perf_counter()-start:.3f}s).')
+                return (json.loads(cached[0]), conf_query_str)
+            elif r.status_code == 200:
+                conf_data = r.json()
+                self.log.debug(f'Downloaded {len(r.content)} bytes in {time.perf_counter()-start:.3f}s')
+                if cache:
+                    cache.store(
+                        conf_name, version, r.content,
+                        etag = r.headers.get('ETag'),
+                        last_modified = r.headers.get('Last-Modified'),
+                    )
+                return (conf_data, conf_query_str)
             else:
                 raise RuntimeError(f'Couldn\'t get the configuration {conf_name} from {svc_url}')
 
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if cached:
+                self.log.warning(f'Couldn\'t reach the conf service (http://{conf_query_str}), using the cached latest version of \'{conf_name}\' (downloaded on {time.ctime(cached[1]["time"])}).\nException: {str(e)}')
+                return (json.loads(cached[0]), conf_query_str)
+            self.log.error(f'Couldn\'t reach the conf service (http://{conf_query_str}), and \'{conf_name}\' isn\'t in the cache\nException: {str(e)}')
+            exit(1)
+
         except Exception as e:
-            if r:
-                self.log.error(f'Couldn\'t get the configuration from the conf service (http://{self.conf_str})\nService response: {json.loads(r.text).get("message",r.text)}\nException: {str(e)}')
+            if r is not None:
+                self.log.error(f'Couldn\'t get the configuration from the conf service (http://{conf_query_str})\nService response: {json.loads(r.text).get("message",r.text)}\nException: {str(e)}')
             else:
-                self.log.error(f'Something went horribly wrong while getting http://{self.conf_str}\nException: {str(e)}')
+                self.log.error(f'Something went horribly wrong while getting http://{conf_query_str}\nException: {str(e)}')
             exit(1)
 
 
     def fetch_from_file_system(self, config_url):
         from .utils import get_json_recursive
-        return (get_json_recursive(config_url.path), f'file://{config_url.path}')
+        return (get_json_recursive(config_url.path, lazy=self.lazy), f'file://{config_url.path}')
 
 
     def _import_data(self, cfg_path: dict) -> dict:
@@ -180,12 +348,13 @@ class ConfigManager:
         std_cmd = ['init', 'conf']
 
         for app_name, app_data in data.items():
-            if type(app_data) is not dict:
+            if not isinstance(app_data, dict):
                 continue
 
-            for command_name, command_data in app_data.items():
+            for command_name in app_data.keys():
                 if command_name in std_cmd:
                     continue
+                command_data = app_data[command_name] # not before, it may not be parsed yet
 
                 if type(command_data) is not dict:
                     continue
@@ -203,69 +372,65 @@ class ConfigManager:
     def get_custom_commands(self):
         return self.custom_commands
 
-    def _resolve_hostnames(self, conf_data):
-        conf_port_host_resolved = cp.deepcopy(conf_data)
-
-        hosts = self.boot.get('hosts-data',{})
-        from nanorc.utils import parse_string
-
-        for app_name, app_data in conf_port_host_resolved.items():
-            if not type(app_data) == dict:
+    def _index_connections(self, conf_data) -> dict:
+        '''
+        uid -> list of (app name, connection), the connections being the dicts of the configuration (not copies)
+        '''
+        index = {}
+        for app_name, app_data in conf_data.items():
+            if not isinstance(app_data, dict):
                 continue
 
-            if not 'init' in app_data:
+            init_data = app_data.get('init')
+            if not type(init_data) == dict:
                 continue
 
-            init_data = app_data['init']
-
-            if not "connections" in init_data:
-                return conf_data
-
-            for connection in init_data['connections']:
-                if "queue://" in connection['uri']:
-                    continue
+            for connection in init_data.get('connections', []):
+                index.setdefault(connection['id']['uid'], []).append((app_name, connection))
+        return index
 
-                origuri = connection['uri']
-                connection['uri'] = parse_string(connection['uri'], hosts)
-                self.log.debug(f" - '{connection['id']['uid']}': {connection['uri']} ({origuri})")
 
-            conf_port_host_resolved[app_name]['init'] = init_data
+    def _offset_port(self, uri:str) -> str:
+        parsed = urlparse(uri)
+        port = parsed.port
+        if port is None:
+            raise ValueError('no port in the uri')
+        host = parsed.netloc.rsplit(':', 1)[0]
+        return parsed._replace(netloc=f'{host}:{port+self.port_offset}').geturl()
 
-        return conf_port_host_resolved
 
-
-    def _offset_ports(self, conf_data):
-        conf_port_offset = cp.deepcopy(conf_data)
+    def _transform_connections(self, connection_index:dict):
+        '''
+        Offsets the ports and resolves the hosts of the connections, in place
+        '''
         external_connections = self.boot.get('external_connections', [])
+        hosts = self.boot.get('hosts-data',{})
+        from nanorc.utils import parse_string
+        offset = {}
+        resolved = {}
 
-        for app_name, app_data in conf_port_offset.items():
-            if not type(app_data) == dict:
-                continue
-
-            if not 'init' in app_data:
-                continue
-
-            init_data = app_data['init']
-            if not "connections" in init_data:
-                continue
-
-            for connection in init_data['connections']:
+        for uid, connections in connection_index.items():
+            for app_name, connection in connections:
                 if "queue://" in connection['uri']:
                     continue
 
-                if not connection['id']['uid'] in external_connections:
+                key = f"{app_name}.init.connections.{uid}.uri"
+
+                if not uid in external_connections:
                     try:
-                        port = urlparse(connection['uri']).port
-                        newport = port + self.port_offset
-                        connection['uri'] = connection['uri'].replace(str(port), str(newport))
-                        self.log.debug(f" - '{connection['id']['uid']}': {connection['uri']}")
+                        origuri = connection['uri']
+                        connection['uri'] = self._offset_port(origuri)
+                        offset[key] = (origuri, connection['uri'])
                     except Exception as e:
-                        self.log.debug(f" - '{connection['id']['uid']}' ('{connection['uri']}') port wasn\'t offset, reason: {str(e)}")
-
-            conf_port_offset[app_name]['init'] = init_data
+                        self.log.debug(f" - '{uid}' ('{connection['uri']}') port wasn\'t offset, reason: {str(e)}")
 
-        return conf_port_offset
+                origuri = connection['uri']
+                connection['uri'] = parse_string(origuri, hosts)
+                if connection['uri'] != origuri:
+                    resolved[key] = (origuri, connection['uri'])
 
+        self.report.add_step('NanoRC\'s port offsetting', offset)
+        self.report.add_step('NanoRC\'s host resolution', resolved)
 
 
     def _load_boot(self, config, port_offset, resolve_hostname):
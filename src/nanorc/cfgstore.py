@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+
+class ConfigBlobStore:
+    '''
+    Content-addressed store of configuration files: each distinct file is stored once,
+    in <root>/<hash[:2]>/<hash>.json, where hash is the sha256 of its content.
+    '''
+
+    def __init__(self, root:Path):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.root = Path(root)
+
+    @staticmethod
+    def hash(content:bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def path(self, blob_hash:str) -> Path:
+        return self.root/blob_hash[:2]/f'{blob_hash}.json'
+
+    def contains(self, blob_hash:str) -> bool:
+        return self.path(blob_hash).exists()
+
+    def put(self, content:bytes, blob_hash:str=None) -> str:
+        blob_hash = blob_hash if blob_hash else self.hash(content)
+        path = self.path(blob_hash)
+        if path.exists():
+            return blob_hash
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return blob_hash
+
+    def get(self, blob_hash:str) -> bytes:
+        with open(self.path(blob_hash), 'rb') as f:
+            return f.read()
+
+
+MANIFEST_NAME = 'manifest.json'
+
+def write_manifest(run_dir:Path, run:int, files:dict) -> None:
+    '''
+    files: path relative to the run directory -> blob hash
+    '''
+    manifest = {
+        'run': run,
+        'files': files,
+    }
+    with open(Path(run_dir)/MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def materialize_run(run_dir:Path, outdir:Path, blob_store:ConfigBlobStore=None, link:bool=False) -> list:
+    '''
+    Rebuild the full configuration directory of a run in outdir (the files listed in its manifest,
+    and the others of the run directory, i.e. the runtime data), returns the files written.
+    By default, the blobs are in the "blobs" directory next to the run directory.
+    With link=True, the configuration files are hard links to the blobs (don't modify them!).
+    '''
+    run_dir = Path(run_dir)
+    outdir = Path(outdir)
+    manifest_path = run_dir/MANIFEST_NAME
+    written = []
+
+    if not manifest_path.exists():
+        # saved before the blob store, it's already complete
+        shutil.copytree(run_dir, outdir, dirs_exist_ok=True)
+        return [p for p in outdir.rglob('*') if p.is_file()]
+
+    if not blob_store:
+        blob_store = ConfigBlobStore(run_dir.parent/'blobs')
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    for rel_path, blob_hash in manifest['files'].items():
+        dest = outdir/rel_path.lstrip('/')
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        src = blob_store.path(blob_hash)
+        if not src.exists():
+            raise RuntimeError(f'The blob {blob_hash} of {rel_path} isn\'t in {blob_store.root}')
+        if link:
+            if dest.exists():
+                dest.unlink()
+            os.link(src, dest)
+        else:
+            shutil.copyfile(src, dest)
+        written.append(dest)
+
+    for src in run_dir.rglob('*'):
+        if not src.is_file() or src == manifest_path:
+            continue
+        dest = outdir/src.relative_to(run_dir)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(src, dest)
+        written.append(dest)
+
+    return written
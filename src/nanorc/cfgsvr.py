@@ -6,11 +6,17 @@ import logging
 import tarfile
 import json
 import copy
+import time
+import uuid
+import queue
+import threading
 import requests
 import tempfile
 from .statefulnode import StatefulNode
 from .node import SubsystemNode
 from .cfgmgr import ConfigManager
+from .archiver import ArchivalQueue, get_spool_dir
+from .cfgstore import ConfigBlobStore, write_manifest
 #from .credmgr import credentials,Authentication
 from distutils.dir_util import copy_tree
 
@@ -20,8 +26,139 @@ def make_tarfile(output_filename, source_dir):
     with tarfile.open(output_filename, "w:gz") as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
-def save_conf_to_dir(topnode, outdir, runtime_data):
+class ChunkPipe:
+    '''
+    Write end of a pipe made of a bounded queue of chunks, read with `chunks()`
+    '''
+    def __init__(self, chunk_size:int=1024*1024, max_chunks:int=8):
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.cancelled = threading.Event()
+        self.error = None
+        self.bytes_written = 0
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError('The reader of the pipe went away')
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error:Exception=None):
+        self.error = error
+        if self.buffer and not error:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._put(None)
+
+    def chunks(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+                yield chunk
+            if self.error:
+                raise RuntimeError(f'Couldn\'t create the tarball: {str(self.error)}') from self.error
+        finally:
+            self.cancelled.set()
+
+
+class CountingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        pass
 
+
+def stream_tarball(files:dict, arcname:str, compression:str='gzip', level:int=6, chunk_size:int=1024*1024, max_chunks:int=8):
+    '''
+    Tars (as arcname/<path>) and compresses the files (path -> JSON content) in a background thread.
+    Returns the compressed chunks generator, a function returning the (uncompressed, compressed) sizes,
+    and a function to stop the creation. At most max_chunks chunks of chunk_size bytes are waiting to be read.
+    '''
+    import io
+    pipe = ChunkPipe(chunk_size, max_chunks)
+
+    if compression == 'zstd':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level).stream_writer(pipe, closefd=False)
+    elif compression == 'gzip':
+        import gzip
+        compressor = gzip.GzipFile(fileobj=pipe, mode='wb', compresslevel=level)
+    else:
+        raise RuntimeError(f'Unknown compression {compression}, use gzip or zstd')
+
+    tar_stream = CountingWriter(compressor)
+
+    def produce():
+        error = None
+        try:
+            with tarfile.open(fileobj=tar_stream, mode='w|') as tar:
+                for path, content in files.items():
+                    data = json.dumps(content, indent=4, sort_keys=True).encode()
+                    info = tarfile.TarInfo(name=arcname+path)
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    tar.addfile(info, io.BytesIO(data))
+            compressor.close()
+        except Exception as e:
+            error = e
+        try:
+            pipe.close(error)
+        except RuntimeError:
+            pass # nobody's reading anymore
+
+    threading.Thread(target=produce, name='tarball', daemon=True).start()
+    return pipe.chunks(), lambda: (tar_stream.bytes_written, pipe.bytes_written), pipe.cancelled.set
+
+
+def multipart_stream(fields:dict, file_field:str, filename:str, file_content_type:str, chunks):
+    '''
+    multipart/form-data body of the fields and a file made of chunks, as a generator,
+    so it can be sent (chunked) while the file is being created.
+    Returns the content type (with the boundary) and the body generator.
+    '''
+    boundary = uuid.uuid4().hex
+
+    def body():
+        for name, value in fields.items():
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+               f'Content-Type: {file_content_type}\r\n\r\n').encode()
+        yield from chunks
+        yield f'\r\n--{boundary}--\r\n'.encode()
+
+    return f'multipart/form-data; boundary={boundary}', body()
+
+
+def snapshot_configuration(topnode, runtime_data) -> dict:
+    '''
+    The files to save for a run, relative path -> content, as they are when it's called.
+    The configurations are the ones nanorc serves from memory, there is no need to download them
+    (they aren't modified after being loaded), the runtime data is copied.
+    '''
+    files = {}
     for node in PreOrderIter(topnode):
 
         if isinstance(node, SubsystemNode):
@@ -30,29 +167,20 @@ def save_conf_to_dir(topnode, outdir, runtime_data):
             for parent in node.path:
                 this_path += "/"+parent.name
 
-            full_path = outdir+this_path
-            os.makedirs(full_path)
+            files[this_path+'/full_configuration.json'] = node.cfgmgr.conf_data
+            files[this_path+'/runtime_data.json'] = copy.deepcopy(node.cfgmgr.generate_data_for_module(runtime_data))
 
-            location = node.cfgmgr.get_conf_location(for_apps=False)
+    return files
 
-            if os.path.isdir(location):
-                copy_tree(location, full_path)
+def write_configuration_files(files:dict, outdir:str):
+    for path, content in files.items():
+        full_path = outdir+path
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            json.dump(content, f, indent=4, sort_keys=True)
 
-            else:
-                import requests
-                r = requests.get(location)
-                if r.status_code == 200:
-                    config = r.json()
-                    with open(os.path.join(full_path, 'full_configuration.json'), 'w') as f:
-                        json.dump(config, f, indent=4, sort_keys=True)
-                else:
-                    raise RuntimeError(f'Couldn\'t get the configuration {location}')
-
-
-            rd = node.cfgmgr.generate_data_for_module(runtime_data)
-
-            with open(os.path.join(full_path, "runtime_data.json"), "w") as f:
-                json.dump(rd, f, indent=4, sort_keys=True)
+def save_conf_to_dir(topnode, outdir, runtime_data):
+    write_configuration_files(snapshot_configuration(topnode, runtime_data), outdir)
 
 
 class FileConfigSaver:
@@ -62,6 +190,48 @@ class FileConfigSaver:
         super(FileConfigSaver, self).__init__()
         self.cfgmgr = None
         self.outdir = cfg_outdir
+        # the configurations are stored once in cfg_outdir/blobs, the run directories only
+        # have a manifest pointing to them and the runtime data (see nanorc.cfgstore)
+        self.blob_store = ConfigBlobStore(os.path.join(cfg_outdir, 'blobs'))
+        self.blob_hashes = {} # id(configuration) -> (configuration, hash)
+        # the files are written in the background, the run directory is local, no need to spool
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.archiver = ArchivalQueue('file-config-saver', self._process, max_retries=1, on_failure=self._failed)
+        self.archiver.start()
+        self.on_failure = None # called with (run, error message) when a configuration couldn't be saved
+
+    def _failed(self, job:dict, error:str):
+        self.log.error(f'Run {job["run"]}: couldn\'t save the configuration in {job["outdir"]}: {error}')
+        if self.on_failure:
+            self.on_failure(job['run'], f'the configuration couldn\'t be saved in {job["outdir"]}: {error}')
+
+    def _store_configuration(self, content) -> str:
+        # the same configuration objects are saved at every run, only serialize and hash them once
+        # (a reference is kept, so the id can't be reused by another object)
+        known = self.blob_hashes.get(id(content))
+        if known and known[0] is content and self.blob_store.contains(known[1]):
+            return known[1]
+        blob_hash = self.blob_store.put(json.dumps(content, indent=4, sort_keys=True).encode())
+        self.blob_hashes[id(content)] = (content, blob_hash)
+        return blob_hash
+
+    def _process(self, job:dict):
+        runtime_data = {}
+        manifest = {}
+        for path, content in job['payload'].items():
+            if os.path.basename(path) == 'runtime_data.json':
+                runtime_data[path] = content
+            else:
+                manifest[path] = self._store_configuration(content)
+
+        write_configuration_files(runtime_data, job['outdir'])
+        write_manifest(job['outdir'], job['run'], manifest)
+
+    def status(self, run:int=None) -> dict:
+        return self.archiver.status(run)
+
+    def stop(self, timeout:float=None) -> None:
+        self.archiver.stop(timeout)
 
     def _get_new_out_dir_name(self, run:int) -> str:
         """
@@ -119,14 +289,18 @@ class FileConfigSaver:
             raise RuntimeError(f"{__name__}: ERROR : You need to set the cfgmgr of this ConfigSaver")
         try:
             self.thisrun_outdir = self._get_new_out_dir_name(run)
+            # reserve the directory now, the files are written in the background
+            os.makedirs(self.thisrun_outdir)
         except Exception as e:
             raise RuntimeError(str(e))
 
-        save_conf_to_dir(
-            outdir = self.thisrun_outdir,
-            topnode = topnode,
-            runtime_data = data,
-        )
+        # snapshot now, only the writing is deferred
+        self.archiver.submit({
+            'kind': 'configuration',
+            'run': run,
+            'outdir': self.thisrun_outdir,
+            'payload': snapshot_configuration(topnode, data),
+        })
         return self.thisrun_outdir
 
 
@@ -137,15 +311,46 @@ class FileConfigSaver:
 
 
 class DBConfigSaver:
-    def __init__(self, socket:str):
+    def __init__(self, socket:str, compression:str='gzip', compression_level:int=6, chunked_upload:bool=True, session:str=None, port_offset:int=0):
         self.API_SOCKET = socket
         from nanorc.credmgr import credentials
         auth = credentials.get_login("run_registry")
         self.API_USER = auth.username
         self.API_PSWD = auth.password
         self.timeout = 2
+        self.upload_timeout = 60
+        self.compression = compression
+        self.compression_level = compression_level
+        # send the tarball while it's being created, otherwise build it first (in memory, or on disk if it's big)
+        self.chunked_upload = chunked_upload
         self.apparatus_id = None
         self.log = logging.getLogger(self.__class__.__name__)
+        self.session = requests.Session()
+        # the insertions and stop times are sent in the background, in order, and spooled
+        # to disk until the run registry acknowledges them
+        self.archiver = ArchivalQueue('run-registry', self._process, spool_dir=get_spool_dir('run_registry', session, port_offset), on_failure=self._failed)
+        self.archiver.start()
+        self.on_failure = None # called with (run, error message) when a run couldn't be recorded
+
+    def _failed(self, job:dict, error:str):
+        what = {'insert': 'insertion in', 'stop': 'stop time update of'}.get(job['kind'], job['kind'])
+        self.log.error(f'Run {job["run"]}: the {what} the run registry failed: {error}')
+        if self.on_failure:
+            self.on_failure(job['run'], f'the {what} the run registry failed (it will be retried at the next start): {error}')
+
+    def status(self, run:int=None) -> dict:
+        return self.archiver.status(run)
+
+    def stop(self, timeout:float=None) -> None:
+        self.archiver.stop(timeout)
+
+    def _process(self, job:dict):
+        if job['kind'] == 'insert':
+            self._insert_run(job['post_data'], job['payload'])
+        elif job['kind'] == 'stop':
+            self._update_stop_time(job['run'])
+        else:
+            raise RuntimeError(f'Unknown run registry job {job["kind"]}')
 
     def save_on_resume(self, topnode, overwrite_data:dict, cfg_method:str) -> str:
         return "not_saving_to_db_on_resume"
@@ -155,78 +360,109 @@ class DBConfigSaver:
                       run:int,
                       run_type:str,
                       data:dict) -> str:
+        '''
+        Checks and records what to send to the run registry, the configuration is sent in the background
+        '''
+        from urllib.parse import ParseResult
+        version = os.getenv("DUNE_DAQ_BASE_RELEASE")
+        if not version:
+            raise RuntimeError('RunRegistryDB: dunedaq version not in the variable env DUNE_DAQ_BASE_RELEASE! Exit nanorc and\nexport DUNE_DAQ_BASE_RELEASE=dunedaq-vX.XX.XX\n')
+
+        post_data = {"run_num": run,
+                     "det_id": self.apparatus_id,
+                     "run_type": run_type,
+                     "software_version": version}
+
+        nice_top = {}
+        for key, value in self.cfgmgr.top_cfg.items():
+            if isinstance(value, ParseResult):
+                nice_top[key] = value.geturl()
+            else:
+                nice_top[key] = value
+
+        # snapshot now, the payload is only serialized (in the spool) and uploaded in the background
+        self.archiver.submit(
+            {
+                'kind': 'insert',
+                'run': run,
+                'post_data': post_data,
+            },
+            payload = {
+                '/top_config.json': nice_top,
+                **snapshot_configuration(topnode, data),
+            },
+        )
+        return "run_registry_db"
+
+    def _insert_run(self, post_data:dict, payload:dict):
+        run = post_data['run_num']
+        extension = {'gzip': 'tar.gz', 'zstd': 'tar.zst'}.get(self.compression, 'tar')
+        file_content_type = {'gzip': 'application/gzip', 'zstd': 'application/zstd'}.get(self.compression, 'application/x-tar')
+
+        start = time.perf_counter()
+        chunks, sizes, cancel = stream_tarball(
+            payload,
+            arcname = f'RunConf_{run}',
+            compression = self.compression,
+            level = self.compression_level,
+        )
+        content_type, body = multipart_stream(
+            post_data,
+            file_field = 'file',
+            filename = f'RunConf_{run}.{extension}',
+            file_content_type = file_content_type,
+            chunks = chunks,
+        )
 
-        fname=None
-        dname=None
-
-        with tempfile.TemporaryDirectory() as dir_name:
-            from urllib.parse import ParseResult
-            dname = dir_name
-            json_object = self.cfgmgr.top_cfg
-            nice_top = {}
-            for key, value in json_object.items():
-                if isinstance(value, ParseResult):
-                    nice_top[key] = value.geturl()
-                else:
-                    nice_top[key] = value
-            with open(dname+"/top_config.json", "w") as outfile:
-                json.dump(nice_top, outfile, indent=4)
-
-            save_conf_to_dir(
-                outdir = dir_name,
-                topnode = topnode,
-                runtime_data = data,
-            )
-
-            with tempfile.NamedTemporaryFile(suffix='.tar.gz', delete=False) as f:
-                with tarfile.open(fileobj=f, mode='w:gz') as tar:
-                    tar.add(dname, arcname=os.path.basename(dname))
-                f.flush()
-                f.seek(0)
-                fname = f.name
-
-            with open(fname, "rb") as f:
-                files = {'file': f}
-                version = os.getenv("DUNE_DAQ_BASE_RELEASE")
-                if not version:
-                    raise RuntimeError('RunRegistryDB: dunedaq version not in the variable env DUNE_DAQ_BASE_RELEASE! Exit nanorc and\nexport DUNE_DAQ_BASE_RELEASE=dunedaq-vX.XX.XX\n')
-
-                post_data = {"run_num": run,
-                             "det_id": self.apparatus_id,
-                             "run_type": run_type,
-                             "software_version": version}
-
-
-                try:
-                    r = requests.post(self.API_SOCKET+"/runregistry/insertRun/",
-                                      files=files,
-                                      data=post_data,
-                                      auth=(self.API_USER, self.API_PSWD),
-                                      timeout=self.timeout)
-                    r.raise_for_status()
-
-                except requests.HTTPError as exc:
-                    error = f"{__name__}: RunRegistryDB: HTTP Error: {exc}, {r.text}"
-                    self.log.error(error)
-                    raise RuntimeError(error) from exc
-                except requests.ConnectionError as exc:
-                    error = f"{__name__}: Connection to {self.API_SOCKET} wasn't successful: {exc}"
-                    self.log.error(error)
-                    raise RuntimeError(error) from exc
-                except requests.Timeout as exc:
-                    error = f"{__name__}: Connection to {self.API_SOCKET} timed out: {exc}"
-                    self.log.error(error)
-                    raise RuntimeError(error) from exc
-
-            os.remove(fname)
+        if not self.chunked_upload:
+            spooled_body = tempfile.SpooledTemporaryFile(max_size=64*1024*1024)
+            for chunk in body:
+                spooled_body.write(chunk)
+            spooled_body.seek(0)
+            body = spooled_body
 
-        return "run_registry_db"
+        try:
+            r = self.session.post(self.API_SOCKET+"/runregistry/insertRun/",
+                                  data=body,
+                                  headers={'Content-Type': content_type},
+                                  auth=(self.API_USER, self.API_PSWD),
+                                  timeout=self.upload_timeout)
+            r.raise_for_status()
+
+        except requests.HTTPError as exc:
+            error = f"{__name__}: RunRegistryDB: HTTP Error: {exc}, {r.text}"
+            self.log.error(error)
+            raise RuntimeError(error) from exc
+        except requests.ConnectionError as exc:
+            error = f"{__name__}: Connection to {self.API_SOCKET} wasn't successful: {exc}"
+            self.log.error(error)
+            raise RuntimeError(error) from exc
+        except requests.Timeout as exc:
+            error = f"{__name__}: Connection to {self.API_SOCKET} timed out: {exc}"
+            self.log.error(error)
+            raise RuntimeError(error) from exc
+        finally:
+            body.close()
+            cancel()
+
+        elapsed = time.perf_counter()-start
+        raw, compressed = sizes()
+        self.log.info(
+            f'Run {run}: uploaded {raw/1e6:.2f}MB of configuration as {compressed/1e6:.2f}MB '
+            f'({self.compression} level {self.compression_level}, ratio {raw/max(compressed, 1):.1f}) '
+            f'in {elapsed:.2f}s ({raw/1e6/max(elapsed, 1e-6):.1f}MB/s)'
+        )
 
     def save_on_stop(self, run:str) -> None:
+        # after the insertion of this run, which may still be in the queue
+        self.archiver.submit({'kind': 'stop', 'run': run})
+
+    def _update_stop_time(self, run:str) -> None:
         try:
-            r = requests.get(self.API_SOCKET+"/runregistry/updateStopTime/"+str(run),
-                              auth=(self.API_USER, self.API_PSWD),
-                              timeout=self.timeout)
+            r = self.session.get(self.API_SOCKET+"/runregistry/updateStopTime/"+str(run),
+                                 auth=(self.API_USER, self.API_PSWD),
+                                 timeout=self.timeout)
+            r.raise_for_status()
         except requests.HTTPError as exc:
             error = f"{__name__}: RunRegistryDB: HTTP Error (maybe failed auth, maybe ill-formed post message, ...)"
             self.log.error(error)
@@ -61,6 +61,21 @@ def ls(obj, legend):
     obj.rc.ls(leg=legend)
 
 
+@click.command()
+@accept_path()
+@click.option('--diff', type=bool, is_flag=True, default=False, help='Show the full diff of each transformation')
+@click.pass_obj
+def config_report(obj, node_path, diff):
+    obj.rc.config_report(node_path=node_path, diff=diff)
+
+
+@click.command()
+@click.option('--run', type=int, default=None, help='Only show this run')
+@click.pass_obj
+def archival_status(obj, run):
+    obj.rc.archival_status(run=run)
+
+
 @click.command()
 @click.argument('pin-thread-file', type=click.Path(exists=True, resolve_path=True))
 @accept_timeout(None)
@@ -301,6 +316,8 @@ def start_shell(ctx, obj):
 def add_common_cmds(shell, end_of_run_cmds=True):
     shell.add_command(status              , 'status'              )
     shell.add_command(ls                  , 'ls'                  )
+    shell.add_command(config_report       , 'config_report'       )
+    shell.add_command(archival_status     , 'archival_status'     )
     shell.add_command(pin_threads         , 'pin_threads'         )
     shell.add_command(boot                , 'boot'                )
     shell.add_command(conf                , 'conf'                )
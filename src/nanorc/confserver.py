@@ -1,8 +1,116 @@
+import json
+import gzip
+import hashlib
 import logging
+import threading
 from rich.console import Console
 from flask_restful import Resource
 from flask import request, abort, make_response, jsonify, abort
 
+
+class SerializedBlob:
+    '''
+    The JSON bytes of a piece of configuration, with its ETag and its compressed versions
+    '''
+    def __init__(self, data):
+        self.body = json.dumps(data, separators=(',', ':')).encode()+b'\n'
+        self.etag = '"'+hashlib.blake2b(self.body, digest_size=16).hexdigest()+'"'
+        self.empty = (data == {})
+        self.encoded = {} # encoding -> compressed body, filled the first time it's asked for
+
+    def encode(self, encoding:str) -> bytes:
+        ret = self.encoded.get(encoding)
+        if ret is None:
+            if encoding == 'zstd':
+                import zstandard
+                ret = zstandard.ZstdCompressor(level=3).compress(self.body)
+            elif encoding == 'gzip':
+                ret = gzip.compress(self.body, compresslevel=6)
+            else:
+                raise ValueError(f'Unknown encoding {encoding}')
+            self.encoded[encoding] = ret
+        return ret
+
+
+class SerializedConfiguration:
+    '''
+    A configuration serialized once, for the whole configuration, each application, and each command of each application.
+    The empty applications and commands aren't, they are left to extract_data (which answers 404 for them).
+    If some applications are loaded lazily (see LazyJSONDict), the pieces are serialized the first time they are asked for,
+    so that only then are they parsed.
+    '''
+    def __init__(self, data:dict):
+        from nanorc.utils import LazyJSONDict
+        self.data = data
+        self.blobs = {}
+        self.lazy = any(isinstance(app_data, LazyJSONDict) for app_data in data.values())
+        if self.lazy:
+            return
+
+        self.blobs[(None, None)] = SerializedBlob(data)
+        for app_name, app_data in data.items():
+            if not app_data:
+                continue
+            self.blobs[(app_name, None)] = SerializedBlob(app_data)
+            if not isinstance(app_data, dict):
+                continue
+            for cmd_name, cmd_data in app_data.items():
+                if not cmd_data:
+                    continue
+                self.blobs[(app_name, cmd_name)] = SerializedBlob(cmd_data)
+
+    def _serialize(self, app_name, cmd_name) -> SerializedBlob:
+        if app_name is None:
+            return SerializedBlob(self.data) if cmd_name is None else None
+        value = self.data.get(app_name)
+        if cmd_name is not None:
+            value = value.get(cmd_name) if isinstance(value, dict) else None
+        return SerializedBlob(value) if value else None
+
+    def get(self, app_name, cmd_name) -> SerializedBlob:
+        blob = self.blobs.get((app_name, cmd_name))
+        if blob or not self.lazy:
+            return blob
+        # two requests may serialize the same piece concurrently, that's harmless
+        blob = self._serialize(app_name, cmd_name)
+        if blob:
+            self.blobs[(app_name, cmd_name)] = blob
+        return blob
+
+
+def supported_encodings() -> list:
+    ret = []
+    try:
+        import zstandard
+        ret += ['zstd']
+    except ImportError:
+        pass
+    return ret + ['gzip']
+
+
+def blob_response(blob:SerializedBlob, request, encodings:list):
+    if blob.empty:
+        res = make_response('', 204)
+        res.headers['ETag'] = blob.etag
+        return res
+
+    if blob.etag in [e.strip() for e in request.headers.get('If-None-Match', '').split(',')]:
+        res = make_response('', 304)
+        res.headers['ETag'] = blob.etag
+        return res
+
+    accepted = [e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').split(',')]
+    encoding = next((e for e in encodings if e in accepted), None)
+
+    res = make_response(blob.encode(encoding) if encoding else blob.body)
+    res.headers['Content-Type'] = 'application/json'
+    res.headers['ETag'] = blob.etag
+    res.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        res.headers['Content-Encoding'] = encoding
+    return res
+
+
 def extract_data(request, dico, conf_name):
     app_name = request.args.get('app_name')
     cmd_name = request.args.get('cmd_name')
@@ -32,8 +140,10 @@ def extract_data(request, dico, conf_name):
     return res
 
 class ConfigurationEndpoint(Resource):
-    def __init__(self, config_data, *args, **kwargs):
+    def __init__(self, config_data, serialized_data, encodings, *args, **kwargs):
         self.conf_data = config_data
+        self.serialized_data = serialized_data
+        self.encodings = encodings
         super().__init__(*args, **kwargs)
         self.log = logging.getLogger('ConfigurationEndpoint')
 
@@ -43,6 +153,7 @@ class ConfigurationEndpoint(Resource):
         try:
             name = request.args['name']
             conf_json = request.json
+            self.serialized_data[name] = SerializedConfiguration(conf_json)
             self.conf_data[name] = conf_json
             res['success'] = True
         except Exception as e:
@@ -61,6 +172,12 @@ class ConfigurationEndpoint(Resource):
         if name not in self.conf_data:
             abort(404, description=f'{name} not in configurations store, available configs are: {list(self.conf_data.keys())}')
 
+        serialized = self.serialized_data.get(name)
+        blob = serialized.get(request.args.get('app_name'), request.args.get('cmd_name')) if serialized else None
+        if blob:
+            return blob_response(blob, request, self.encodings)
+
+        # not pre-serialized (likely an error), do it the slow way
         return extract_data(request, self.conf_data[name], name)
 
 class ConfigUploadFailed(Exception):
@@ -83,11 +200,21 @@ class ConfigurationAlreadyPresent(Exception):
         super().__init__(f"Couldn't add the configuration {self.name} to nanorc's internal configuration server, the configuration is already present in the internal store")
 
 class ConfServer:
-    def __init__(self, port):
+    '''
+    Serves the configurations to the applications, from a server thread in nanorc's process.
+    The configurations are added to its store directly, without copying them.
+    '''
+    def __init__(self, port, threads:int=16):
         self.log = logging.getLogger('nano-conf-service')
         self.config_data = {}
+        self.serialized_data = {}
+        self.encodings = supported_encodings()
+        self.threads = threads
         self.uploaded_name = set()
+        self.uploaded_name_lock = threading.Lock() # the subsystem configurations are added concurrently
         self.port = port
+        self.server = None
+        self.server_thread = None
         self._start_conf_service()
 
     def get_conf_address_prefix(self):
@@ -103,60 +230,58 @@ class ConfServer:
         self.api.add_resource(
             ConfigurationEndpoint, "/configuration",
             methods = ['GET', 'POST'],
-            resource_class_kwargs = {"config_data":self.config_data}
-        )
-
-        from .utils import FlaskManager
-        self.manager = FlaskManager(
-            port = self.port,
-            app = self.app,
-            name = "nano-conf-svc"
+            resource_class_kwargs = {
+                "config_data": self.config_data,
+                "serialized_data": self.serialized_data,
+                "encodings": self.encodings,
+            }
         )
 
-        self.manager.start()
-        while not self.manager.is_ready():
-            from time import sleep
-            sleep(0.1)
-
-    def _upload_data(self, name,data):
-        from requests import post
-        header = {
-            'Accept' : 'application/json',
-            'Content-Type':'application/json'
-        }
-        import json
+        def get_ready_status():
+            return "ready"
+        self.app.add_url_rule("/readystatus", "get_ready_status", get_ready_status, methods=["GET"])
 
+        # the socket is listening as soon as the server is created
         try:
-            r = post(
-                f'http://0.0.0.0:{self.port}/configuration?name={name}',
-                headers=header,
-                data=json.dumps(data)
-            )
-        except Exception as e:
-            raise ConfigUploadFailed(name) from e
-
-        if not r.json()['success']:
-            raise ConfigUploadFailed(name)
+            from waitress import create_server
+            self.server = create_server(self.app, host="0.0.0.0", port=self.port, threads=self.threads)
+            serve = self.server.run
+            server_name = 'waitress'
+        except ImportError:
+            from werkzeug.serving import make_server
+            self.server = make_server("0.0.0.0", self.port, self.app, threaded=True)
+            serve = self.server.serve_forever
+            server_name = 'werkzeug'
+
+        self.server_thread = threading.Thread(target=serve, name='nano-conf-svc', daemon=True)
+        self.server_thread.start()
+        self.log.info(f'nano-conf-svc listening on port {self.port} ({server_name})')
+
+    def _store_data(self, name, data):
+        # serialize once here, rather than on every request
+        # the request handlers read the stores, adding a key to them is atomic
+        self.serialized_data[name] = SerializedConfiguration(data)
+        self.config_data[name] = data
 
 
     def add_configuration_data(self, name, data):
         from nanorc.argval import validate_conf_name
         validate_conf_name({}, {}, name)
 
-        if name in self.uploaded_name:
-            raise ConfigurationAlreadyPresent(name)
-
-        self._upload_data(name, data)
-        self.uploaded_name.add(name)
+        with self.uploaded_name_lock:
+            if name in self.uploaded_name:
+                raise ConfigurationAlreadyPresent(name)
+            self.uploaded_name.add(name)
+            self._store_data(name, data)
 
     def update_configuration_data(self, name, data):
         from nanorc.argval import validate_conf_name
         validate_conf_name({}, {}, name)
 
-        if not name in self.uploaded_name:
-            raise ConfigurationNotPresent(name)
-
-        self._upload_data(name, data)
+        with self.uploaded_name_lock:
+            if not name in self.uploaded_name:
+                raise ConfigurationNotPresent(name)
+            self._store_data(name, data)
 
     def update_configuration_directory(self, name, path):
         from pathlib import Path
@@ -172,4 +297,16 @@ class ConfServer:
 
         return
     def terminate(self):
-        self.manager.stop()
+        if self.server:
+            if hasattr(self.server, 'shutdown'): # werkzeug
+                self.server.shutdown()
+                self.server.server_close()
+                self.server_thread.join(timeout=10)
+            else: # waitress
+                self.server.close()
+                # its loop keeps running while (keep-alive) connections are open, it's a daemon thread,
+                # don't wait for it more than that (it lets go of the listening socket within a second)
+                self.server_thread.join(timeout=0.1)
+                if self.server_thread.is_alive():
+                    self.log.debug('nano-conf-svc still has open connections, not waiting for them')
+            self.server = None
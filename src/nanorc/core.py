@@ -93,6 +93,7 @@ class NanoRC:
         if self.cfgsvr:
             self.cfgsvr.cfgmgr = self.cfg
             self.cfgsvr.apparatus_id = self.apparatus_id
+            self.cfgsvr.on_failure = self._archival_failed
         self.timeout = timeout
         self.return_code = None
         self.logbook = None
@@ -100,7 +101,12 @@ class NanoRC:
 
         if logbook_type != 'file':
             try:
-                self.logbook = ElisaHandler(socket = logbook_type['socket'], session_handler = self.session_handler)
+                self.logbook = ElisaHandler(
+                    socket = logbook_type['socket'],
+                    session_handler = self.session_handler,
+                    session = partition_label,
+                    port_offset = port_offset,
+                )
             except Exception as e:
                 self.log.error(f"Couldn't initialise ELisA, reverting to file logbook! {str(e)}")
                 logbook_type = 'file'
@@ -114,6 +120,16 @@ class NanoRC:
 
     def quit(self):
         self.cfg.terminate()
+        if self.cfgsvr:
+            # what isn't archived by then stays in the spool, and is retried at the next start
+            self.cfgsvr.stop(timeout=30)
+        if self.logbook:
+            self.logbook.flush(timeout=30)
+
+    def _archival_failed(self, run:int, error:str):
+        # called from the archiver thread, once all the attempts failed
+        from rich.markup import escape
+        self.console.print(f'[bold red]Run {run}: {escape(error)}[/bold red]', highlight=False)
 
     def get_command_sequence(self, command:str):
         seq_cmd = self.topnode.fsm.command_sequences.get(command)
@@ -266,6 +282,51 @@ class NanoRC:
         self.return_code = print_node(node=self.topnode, console=self.console, leg=leg)
 
 
+    def config_report(self, node_path=None, diff:bool=False) -> NoReturn:
+        """
+        Print what nanorc changed in the configurations when loading them
+        """
+        from anytree import PreOrderIter
+        from .node import SubsystemNode
+
+        for node in PreOrderIter(node_path if node_path else self.topnode):
+            if not isinstance(node, SubsystemNode):
+                continue
+
+            report = node.cfgmgr.report
+            self.console.print(f'[bold]{node.name}[/bold]')
+            for title, keys in report.summary().items():
+                self.console.print(f'  {title}: {len(keys)} keys touched')
+                if diff:
+                    self.console.print(json.dumps(report.diff(title), indent=4), markup=False, highlight=False)
+                else:
+                    for key in keys:
+                        self.console.print(f'    {key}', markup=False, highlight=False)
+
+
+    def archival_status(self, run:int=None) -> NoReturn:
+        """
+        Print whether the configurations of the runs were archived
+        """
+        if not self.cfgsvr:
+            self.console.print('No run registry')
+            return
+
+        table = Table(title='Run configuration archival')
+        table.add_column('Run')
+        table.add_column('Job')
+        table.add_column('Status')
+        table.add_column('Attempts')
+        table.add_column('Details')
+        for _, status in sorted(self.cfgsvr.status(run).items()):
+            details = status.get('error', '')
+            if status.get('duration') is not None:
+                details = f'{status["duration"]:.2f}s'
+            style = {'done': 'green', 'failed': 'bold red'}.get(status['status'], 'yellow')
+            table.add_row(str(status['run']), status['kind'], f'[{style}]{status["status"]}[/{style}]', str(status.get('attempt', '')), details)
+        self.console.print(table)
+
+
     def boot(self, timeout:int) -> NoReturn:
         """
         Boot applications
@@ -330,22 +391,9 @@ class NanoRC:
             self.return_code = self.topnode.return_code
             return
 
-        run = 0
         if self.run_num_mgr:
-            run = self.run_num_mgr.get_run_number()
-        else:
-            run = 1
-
-        stparam = {
-            "run":run,
-            "disable_data_storage":disable_data_storage,
-            "production_vs_test":run_type
-        }
-
-        if not trigger_rate is None:
-            stparam['trigger_rate'] = trigger_rate
-
-        runtime_start_data = rccmd.StartParams(**stparam).pod() # EnFoRcE tHiS sChEmA aNd DiTcH iT
+            # the run number db is asked while the rest of the start is prepared
+            self.run_num_mgr.request_run_number()
 
         messages = []
         if message != "":
@@ -363,6 +411,23 @@ class NanoRC:
 
         messages += [config_pretty]
 
+        run = 0
+        if self.run_num_mgr:
+            run = self.run_num_mgr.get_run_number()
+        else:
+            run = 1
+
+        stparam = {
+            "run":run,
+            "disable_data_storage":disable_data_storage,
+            "production_vs_test":run_type
+        }
+
+        if not trigger_rate is None:
+            stparam['trigger_rate'] = trigger_rate
+
+        runtime_start_data = rccmd.StartParams(**stparam).pod() # EnFoRcE tHiS sChEmA aNd DiTcH iT
+
         if message != '' and run_type.lower() != 'prod':
             self.log.warning('Your message will NOT be stored, as this is not a PROD run')
 
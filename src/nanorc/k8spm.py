@@ -7,10 +7,13 @@ import time
 import json
 import copy as cp
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from kubernetes import client, config
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
 from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn, track
+from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn
 from rich.table import Table
 
 from datetime import datetime
@@ -22,15 +25,117 @@ class AppProcessDescriptor(object):
         super(AppProcessDescriptor, self).__init__()
         self.name = name
         self.host = None
-        self.node = None
+        self._node = None
         self.conf = None
         self.port = None
         self.proc = None
-
+        self.creation_time = None
+
+    @property
+    def node(self):
+        # the node is only known once the pod is scheduled
+        if self._node is None and self.proc is not None:
+            node = self.proc.node()
+            if node != 'unknown':
+                self._node = node
+            return node
+        return self._node
+
+    @node.setter
+    def node(self, value):
+        self._node = value
 
     def __str__(self):
         return str(vars(self))
 
+class PodInformer(threading.Thread):
+    '''
+    Keeps an in-memory copy of the pods of a namespace up to date, with a single watch stream.
+    '''
+
+    def __init__(self, core_v1_api, namespace:str, watch_timeout:int=5):
+        super().__init__(name=f'pod-informer-{namespace}', daemon=True)
+        self.log = logging.getLogger(__name__)
+        self.core_v1_api = core_v1_api
+        self.namespace = namespace
+        self.watch_timeout = watch_timeout
+        self.pods = {}
+        self.resource_version = None
+        self.changed = threading.Condition()
+        self.synced = threading.Event()
+        self.stop_event = threading.Event()
+        self.watch = None
+
+    def _update(self, pods:dict=None, name:str=None, pod=None, deleted:bool=False):
+        with self.changed:
+            if pods is not None:
+                self.pods = pods
+            elif deleted:
+                self.pods.pop(name, None)
+            else:
+                self.pods[name] = pod
+            self.changed.notify_all()
+
+    def _list(self):
+        ret = self.core_v1_api.list_namespaced_pod(self.namespace)
+        self.resource_version = ret.metadata.resource_version
+        self._update(pods={p.metadata.name: p for p in ret.items})
+        self.synced.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.resource_version is None:
+                    self._list()
+
+                self.watch = watch.Watch()
+                for event in self.watch.stream(
+                        self.core_v1_api.list_namespaced_pod,
+                        self.namespace,
+                        resource_version = self.resource_version,
+                        timeout_seconds = self.watch_timeout):
+                    if self.stop_event.is_set():
+                        break
+                    if event['type'] == 'ERROR':
+                        # most likely the resource version is too old, list everything again
+                        self.resource_version = None
+                        break
+                    pod = event['object']
+                    self.resource_version = pod.metadata.resource_version
+                    self._update(name=pod.metadata.name, pod=pod, deleted=(event['type'] == 'DELETED'))
+
+            except ApiException as e:
+                if e.status == 410:
+                    self.resource_version = None
+                    continue
+                self.log.debug(f'Pod watch on {self.namespace} failed: {str(e)}')
+                self.resource_version = None
+                self.stop_event.wait(1)
+            except Exception as e:
+                self.log.debug(f'Pod watch on {self.namespace} failed: {str(e)}')
+                self.resource_version = None
+                self.stop_event.wait(1)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.watch:
+            self.watch.stop()
+        with self.changed:
+            self.changed.notify_all()
+
+    def get(self, name:str):
+        with self.changed:
+            return self.pods.get(name)
+
+    def list(self) -> list:
+        with self.changed:
+            return list(self.pods.values())
+
+    def wait_for_change(self, timeout:float):
+        with self.changed:
+            self.changed.wait(timeout)
+
+
 class K8sProcess(object):
 
     def __init__(self, pm, name, namespace):
@@ -40,7 +145,7 @@ class K8sProcess(object):
 
     def is_alive(self):
         try:
-            s = self.pm._core_v1_api.read_namespaced_pod_status(self.name, self.namespace)
+            s = self.pm.get_pod(self.name, self.namespace)
             for cond in s.status.conditions:
                 if cond.type == "Ready" and cond.status == "True":
                     return True
@@ -48,9 +153,12 @@ class K8sProcess(object):
         except:
             return False
 
+    def node(self):
+        return self.pm.get_pod_node(self.name, self.namespace)
+
     def status(self):
         try:
-            s = self.pm._core_v1_api.read_namespaced_pod_status(self.name, self.namespace)
+            s = self.pm.get_pod(self.name, self.namespace)
             container_status = s.status.container_statuses[0].state
             if   container_status.running:
                 return "Running"
@@ -81,6 +189,14 @@ class K8SProcessManager(object):
         self.apps = {}
         self.partition = None
         self.cluster_config = cluster_config
+        self.script_timeout = 60
+        self.max_script_workers = 16
+        self.informer = None
+        self.max_create_workers = getattr(cluster_config, 'max_create_workers', 16)
+        self.server_side_apply = getattr(cluster_config, 'server_side_apply', False)
+        self.field_manager = 'nanorc'
+        self.fast_terminate = getattr(cluster_config, 'fast_terminate', False)
+        self.namespace_timeout = 60
 
         config.load_kube_config()
 
@@ -123,30 +239,24 @@ class K8SProcessManager(object):
         cmd += "; ".join(script_data['cmd'])
         pretty_print += "; ".join(script_data['cmd'])
 
-        pods = self.list_pods(self.partition)
-        hosts = set([self.get_pod_node(pod.metadata.name, self.partition) for pod in pods.items])
-
-        for host in hosts:
-            self.console.print(f'Executing {script_data["cmd"]} script on \'{host}\':\n[bright_black]{pretty_print}[/]')
-            ssh_args = [host, "-tt", "-o StrictHostKeyChecking=no"] + [cmd]
-            import sh
-            from sh import ErrorReturnCode
-            try:
-                import os
-                host_env = os.environ
-                ssh_env = {'KRB5CCNAME': host_env['KRB5CCNAME'] } if 'KRB5CCNAME' in host_env else {}
-                ssh_cmd  = sh.Command('/usr/bin/ssh')
-                proc = ssh_cmd(ssh_args, _env=ssh_env)
-            except ErrorReturnCode as e:
-                self.log.error(
-                    e.stdout.decode('ascii')
-                )
-                continue
-            except Exception as e:
-                self.log.critical(
-                    str(e)
-                )
-            self.log.debug(proc)
+        pods = self.informer.list() if self.informer else self.list_pods(self.partition).items
+        hosts = sorted(set([pod.spec.node_name for pod in pods if pod.spec.node_name]))
+
+        self.console.print(f'Executing {script_data["cmd"]} script on {", ".join(hosts)}:\n[bright_black]{pretty_print}[/]')
+        import sh
+        from nanorc.utils import execute_script_on_hosts, log_script_results
+        host_env = os.environ
+        results = execute_script_on_hosts(
+            ssh_cmd = sh.Command('/usr/bin/ssh'),
+            hosts = hosts,
+            ssh_args = lambda host: [host, "-tt", "-o StrictHostKeyChecking=no"],
+            cmd = cmd,
+            ssh_env = {'KRB5CCNAME': host_env['KRB5CCNAME'] } if 'KRB5CCNAME' in host_env else {},
+            timeout = self.script_timeout,
+            max_workers = self.max_script_workers,
+        )
+        log_script_results(self.log, script_data["cmd"], results)
+        return results
 
 
 
@@ -164,9 +274,62 @@ class K8SProcessManager(object):
         return ret
 
     # ----
+    def read_namespace(self, namespace: str):
+        '''
+        The namespace, or None if it doesn't exist
+        '''
+        try:
+            return self._core_v1_api.read_namespace(namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def wait_for_namespace_deletion(self, namespace: str, timeout: float) -> bool:
+        '''
+        Returns as soon as the namespace is deleted (True), or when the timeout expires (False)
+        '''
+        ns = self.read_namespace(namespace)
+        if ns is None:
+            return True
+
+        resource_version = ns.metadata.resource_version
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            w = watch.Watch()
+            try:
+                for event in w.stream(
+                        self._core_v1_api.list_namespace,
+                        field_selector = f'metadata.name={namespace}',
+                        resource_version = resource_version,
+                        timeout_seconds = max(1, int(deadline - time.monotonic()))):
+                    if event['type'] == 'DELETED':
+                        w.stop()
+                        return True
+                    if event['type'] == 'ERROR':
+                        break
+                    resource_version = event['object'].metadata.resource_version
+            except ApiException as e:
+                self.log.debug(f'Namespace watch failed: {str(e)}')
+                time.sleep(min(1, max(0, deadline - time.monotonic())))
+
+            # the watch expired or failed, we may have missed the deletion
+            ns = self.read_namespace(namespace)
+            if ns is None:
+                return True
+            resource_version = ns.metadata.resource_version
+
+        return False
+
     def create_namespace(self, namespace : str):
-        nslist = [ns.metadata.name for ns in self._core_v1_api.list_namespace().items]
-        if namespace in nslist:
+        ns = self.read_namespace(namespace)
+        if ns is not None and ns.status.phase == 'Terminating':
+            self.log.info(f"The \"{namespace}\" namespace is still being deleted, waiting")
+            if not self.wait_for_namespace_deletion(namespace, self.namespace_timeout):
+                raise RuntimeError(f"The \"{namespace}\" namespace is still being deleted")
+            ns = None
+
+        if ns is not None:
             self.log.debug(f"Not creating \"{namespace}\" namespace as it already exist")
             self.log.info(f"Try `kubectl get pods -n {namespace}' and see if there is anything running")
             self.log.info(f"If you are sure nothing is running and want to use same session name `kubectl delete ns {namespace}' before starting your next run")
@@ -202,25 +365,56 @@ class K8SProcessManager(object):
 
     # ----
     def delete_namespace(self, namespace: str):
-        nslist = [ns.metadata.name for ns in self._core_v1_api.list_namespace().items]
-        if not namespace in nslist:
-            self.log.info(f"The \"{namespace}\" namespace has already been deleted")
-            return
         self.log.info(f"Deleting \"{namespace}\" namespace")
         try:
             #
             resp = self._core_v1_api.delete_namespace(
                 name=namespace
             )
+        except ApiException as e:
+            if e.status == 404:
+                self.log.info(f"The \"{namespace}\" namespace has already been deleted")
+                return
+            self.log.error(e)
+            raise RuntimeError(f"Failed to delete namespace \"{namespace}\"") from e
         except Exception as e:
             self.log.error(e)
             raise RuntimeError(f"Failed to delete namespace \"{namespace}\"") from e
 
+    def start_informer(self, namespace: str):
+        self.stop_informer()
+        self.informer = PodInformer(self._core_v1_api, namespace)
+        self.informer.start()
+
+    def stop_informer(self):
+        if self.informer:
+            self.informer.stop()
+            # the watch only ends with its timeout, with fast_terminate the (daemon) thread is left to finish on its own
+            if not self.fast_terminate:
+                self.informer.join(timeout=self.informer.watch_timeout+1)
+            self.informer = None
+
+    def get_pod(self, pod_name, namespace):
+        '''
+        The pod, from the informer cache if there is one for this namespace
+        '''
+        if self.informer and self.informer.namespace == namespace and self.informer.synced.is_set():
+            return self.informer.get(pod_name)
+        try:
+            return self._core_v1_api.read_namespaced_pod_status(pod_name, namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
     def get_pod_node(self, pod_name, partition):
-        pod_list = self._core_v1_api.list_namespaced_pod(partition)
-        for pod in pod_list.items:
-            if pod.metadata.name == pod_name:
-                return pod.spec.node_name
+        try:
+            pod = self.get_pod(pod_name, partition)
+        except Exception as e:
+            self.log.debug(f'Couldn\'t get the pod {pod_name}: {str(e)}')
+            return 'unknown'
+        if pod and pod.spec.node_name:
+            return pod.spec.node_name
         return 'unknown'
 
     def get_container_port_list_from_connections(self, app_name:str, connections:list=None, cmd_port:int=3333):
@@ -383,13 +577,16 @@ class K8SProcessManager(object):
             )
 
     # ----
-    def create_daqapp_pod(
+    def build_daqapp_pod(
             self,
             name: str,
             app_label: str,
             app_boot_info:dict,
             namespace: str,
             run_as: dict = None):
+        '''
+        Returns the pod and service objects of a DAQ application
+        '''
 
         info_str  = f"Creating \"{namespace}:{name}\" DAQ App"
         debug_str = f"image: \"{app_boot_info['image']}\""
@@ -411,6 +608,8 @@ class K8SProcessManager(object):
         ## Need to mount /dev and be privileged in this case...
 
         pod = client.V1Pod(
+            api_version = 'v1',
+            kind = 'Pod',
             # Run the pod with same user id and group id as the current user
             # Required in kind environment to create non-root files in shared folders
             metadata = client.V1ObjectMeta(
@@ -490,18 +689,9 @@ class K8SProcessManager(object):
 
         self.log.debug(pod)
 
-        # Creation of the pod in specified namespace
-        try:
-            #
-            resp = self._core_v1_api.create_namespaced_pod (
-                namespace = namespace,
-                body = pod
-            )
-        except Exception as e:
-            self.log.error(e)
-            raise RuntimeError(f"Failed to create daqapp pod \"{namespace}:{name}\"") from e
-
         service = client.V1Service(
+            api_version = 'v1',
+            kind = 'Service',
             metadata = client.V1ObjectMeta(name=name),
             spec = client.V1ServiceSpec(
                 ports = self.get_service_port_list_from_connections(app_name=name, connections=app_boot_info['connections'], cmd_port=app_boot_info['cmd_port']),
@@ -509,13 +699,74 @@ class K8SProcessManager(object):
             )
         )  # V1Service
         #self.log.debug(service)
+        return pod, service
+
+    def apply(self, create, patch, name:str, namespace:str, body):
+        '''
+        Create the object, or server-side apply it if server_side_apply is set
+        '''
+        if not self.server_side_apply:
+            return create(namespace=namespace, body=body)
+
+        return patch(
+            name = name,
+            namespace = namespace,
+            body = self._core_v1_api.api_client.sanitize_for_serialization(body),
+            field_manager = self.field_manager,
+            force = True,
+            _content_type = 'application/apply-patch+yaml',
+        )
+
+    def submit_daqapp_pod(self, name:str, namespace:str, pod, service) -> float:
+        '''
+        Send the pod and the service of a DAQ application to the cluster, returns the time it took
+        '''
+        start = time.perf_counter()
 
+        # Creation of the pod in specified namespace
         try:
-            resp = self._core_v1_api.create_namespaced_service(namespace, service)
+            self.apply(self._core_v1_api.create_namespaced_pod, self._core_v1_api.patch_namespaced_pod, name, namespace, pod)
+        except Exception as e:
+            self.log.error(e)
+            raise RuntimeError(f"Failed to create daqapp pod \"{namespace}:{name}\"") from e
+
+        try:
+            self.apply(self._core_v1_api.create_namespaced_service, self._core_v1_api.patch_namespaced_service, name, namespace, service)
         except Exception as e:
             self.log.error(e)
             raise RuntimeError(f"Failed to create daqapp service \"{namespace}:{name}\"") from e
 
+        return time.perf_counter() - start
+
+    def create_daqapp_pod(
+            self,
+            name: str,
+            app_label: str,
+            app_boot_info:dict,
+            namespace: str,
+            run_as: dict = None):
+
+        pod, service = self.build_daqapp_pod(name, app_label, app_boot_info, namespace, run_as)
+        return self.submit_daqapp_pod(name, namespace, pod, service)
+
+    def submit_daqapp_pods(self, namespace:str, objects:dict) -> dict:
+        '''
+        Send the pods and services of the DAQ applications concurrently (at most max_create_workers at a time).
+        objects is app name -> (pod, service), returns app name -> time it took
+        '''
+        if not objects:
+            return {}
+
+        n_workers = max(1, min(self.max_create_workers, len(objects)))
+        with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='k8s-create') as executor:
+            futures = {
+                name: executor.submit(self.submit_daqapp_pod, name, namespace, pod, service)
+                for name, (pod, service) in objects.items()
+            }
+
+        # raise the first error, in the boot order
+        return {name: future.result() for name, future in futures.items()}
+
     # ----
     def create_egress_endpoint(self, name: str, namespace: str, ip: str, port: int):
 
@@ -656,7 +907,7 @@ class K8SProcessManager(object):
 
 
     #---
-    def boot(self, boot_info, timeout, conf_loc, **kwargs):
+    def boot(self, boot_info, timeout, conf_loc, show_progress=True, **kwargs):
 
         if self.apps:
             raise RuntimeError(
@@ -730,6 +981,7 @@ class K8SProcessManager(object):
 
         # Create partition
         self.create_namespace(self.partition)
+        self.start_informer(self.partition)
 
         run_as = {
             'uid': os.getuid(),
@@ -747,6 +999,7 @@ class K8SProcessManager(object):
             physical_location = log_dir
         )]
 
+        objects = {}
         for app_name in boot_info['order']:
             app_conf = apps[app_name]
             cmd_port = app_conf['port']
@@ -863,7 +1116,7 @@ class K8SProcessManager(object):
 
             k8s_name = app_name#.replace("_", "-").replace(".", "")
 
-            self.create_daqapp_pod(
+            objects[k8s_name] = self.build_daqapp_pod(
                 name = k8s_name, # better kwargs all this...
                 app_label = k8s_name,
                 app_boot_info = app_boot_info,
@@ -871,10 +1124,15 @@ class K8SProcessManager(object):
                 run_as = run_as
             )
 
-            app_desc.node = self.get_pod_node(k8s_name, self.partition)
-
             self.apps[app_name] = app_desc
 
+        start = time.perf_counter()
+        creation_times = self.submit_daqapp_pods(self.partition, objects)
+        for app_name, creation_time in creation_times.items():
+            self.apps[app_name].creation_time = creation_time
+            self.log.debug(f'{app_name} pod and service created in {creation_time:.3f}s')
+        self.log.info(f'{len(objects)} pods and services created in {time.perf_counter()-start:.2f}s')
+
         def rdm_string(N:int=5):
             import string
             import random
@@ -908,6 +1166,7 @@ class K8SProcessManager(object):
             TimeRemainingColumn(),
             TimeElapsedColumn(),
             console=self.console,
+            disable=not show_progress,
         ) as progress:
             total = progress.add_task("[yellow]# apps started", total=len(self.apps))
             apps_tasks = {
@@ -915,14 +1174,19 @@ class K8SProcessManager(object):
             }
             waiting = progress.add_task("[yellow]timeout", total=timeout)
 
-            for _ in range(timeout):
-                progress.update(waiting, advance=1)
+            start = time.monotonic()
+            while True:
+                elapsed = time.monotonic() - start
+                progress.update(waiting, completed=elapsed)
 
                 ready = self.check_apps()
                 for a, t in apps_tasks.items():
                     if a in ready:
                         progress.update(t, completed=1)
                         self.apps[a].pod = ready[a]
+                        node = self.get_pod_node(ready[a], self.partition)
+                        if node != 'unknown':
+                            self.apps[a].node = node
                 progress.update(total, completed=len(ready))
                 r = list(ready.keys())
                 a = list(self.apps.keys())
@@ -932,14 +1196,22 @@ class K8SProcessManager(object):
                     progress.update(waiting, visible=False)
                     break
 
-                time.sleep(1)
+                if elapsed >= timeout:
+                    break
+
+                # wake up as soon as a pod changes
+                if self.informer:
+                    self.informer.wait_for_change(min(1, timeout-elapsed))
+                else:
+                    time.sleep(1)
 
 
 
     # ---
     def check_apps(self):
         ready = {}
-        for p in self._core_v1_api.list_namespaced_pod(self.partition).items:
+        pods = self.informer.list() if self.informer else self.list_pods(self.partition).items
+        for p in pods:
             for name in self.apps.keys():
                 if name in p.metadata.name and p.status.phase == "Running":
                     ready[name]=p.metadata.name
@@ -948,23 +1220,18 @@ class K8SProcessManager(object):
     # ---
     def terminate(self):
 
-        timeout = 60
+        self.stop_informer()
         if self.partition:
             self.delete_namespace(self.partition)
 
-            for _ in track(range(timeout), description="Terminating namespace..."):
-
-                s = self._core_v1_api.list_namespace()
-                found = False
-                for namespace in s.items:
-                    if namespace.metadata.name == self.partition:
-                        found = True
-                        break
-                if not found:
-                    return
-                time.sleep(1)
+            if self.fast_terminate:
+                # the next boot waits for the deletion if needed
+                self.log.info(f"Not waiting for the \"{self.partition}\" namespace to be deleted")
+                return
 
-            logging.warning('Timeout expired!')
+            self.log.info("Terminating namespace...")
+            if not self.wait_for_namespace_deletion(self.partition, self.namespace_timeout):
+                self.log.warning('Timeout expired!')
 
 
 # ---
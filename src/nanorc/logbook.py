@@ -9,8 +9,11 @@ import os.path
 import subprocess
 import copy
 import time
+import json
+import uuid
 import requests
 from .credmgr import credentials
+from .archiver import ArchivalQueue, JobDeferred, get_spool_dir
 
 class FileLogbook:
     def __init__(self, path:str, console):
@@ -46,10 +49,20 @@ class FileLogbook:
         f.write(f'{self.now()}: {messages}\n')
         f.close()
 
+    def flush(self, timeout:float=None) -> bool:
+        '''
+        Nothing to do, the messages are written to the file straight away (same interface as ElisaHandler)
+        '''
+        return True
+
 
 
 class ElisaHandler:
-    def __init__(self, socket, session_handler):
+    '''
+    The messages are sent by a background thread, in order, through an on-disk outbox (see ArchivalQueue),
+    so a slow or unreachable ELisA doesn't stall the run control.
+    '''
+    def __init__(self, socket, session_handler, session:str=None, port_offset:int=0):
         self.socket = socket
         self.session_handler = session_handler
         self.log = logging.getLogger(self.__class__.__name__)
@@ -57,10 +70,68 @@ class ElisaHandler:
         auth = credentials.get_login("elisa_logbook")
         self.API_USER=auth.username
         self.API_PSWD=auth.password
+        self.timeout = 10
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # The messages of a run are replies to its first message, but its ELisA id is only known
+        # once the outbox has sent it. So each logbook thread gets a local key, and the outbox
+        # worker remembers which ELisA id it corresponds to (on disk next to the spooled messages,
+        # the outbox and this map belong to the session, see ArchivalQueue).
+        self.thread_ids = {}
+        self.max_thread_ids = 100
+        self.current_run_num = None
+        self.current_run_type = None
+        self.current_thread = uuid.uuid4().hex
+        self.current_thread_started = False
+
+        self.outbox = ArchivalQueue(
+            'elisa', self._process,
+            spool_dir = get_spool_dir('elisa', session, port_offset),
+            max_retries = 8,
+            retry_delay = 1.,
+            on_adopt = self._adopt_thread_ids,
+        )
+        self.spool_dir = self.outbox.spool_dir
+        self.thread_ids_file = self.spool_dir/'elisa_threads.json'
+        self.thread_ids = {**self._load_thread_ids(self.thread_ids_file), **self.thread_ids}
+        self._save_thread_ids()
+        self.outbox.start()
+
+    @property
+    def current_id(self):
+        return self.thread_ids.get(self.current_thread)
+
+    def _load_thread_ids(self, path) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _adopt_thread_ids(self, orphan_dir):
+        # the messages of a nanorc which is gone are taken over, with the ids of their threads
+        self.thread_ids.update(self._load_thread_ids(orphan_dir/'elisa_threads.json'))
+
+    def _save_thread_ids(self):
+        # only the last threads can still have messages in the outbox
+        keys = list(self.thread_ids.keys())[-self.max_thread_ids:]
+        self.thread_ids = {k: self.thread_ids[k] for k in keys}
+        try:
+            tmp_path = self.thread_ids_file.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.thread_ids, f)
+            os.replace(tmp_path, self.thread_ids_file)
+        except Exception as e:
+            self.log.debug(f'Couldn\'t save the ELisA thread ids: {str(e)}')
 
     def _start_new_message_thread(self):
         self.log.info("ELisA logbook: Next message will be a new thread")
-        self.current_id = None
+        self.current_thread = uuid.uuid4().hex
+        self.current_thread_started = False
         self.current_run = None
         self.current_run_type = None
 
@@ -68,34 +139,51 @@ class ElisaHandler:
     def _send_message(self, subject:str, body:str, command:str):
         user = self.session_handler.nanorc_user.username
         data = {'author':user, 'title':subject, 'body':body, 'command':command, 'systems':["daq"]}
+        self.outbox.submit({
+            'kind': f'logbook_{command}',
+            'run': self.current_run_num,
+            'thread': self.current_thread,
+            'new_thread': not self.current_thread_started,
+            'data': data,
+        })
+        self.current_thread_started = True
+
+    def _process(self, job:dict):
+        data = dict(job['data'])
+        thread_id = self.thread_ids.get(job['thread'])
+        if not thread_id and not job['new_thread']:
+            # the first message of the thread couldn't be sent, keep its replies behind it
+            raise JobDeferred('the first message of its thread wasn\'t sent yet')
         try:
-            if not self.current_id:
-                r = requests.post(f'{self.socket}/v1/elisaLogbook/new_message/', auth=(self.API_USER, self.API_PSWD), json=data)
+            if not thread_id:
+                r = self.session.post(f'{self.socket}/v1/elisaLogbook/new_message/', auth=(self.API_USER, self.API_PSWD), json=data, timeout=self.timeout)
             else:
-                data["id"] = self.current_id
-                r = requests.put(f'{self.socket}/v1/elisaLogbook/reply_to_message/', auth=(self.API_USER, self.API_PSWD), json=data)
+                data["id"] = thread_id
+                r = self.session.put(f'{self.socket}/v1/elisaLogbook/reply_to_message/', auth=(self.API_USER, self.API_PSWD), json=data, timeout=self.timeout)
             r.raise_for_status()
-            response = r.json()
-            if r.status_code != 201:
-                self.log.error(f'Exception thrown while inserting data in elisa:')
-                e = (response['response'])
-                self.log.error(e)
-                import logging
-                if logging.DEBUG >= logging.root.level:
-                    self.console.print_exception()
-                raise e
-            else:
-                self.current_id = response['thread_id']
-                self.log.info(f"ELisA logbook: Sent message (ID{self.current_id})")
         except requests.HTTPError as exc:
-            error = f"of HTTP Error (maybe failed auth, maybe ill-formed post message, ...)"
-            self.log.error(error)
+            raise RuntimeError(f"ELisA logbook: HTTP Error (maybe failed auth, maybe ill-formed post message, ...): {exc}") from exc
         except requests.ConnectionError as exc:
-            error = f"connection to {self.API_SOCKET} wasn't successful"
-            self.log.error(error)
+            raise RuntimeError(f"ELisA logbook: connection to {self.socket} wasn't successful") from exc
         except requests.Timeout as exc:
-            error = f"connection to {self.API_SOCKET} timed out"
-            self.log.error(error)
+            raise RuntimeError(f"ELisA logbook: connection to {self.socket} timed out") from exc
+
+        response = r.json()
+        if r.status_code != 201:
+            raise RuntimeError(f'ELisA logbook: exception thrown while inserting data in elisa: {response["response"]}')
+
+        self.thread_ids[job['thread']] = response['thread_id']
+        self._save_thread_ids()
+        self.log.info(f"ELisA logbook: Sent message (ID{response['thread_id']})")
+
+    def flush(self, timeout:float=None) -> bool:
+        '''
+        Wait for the outbox to be empty, returns whether it is
+        '''
+        if not self.outbox.flush(timeout):
+            self.log.warning(f'ELisA logbook: {self.outbox.queue.unfinished_tasks} messages weren\'t sent yet, they will be at the next start')
+            return False
+        return True
 
     def message_on_start(self, messages:[str], session:str, run_num:int, run_type:str):
         self._start_new_message_thread()
@@ -10,8 +10,10 @@ from rich.text import Text
 from rich.panel import Panel
 import copy as cp
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .pmdesc import PMFactory
-from .appctrl import AppSupervisor, ResponseListener, ResponseTimeout, NoResponse
+from .appctrl import AppSupervisor, ResponseListener, ResponseTimeout, NoResponse, AppHealthMonitor, AppHealthCache
 from typing import Union, NoReturn
 from .fsm import FSM
 import os.path
@@ -63,6 +65,10 @@ class SubsystemNode(StatefulNode):
         self.pm = None
         self.pm_task_enqueuer = None
         self.listener = None
+        self.max_command_fanout = 64
+        self.health_check_interval = 1.
+        self.health_cache = None
+        self.health_cache_ttl = 1.
 
     def can_execute_custom_or_expert(self, command, quiet=False, check_dead=True, check_inerror=True, check_children=True, only_included=True):
         ret = super().can_execute_custom_or_expert(
@@ -80,7 +86,7 @@ class SubsystemNode(StatefulNode):
             for c in self.children:
                 if not c.included and only_included: continue
 
-                if check_dead and not (c.sup.desc.proc.is_alive() and c.sup.commander.ping()):
+                if check_dead and not c.sup.is_healthy():
                     self.return_code = ErrorCode.Failed
                     self.log.error(f'{c.name} is dead, cannot send {command}')
                     return CanExecuteReturnVal.Dead
@@ -105,7 +111,7 @@ class SubsystemNode(StatefulNode):
             for c in self.children:
                 if not c.included and only_included: continue
 
-                if check_dead and not (c.sup.desc.proc.is_alive() and c.sup.commander.ping()):
+                if check_dead and not c.sup.is_healthy():
                     self.return_code = ErrorCode.Failed
                     self.log.error(f'{c.name} is dead, cannot send {command} unless you disable it or --force')
                     return CanExecuteReturnVal.Dead
@@ -115,9 +121,9 @@ class SubsystemNode(StatefulNode):
 
     def send_custom_command(self, cmd, data, timeout, app=None) -> dict:
         ret = {}
-        if not self.listener.flask_manager.is_alive():
+        if not self.listener.is_alive():
             self.log.error('Response listener is not alive, trying to respawn it!!')
-            self.listener.flask_manager = self.listener.create_manager()
+            self.listener.restart()
 
         if cmd == 'scripts': # unfortunately I don't see how else to do this
             scripts = self.cfgmgr.boot.get('scripts')
@@ -163,7 +169,7 @@ class SubsystemNode(StatefulNode):
                     else:
                         if not is_include_exclude and not c.included: continue
 
-                    if not (c.sup.desc.proc.is_alive() and c.sup.commander.ping()):
+                    if not c.sup.is_healthy():
                         self.log.error(f'{c.name} is dead, cannot send {cmd} to the app')
                         continue
 
@@ -180,7 +186,7 @@ class SubsystemNode(StatefulNode):
                 else:
                     if not is_include_exclude and not c.included: continue
 
-                if not (c.sup.desc.proc.is_alive() and c.sup.commander.ping()):
+                if not c.sup.is_healthy():
                     self.log.error(f'{c.name} is dead, cannot send {cmd} to the app')
                     continue
                 cmd_data = {
@@ -190,12 +196,15 @@ class SubsystemNode(StatefulNode):
                     }]
                 }
                 ret[c.name] = c.sup.send_command_and_wait(cmd, cmd_data=cmd_data, timeout=timeout)
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f'{self.name} command connections: {self.connection_stats()[self.name]}')
         return ret
 
     def send_expert_command(self, app, cmd, timeout) -> dict:
-        if not self.listener.flask_manager.is_alive():
+        if not self.listener.is_alive():
             self.log.error('Response listener is not alive, trying to respawn it!!')
-            self.listener.flask_manager = self.listener.create_manager()
+            self.listener.restart()
 
         cmd_name = cmd['id']
         cmd_payload = cmd.get('data', {})
@@ -215,6 +224,18 @@ class SubsystemNode(StatefulNode):
     def get_custom_commands(self):
         return self.cfgmgr.get_custom_commands()
 
+    def connection_stats(self) -> dict:
+        '''
+        Keep-alive connection statistics of the command sessions, per app and summed over the subsystem
+        (the terminated apps, which don't have a commander anymore, are skipped)
+        '''
+        ret = {c.name: c.sup.commander.connection_stats() for c in self.children if hasattr(c.sup, 'commander')}
+        ret[self.name] = {
+            key: sum(stats[key] for stats in ret.values())
+            for key in ['requests', 'connections', 'reused']
+        }
+        return ret
+
     def on_enter_boot_ing(self, event) -> NoReturn:
         partition = event.kwargs["partition"]
         self.log.info(f'Subsystem {self.name} is booting partition {partition}')
@@ -239,7 +260,8 @@ class SubsystemNode(StatefulNode):
                 function = 'boot',
                 boot_info = boot_info,
                 timeout = timeout,
-                conf_loc = self.cfgmgr.get_conf_location(for_apps=True)
+                conf_loc = self.cfgmgr.get_conf_location(for_apps=True),
+                show_progress = event.kwargs.get('show_progress', True),
             )
             self.pm_task_enqueuer.enqueue_synchronous(task)
             self.log.info('booting task ending')
@@ -265,6 +287,10 @@ class SubsystemNode(StatefulNode):
             )
             return
 
+        self.max_command_fanout = getattr(event.kwargs['pm'], 'max_command_fanout', self.max_command_fanout)
+        self.health_cache_ttl = getattr(event.kwargs['pm'], 'health_cache_ttl', self.health_cache_ttl)
+        self.health_cache = AppHealthCache(ttl=self.health_cache_ttl)
+
         children = []
         failed = []
         for n,d in self.pm.apps.items():
@@ -287,17 +313,20 @@ class SubsystemNode(StatefulNode):
                     response_host = response_host,
                     proxy = proxy,
                     connection_timeout = 10 if event.kwargs['pm'].use_k8spm() else 1,
+                    health_cache = self.health_cache,
                 ),
                 parent=self,
                 fsm_conf=self.fsm_conf)
 
             tries=0 # give it 10 more seconds to come up
-            while (not child.sup.desc.proc.is_alive() or not child.sup.commander.ping()) and tries<20:
+            alive, ping = child.sup.health(force=True)
+            while (not alive or not ping) and tries<20:
                 time.sleep(0.5)
                 tries+=1
+                alive, ping = child.sup.health(force=True)
 
 
-            if child.sup.desc.proc.is_alive() and child.sup.commander.ping():
+            if alive and ping:
                 # nothing really happens in these 2:
                 child.boot()
                 child.end_boot()
@@ -310,9 +339,9 @@ class SubsystemNode(StatefulNode):
                     "error": "Not bootable",
                 })
                 etext=''
-                if not child.sup.desc.proc.is_alive():
+                if not alive:
                     etext='Process isn\'t alive! '
-                if not child.sup.commander.ping():
+                if not ping:
                     etext='Cannot ping the app!'
                 child.to_error(
                     text=etext,
@@ -373,6 +402,9 @@ class SubsystemNode(StatefulNode):
 
     def terminate_logic(self) -> NoReturn:
         self.log.debug(f"Terminate logic of {self.name}")
+        if self.health_cache:
+            self.health_cache.stop()
+            self.health_cache = None
         if self.listener:
             self.listener.terminate()
         if self.pm:
@@ -415,6 +447,161 @@ class SubsystemNode(StatefulNode):
         self.errored = False
         self.log.debug(f"DONE Aborting {self.name}")
 
+    def _fan_out_command(self, command, appset, data, exit_state, on_ack=None) -> dict:
+        '''
+        Send the command to all the apps in appset concurrently.
+        The FSM of the children is moved to *_ing in this thread, only the HTTP requests go through the thread pool.
+        Returns a dictionary app name -> exception for the apps to which the command couldn't be sent.
+        '''
+        errors = {}
+        futures = {}
+        completed = 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_command_fanout, len(appset))), thread_name_prefix=f'{self.name}-fanout') as executor:
+            for child_node in appset:
+                self.log.debug(f'Sending {command} to {child_node.name}')
+                entry_state = child_node.state.upper()
+                try:
+                    child_node.trigger(command)
+                    ## APP now in *_ing
+                except Exception as e:
+                    errors[child_node.name] = e
+                    continue
+
+                future = executor.submit(
+                    child_node.sup.send_command,
+                    cmd_id = command,
+                    cmd_data = data,
+                    entry_state = entry_state,
+                    exit_state = exit_state
+                )
+                futures[future] = child_node.name
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    completed += 1
+                    if on_ack: on_ack(completed)
+                except Exception as e:
+                    errors[futures[future]] = e
+
+        # report the errors in the order of the appset, as the sequential version did
+        return {a.name: errors[a.name] for a in appset if a.name in errors}
+
+
+    def _send_command(self, command, appset, event, exit_state, force) -> list:
+        ignore = []
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            console=self.console,
+            disable=not event.kwargs.get('show_progress', True),
+        ) as progress:
+            total = progress.add_task("[yellow]# acks      received", total=len(appset))
+            errors = self._fan_out_command(
+                command = command,
+                appset = appset,
+                data = self.cfgmgr.generate_data_for_module(event.kwargs.get('overwrite_data')),
+                exit_state = exit_state,
+                on_ack = lambda completed: progress.update(total, completed=completed),
+            )
+
+        for name, e in errors.items():
+            if force:
+                self.log.error(f'Failed to send \'{command}\' to \'{name}\', --force was specified so continuing anyway')
+                ignore+=[name]
+            else:
+                self.log.error(f'Failed to send \'{command}\' to \'{name}\'')
+        if errors and not force:
+            raise list(errors.values())[0]
+
+        return [app for app in appset if app.name not in ignore]
+
+
+    def _wait_for_responses(self, command, appset, timeout, completion_queue, failed, mode_fail, show_progress=True) -> NoReturn:
+        '''
+        Block on the completion queue until all the apps have replied, died or the timeout expired.
+        The liveness of the apps which haven't replied yet is checked by an AppHealthMonitor at a low rate.
+        '''
+        pending = {a.name: a for a in appset if a.included}
+
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            TimeRemainingColumn(),
+            TimeElapsedColumn(),
+            console=self.console,
+            disable=not show_progress,
+        ) as progress:
+            n_apps = len(appset)
+            total = progress.add_task("[yellow]# responses received", total = n_apps)
+            apps_tasks = {
+                a.name: progress.add_task(f"[blue]{a.name}", total=1) for a in appset
+            }
+            timeout_bar = progress.add_task("[yellow]timeout", total = timeout)
+
+            monitor = AppHealthMonitor(
+                supervisors = {name: a.sup for name, a in pending.items()},
+                completion_queue = completion_queue,
+                interval = self.health_check_interval,
+            )
+            monitor.start()
+
+            start = time.monotonic()
+            try:
+                while pending:
+                    elapsed = time.monotonic() - start
+                    progress.update(timeout_bar, completed=elapsed)
+                    if elapsed >= timeout:
+                        break
+
+                    try:
+                        # the timeout here only serves to refresh the timeout bar
+                        app_name, failure_mode = completion_queue.get(timeout=min(0.5, timeout-elapsed))
+                    except queue.Empty:
+                        continue
+
+                    child_node = pending.get(app_name)
+                    if child_node is None:
+                        continue # late notification for an app that is already done
+
+                    if failure_mode:
+                        failed.append(child_node.name)
+                        mode_fail.append(failure_mode)
+                        child_node.to_error(
+                            command = command,
+                        )
+                    else:
+                        try:
+                            r = child_node.sup.check_response()
+                        except NoResponse:
+                            continue
+
+                        if r['success']:
+                            child_node.trigger("end_"+command) # this is all dummy
+                        else:
+                            failed.append(child_node.name)
+                            mode_fail.append('command error')
+                            child_node.to_error(
+                                command=command,
+                                text=r['result']
+                            )
+
+                    del pending[app_name]
+                    monitor.done(app_name)
+                    progress.update(apps_tasks[app_name], completed=1)
+                    progress.update(total, completed = n_apps - len(pending))
+            finally:
+                monitor.stop()
+
+            if not pending:
+                progress.update(total, completed = n_apps)
+                progress.update(timeout_bar, visible=False)
+
+
     def _on_enter_callback(self, event):
         command = event.event.name
         origin = event.transition.source
@@ -429,9 +616,9 @@ class SubsystemNode(StatefulNode):
         appset = list(self.children)
         failed = []
 
-        if not self.listener.flask_manager.is_alive():
+        if not self.listener.is_alive():
             self.log.error('Response listener is not alive, trying to respawn it!!')
-            self.listener.flask_manager = self.listener.create_manager()
+            self.listener.restart()
 
         to_chuck = []
         for i, n in enumerate(appset):
@@ -440,7 +627,8 @@ class SubsystemNode(StatefulNode):
                 to_chuck.append(n.name)
                 continue
 
-            if not n.sup.desc.proc.is_alive() or not n.sup.commander.ping():
+            # this is a critical point, so don't trust the cache
+            if not n.sup.is_healthy(force=True):
                 text = f"'{n.name}' seems to be dead. So I cannot initiate transition '{command}'"
                 if force:
                     self.log.error(text+f"\nBut! '--force' was specified, so I'll ignore '{n.name}'!")
@@ -461,129 +649,21 @@ class SubsystemNode(StatefulNode):
                 if chuck == app.name:
                     del appset[i]
 
-        ignore = []
-        with Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            console=self.console,
-        ) as progress:
-            total = progress.add_task("[yellow]# acks      received", total=len(appset))
-
-            completed = 0
-            for child_node in appset:
-                data = self.cfgmgr.generate_data_for_module(event.kwargs.get('overwrite_data'))
-                if not child_node.included:
-                    self.log.info(f'Node {child_node.name} is excluded! NOT sending {command} to it!')
-                    continue
-                self.log.debug(f'Sending {command} to {child_node.name}')
-
-                entry_state = child_node.state.upper()
-
-                try:
-                    child_node.trigger(command)
-                    ## APP now in *_ing
-                    child_node.sup.send_command(
-                        cmd_id = command,
-                        cmd_data = data,
-                        entry_state = entry_state,
-                        exit_state = exit_state
-                    )
-                    completed += 1
-                    progress.update(total, completed=completed)
-
-                except Exception as e:
-                    if force:
-                        self.log.error(f'Failed to send \'{command}\' to \'{child_node.name}\', --force was specified so continuing anyway')
-                        ignore+=[child_node.name]
-                    else:
-                        self.log.error(f'Failed to send \'{command}\' to \'{child_node.name}\'')
-                        raise e
-
-
-        for chuck in ignore:
-            for i, app in enumerate(appset):
-                if chuck == app.name:
-                    del appset[i]
-        with Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            TimeRemainingColumn(),
-            TimeElapsedColumn(),
-            console=self.console,
-        ) as progress:
-            n_apps = len(appset)
-            total = progress.add_task("[yellow]# responses received", total = n_apps)
-            apps_tasks = {
-                a.name: progress.add_task(f"[blue]{a.name}", total=1) for a in appset
-            }
-            timeout_bar = progress.add_task("[yellow]timeout", total = timeout*10)
-
-            failed_ping_count = {app.name:0 for app in appset}
-            mode_fail = []
-            failed_ping_thres = 3
-            for _ in range(timeout*10):
-                progress.update(timeout_bar, advance=1)
-                if len(appset)==0:
-                    progress.update(total, completed = n_apps)
-                    progress.update(timeout_bar, visible=False)
-                    break
-                done = []
-                for child_node in appset:
-                    if not child_node.included: continue
-                    is_alive = child_node.sup.desc.proc.is_alive()
-                    if not is_alive:
-                        failed.append(child_node.name)
-                        mode_fail.append('app died')
-                        child_node.to_error(
-                            command = command,
-                        )
-                        done += [child_node]
-                        continue
-                    is_ping = child_node.sup.commander.ping()
-                    if not is_ping:
-                        failed_ping_count[child_node.name] += 1
-                        if failed_ping_count[child_node.name] > failed_ping_thres:
-                            failed.append(child_node.name)
-                            mode_fail.append('app not pinging')
-                            child_node.to_error(
-                                command = command,
-                            )
-                            done += [child_node]
-                        continue
-                    try:
-                        r = child_node.sup.check_response()
-                    except NoResponse:
-                        continue
-
-                    done += [child_node]
-                    if r['success']:
-                        child_node.trigger("end_"+command) # this is all dummy
-                    else:
-                        response = {
-                            "node": child_node.name,
-                            "status_code" : r,
-                            "state": child_node.state,
-                            "command": command,
-                            "error": r,
-                            "failure_mode": mode_fail,
-                        }
-                        failed.append(child_node.name)
-                        mode_fail.append('command error')
-                        child_node.to_error(
-                            command=command,
-                            text=r['result']
-                        )
+        # replies (and health failures) for this transition all end up in this queue
+        completion_queue = queue.Queue()
+        listening = list(appset)
+        for a in listening:
+            a.sup.commander.completion_queue = completion_queue
 
-                for d in done:
-                    appset.remove(d)
-                    progress.update(apps_tasks[d.name], completed=1)
-                    progress.update(total, completed = n_apps - len(appset))
+        mode_fail = []
+        try:
+            appset = self._send_command(command, appset, event, exit_state, force)
+            self._wait_for_responses(command, appset, timeout, completion_queue, failed, mode_fail, event.kwargs.get('show_progress', True))
+        finally:
+            for a in listening:
+                if hasattr(a.sup, 'commander'): # not if the app was terminated meanwhile
+                    a.sup.commander.completion_queue = None
 
-                time.sleep(0.1)
 
         response= {}
         if failed:
@@ -13,7 +13,8 @@ def status_data(node, get_children=True) -> dict:
     ret = {}
     if isinstance(node, ApplicationNode):
         sup = node.sup
-        if sup.desc.proc.is_alive():
+        alive, ping = sup.health()
+        if alive:
             ret['process_state'] = 'alive'
         else:
             if isinstance(sup.desc.proc, K8sProcess): # hacky way to check the pm
@@ -24,7 +25,7 @@ def status_data(node, get_children=True) -> dict:
                 except sh.ErrorReturnCode as e:
                     exit_code = e.exit_code
             ret['process_state'] = f'dead[{exit_code}]'
-        ret['ping'] = sup.commander.ping()
+        ret['ping'] = ping
         ret['last_cmd_failed'] = (sup.last_sent_command != sup.last_ok_command)
         ret['name'] = node.name
         ret['state'] = ("error " if node.errored else "") + node.state + ("" if node.included else " - excluded")
@@ -35,6 +36,8 @@ def status_data(node, get_children=True) -> dict:
         ret['name'] = node.name
         ret['state'] = ("error " if node.errored else "") + node.state
         if get_children:
+            if isinstance(node, SubsystemNode) and node.health_cache:
+                node.health_cache.refresh()
             ret['children'] = [status_data(child) for child in node.children]
     return ret
 
@@ -51,8 +54,9 @@ def print_status(topnode, console, apparatus_id='', partition='', conf='') -> in
     for pre, _, node in RenderTree(topnode):
         if isinstance(node, ApplicationNode):
             sup = node.sup
+            is_alive, ping = sup.health()
 
-            if sup.desc.proc.is_alive():
+            if is_alive:
                 alive = 'alive'
             else:
                 proc = sup.desc.proc
@@ -67,7 +71,6 @@ def print_status(topnode, console, apparatus_id='', partition='', conf='') -> in
 
                 alive = f'dead[{exit_code}]'
 
-            ping = sup.commander.ping()
             last_cmd_failed = (sup.last_sent_command != sup.last_ok_command)
 
             state_str = ''
@@ -92,6 +95,9 @@ def print_status(topnode, console, apparatus_id='', partition='', conf='') -> in
             )
 
         else:
+            if isinstance(node, SubsystemNode) and node.health_cache:
+                node.health_cache.refresh() # probe its apps in one go, before they are printed
+
             state_str = ''
             style = ''
             if node.errored:
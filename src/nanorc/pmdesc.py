@@ -33,6 +33,53 @@ class pm_desc:
         if self.is_kind and self.address != "localhost":
             raise click.BadParameter(f'Kind address can only be localhost for now!')
 
+        # tuning options, e.g. k8s://host:port?fast_terminate=true or ssh://?control_master=false
+        options = parse.parse_qs(pm_uri.query)
+        unknown = set(options) - set(self.options)
+        if unknown:
+            raise click.BadParameter(f'Unknown --pm option(s) {", ".join(sorted(unknown))}, they can be: {", ".join(self.options)}')
+
+        for name, default in self.options.items():
+            value = options.get(name, [None])[0]
+            if value is None:
+                setattr(self, name, default)
+            elif isinstance(default, bool):
+                if value.lower() in ['1', 'true', 'yes']:
+                    setattr(self, name, True)
+                elif value.lower() in ['0', 'false', 'no']:
+                    setattr(self, name, False)
+                else:
+                    raise click.BadParameter(f'--pm option {name} should be true or false, not {value}')
+            else:
+                try:
+                    value = type(default)(value)
+                except ValueError:
+                    raise click.BadParameter(f'Badly formatted --pm option {name}={value}')
+                # the numbers of workers are at least 1, the durations aren't negative
+                minimum = 1 if isinstance(default, int) else 0
+                if value < minimum:
+                    raise click.BadParameter(f'--pm option {name} should be at least {minimum}, not {value}')
+                setattr(self, name, value)
+
+    # name -> default, the type of the default is the type of the option
+    options = {
+        # k8s: don't wait for the namespace to be deleted on terminate
+        'fast_terminate': False,
+        # k8s: create the pods and services with a server-side apply, and how many at a time
+        'server_side_apply': False,
+        'max_create_workers': 16,
+        # ssh: run the short commands over one multiplexed connection per host, and how many checks at a time
+        'control_master': True,
+        'max_preflight_workers': 32,
+        # how many applications are sent a command at a time, and how long their health is cached (s)
+        'max_command_fanout': 64,
+        'health_cache_ttl': 1.,
+        # how many subsystems' configurations are loaded at a time
+        'max_config_workers': 8,
+        # only parse the commands of the configuration directories when they are needed (disables their cache)
+        'lazy_config': False,
+    }
+
     def use_k8spm(self):
         return self.is_kind or self.is_k8s_cluster
 
@@ -72,4 +119,6 @@ class PMFactory:
                 console = self.console,
                 log_path = event.kwargs.get('log_path'),
                 ssh_conf = event.kwargs['ssh_conf'],
+                use_control_master = pm.control_master,
+                max_preflight_workers = pm.max_preflight_workers,
             )
@@ -1,4 +1,4 @@
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, request, make_response, jsonify, cli
 from flask_restful import Api, Resource
 from flask_cors import CORS, cross_origin
 import os
@@ -299,6 +299,9 @@ class RestApi:
         if not self.host or not self.port:
             raise RuntimeError('RestAPI: no host or port specified!')
 
+        # don't print the flask banner and every request in the console
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        cli.show_server_banner = lambda *_: None
         self.app.run(host=self.host, port=self.port,
                      debug=True, use_reloader=False,
                      threaded=True)
@@ -1,11 +1,17 @@
 import requests
 import json
+import time
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class SimpleRunNumberManager:
     def __init__(self):
         self.run_number = None
 
+    def request_run_number(self):
+        pass
+
     def get_run_number(self):
         return self.run_number
 
@@ -13,9 +19,17 @@ class SimpleRunNumberManager:
         self.run_number = run
 
 class DBRunNumberManager:
-    """A class that interacts with the run number db"""
+    """
+    A class that interacts with the run number db
+
+    request_run_number() asks the run number db for a new run number in the background, so that the
+    request overlaps with the rest of the start, and get_run_number() collects it (or asks for it then).
+    With prefetch=True, the next run number is also reserved when one is handed out, so the next start
+    doesn't wait for the run number db at all. The cost is that the run number reserved last is never
+    used, if nanorc is stopped, which is why it's off by default.
+    """
 
-    def __init__(self, socket:str):
+    def __init__(self, socket:str, prefetch:bool=False):
         super(DBRunNumberManager, self).__init__()
         self.log = logging.getLogger(self.__class__.__name__)
         self.run = None
@@ -25,15 +39,53 @@ class DBRunNumberManager:
         self.API_USER=auth.username
         self.API_PSWD=auth.password
         self.timeout = 2
+        self.prefetch = prefetch
+        self.session = self._make_session()
+        self.executor_session = self._make_session() # only used in the executor thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='run-number')
+        self.next_run = None # future of the requested run number
+        self.latencies = deque(maxlen=100) # of the last reservations, in seconds
+
+    @staticmethod
+    def _make_session():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request_run_number(self):
+        '''
+        Start asking for a new run number in the background, if there isn't one requested already
+        '''
+        if self.next_run is None:
+            self.next_run = self.executor.submit(self._getnew_run_number, self.executor_session)
 
     def get_run_number(self):
-        return self._getnew_run_number()
+        run = None
+        next_run, self.next_run = self.next_run, None
+        if next_run:
+            try:
+                start = time.perf_counter()
+                run = next_run.result(timeout=self.timeout)
+                self.log.info(f'Using the requested run number {run} (waited {time.perf_counter()-start:.3f}s)')
+            except Exception as e:
+                self.log.warning(f'Couldn\'t get the requested run number, asking for a new one: {str(e)}')
 
-    def _getnew_run_number(self):
+        if run is None:
+            run = self._getnew_run_number(self.session)
+
+        self.run = run
+        if self.prefetch:
+            self.request_run_number()
+        return self.run
+
+    def _getnew_run_number(self, session):
         try:
-            req = requests.get(self.API_SOCKET+'/runnumber/getnew',
-                               auth=(self.API_USER, self.API_PSWD),
-                               timeout=self.timeout)
+            start = time.perf_counter()
+            req = session.get(self.API_SOCKET+'/runnumber/getnew',
+                              auth=(self.API_USER, self.API_PSWD),
+                              timeout=self.timeout)
             req.raise_for_status()
         except requests.HTTPError as exc:
             error = f"{__name__}: HTTP Error (maybe failed auth, maybe ill-formed post message, ...)"
@@ -48,15 +100,17 @@ class DBRunNumberManager:
             self.log.error(error)
             raise RuntimeError(error) from exc
 
-        print(req.json())
-        self.run = req.json()[0][0][0]
-        return self.run
+        run = req.json()[0][0][0]
+        latency = time.perf_counter()-start
+        self.latencies.append(latency)
+        self.log.info(f'Reserved the run number {run} in {latency:.3f}s')
+        return run
 
     def _update_stop(self, run_number):
         try:
-            req = requests.get(self.API_SOCKET+'/runnumber/updatestop/'+str(run_number),
-                               auth=(self.API_USER, self.API_PSWD),
-                               timeout=self.timeout)
+            req = self.session.get(self.API_SOCKET+'/runnumber/updatestop/'+str(run_number),
+                                   auth=(self.API_USER, self.API_PSWD),
+                                   timeout=self.timeout)
             req.raise_for_status()
         except requests.HTTPError as exc:
             error = f"{__name__}: HTTP Error (maybe failed auth, maybe ill-formed post message, ...)"
@@ -9,12 +9,16 @@ import atexit
 import signal
 import threading
 import queue
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import signal
 import logging
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn
 from rich.table import Table
+from nanorc.utils import execute_script_on_hosts, log_script_results
 
 
 # # ------------------------------------------------
@@ -43,14 +47,18 @@ def on_parent_exit(signum):
 # # ------------------------------------------------
 
 # ---
-def is_port_open(ip, port):
+def is_port_open(ip, port, timeout=None):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if timeout is not None:
+        s.settimeout(timeout)
     try:
         s.connect((ip, int(port)))
         s.shutdown(2)
         return True
     except:
         return False
+    finally:
+        s.close()
 
 
 # ---
@@ -105,6 +113,87 @@ class AppProcessWatcherThread(threading.Thread):
         self.pm.notify_join(self.app, self, exc)
 
 
+class SSHControlMasterPool(object):
+    '''
+    One multiplexed ssh master connection per host.
+    The commands sent to a host with the args returned by `args` reuse its master connection
+    (and fall back to a direct connection if there isn't one).
+    Only use it for short-lived commands: sshd limits the number of sessions per connection
+    (MaxSessions, 10 by default), and all the sessions go down with the master.
+    '''
+
+    def __init__(self, ssh_cmd, ssh_env, ssh_conf, timeout=10):
+        self.log = logging.getLogger(__name__)
+        self.ssh_cmd = ssh_cmd
+        self.ssh_env = ssh_env
+        self.ssh_conf = ssh_conf
+        self.timeout = timeout
+        self.control_dir = None
+        self.masters = {} # host -> (control path, proc)
+        self.lock = threading.Lock()
+
+    def control_path(self, host):
+        with self.lock:
+            if self.control_dir is None:
+                # unix socket paths are limited to ~100 chars, keep it short
+                self.control_dir = tempfile.mkdtemp(prefix='nanorc-ssh-')
+            return os.path.join(self.control_dir, host.replace('/', '_'))
+
+    def args(self, host):
+        return ["-o", "ControlMaster=no", "-o", f"ControlPath={self.control_path(host)}"]
+
+    def start(self, host):
+        '''
+        Open the master connection to the host and wait for it to be ready
+        '''
+        path = self.control_path(host)
+        with self.lock:
+            if host in self.masters:
+                return
+            master_args = [host, "-M", "-N", "-o", "StrictHostKeyChecking=no", "-o", "ControlPersist=no", "-o", f"ControlPath={path}"] + self.ssh_conf
+            proc = self.ssh_cmd(
+                *master_args,
+                _env=self.ssh_env,
+                _bg=True,
+                _bg_exc=False,
+                _new_session=True,
+                _preexec_fn=on_parent_exit(signal.SIGTERM),
+            )
+            self.masters[host] = (path, proc)
+
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            if os.path.exists(path):
+                self.log.debug(f'ssh master connection to {host} ready in {time.perf_counter()-start:.2f}s')
+                return
+            if not proc.is_alive():
+                break
+            time.sleep(0.01)
+        self.log.warning(f'Could not open a master ssh connection to {host}, will use direct connections')
+
+    def stop(self):
+        with self.lock:
+            masters = self.masters
+            self.masters = {}
+            control_dir = self.control_dir
+            self.control_dir = None
+
+        for host, (path, proc) in masters.items():
+            if proc.is_alive():
+                try:
+                    self.ssh_cmd(host, "-O", "exit", "-o", f"ControlPath={path}", _env=self.ssh_env, _timeout=self.timeout)
+                except Exception as e:
+                    self.log.debug(f'Could not stop the master ssh connection to {host}: {str(e)}')
+            if proc.is_alive():
+                try:
+                    proc.terminate()
+                except OSError:
+                    pass
+
+        if control_dir:
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+
 # ---
 class SSHProcessManager(object):
     """An poor's man process manager based on ssh"""
@@ -123,7 +212,7 @@ class SSHProcessManager(object):
         for i in instances:
             i.kill()
 
-    def __init__(self, console: Console, log_path, ssh_conf):
+    def __init__(self, console: Console, log_path, ssh_conf, use_control_master:bool=True, max_preflight_workers:int=32):
         super(SSHProcessManager, self).__init__()
         self.console = console
         self.log = logging.getLogger(__name__)
@@ -136,6 +225,13 @@ class SSHProcessManager(object):
         host_env = os.environ
         self.ssh_env = {'KRB5CCNAME': host_env['KRB5CCNAME'] } if 'KRB5CCNAME' in host_env else {}
         self.log_path = log_path
+        self.max_preflight_workers = max_preflight_workers
+        self.port_check_timeout = 2
+        self.boot_timings = {}
+        self.script_timeout = 60
+        self.max_script_workers = 16
+        self.use_control_master = use_control_master
+        self.control_masters = SSHControlMasterPool(self.ssh_cmd, self.ssh_env, self.ssh_conf)
         # Add self to the list of instances
         self.__instances.add(self)
 
@@ -144,6 +240,16 @@ class SSHProcessManager(object):
             self.__instances.remove(self)
         self.kill()
 
+    def host_ssh_args(self, host, multiplexed=True):
+        '''
+        ssh args to run a command on the host, using its master connection if there is one and multiplexed is True.
+        The apps, which run for the whole session, use direct connections (multiplexed=False).
+        '''
+        ssh_args = [host, "-tt", "-o StrictHostKeyChecking=no"]
+        if self.use_control_master and multiplexed:
+            ssh_args += self.control_masters.args(host)
+        return ssh_args
+
     def watch(self, name, proc):
         t = AppProcessWatcherThread(self, name, proc)
         t.start()
@@ -169,23 +275,20 @@ class SSHProcessManager(object):
         cmd += "; ".join(script_data['cmd'])
         pretty_print += "; ".join(script_data['cmd'])
 
-        hosts = set(self.boot_info["hosts-ctrl"].values())
-
-        for host in hosts:
-            self.console.print(f'Executing {script_data["cmd"]} script on \'{host}\':\n[bright_black]{pretty_print}[/]')
-            ssh_args = [host, "-tt", "-o StrictHostKeyChecking=no"] + [cmd]
-            try:
-                proc = self.ssh_cmd(ssh_args, _env=self.ssh_env)
-            except ErrorReturnCode as e:
-                self.log.error(
-                    e.stdout.decode('ascii')
-                )
-                continue
-            except Exception as e:
-                self.log.critical(
-                    str(e)
-                )
-            self.log.debug(proc)
+        hosts = sorted(set(self.boot_info["hosts-ctrl"].values()))
+
+        self.console.print(f'Executing {script_data["cmd"]} script on {", ".join(hosts)}:\n[bright_black]{pretty_print}[/]')
+        results = execute_script_on_hosts(
+            ssh_cmd = self.ssh_cmd,
+            hosts = hosts,
+            ssh_args = self.host_ssh_args,
+            cmd = cmd,
+            ssh_env = self.ssh_env,
+            timeout = self.script_timeout,
+            max_workers = self.max_script_workers,
+        )
+        log_script_results(self.log, script_data["cmd"], results)
+        return results
 
     def setup_app(self, app_name, app_conf, conf_loc):
         hosts = self.boot_info["hosts-ctrl"]
@@ -208,8 +311,6 @@ class SSHProcessManager(object):
             "APP_WD": os.getcwd(),
             "CONF_LOC": conf_loc,
         }
-        if is_port_open(host, app_conf["port"]):
-            raise RuntimeError(f'The port {host}:{app_conf["port"]} for {app_name} is already open, likely by another application, cannot continue')
 
         if 'update-env' in app_conf:
             for k,v in app_conf['update-env'].items():
@@ -250,14 +351,29 @@ class SSHProcessManager(object):
             import socket
             self.console.print(f'\'{app_name}\' logs are in \'{socket.gethostname()}:{os.getcwd()}/{log_file}\'')
 
-        ssh_args = [host, "-tt", "-o StrictHostKeyChecking=no", "-vvv"]
+        ssh_args = self.host_ssh_args(host, multiplexed=False) + ["-vvv"]
         # if not self.can_use_kerb:
         ssh_args += self.ssh_conf
 
-        ssh_test_args = ssh_args+['echo "Knock knock, tricks or treats!"']
+        desc = AppProcessDescriptor(app_name)
+        desc.logfile = log_file
+        desc.cmd = cmd
+        desc.ssh_args = ssh_args
+        desc.host = host
+        desc.port = app_conf["port"]
+        desc.conf = app_conf.copy()
+        return desc
 
+    def test_host(self, host, ssh_args):
+        '''
+        Check that we can ssh to the host, returns the time it took
+        '''
+        ssh_test_args = ssh_args+['echo "Knock knock, tricks or treats!"']
+        start = time.perf_counter()
+        if self.use_control_master:
+            self.control_masters.start(host)
         try:
-            test_proc = self.ssh_cmd(ssh_test_args, _env=self.ssh_env)
+            self.ssh_cmd(ssh_test_args, _env=self.ssh_env)
         except Exception as e:
             self.log.error(f'I cannot ssh to {host}:')
             self.log.error(f'ssh {" ".join(ssh_test_args)}')
@@ -265,19 +381,89 @@ class SSHProcessManager(object):
                 stderr = e.stderr.decode("utf-8")
                 self.log.debug(stderr)
             raise e
+        return time.perf_counter() - start
+
+    def test_port(self, desc):
+        '''
+        Returns whether the port of the app is already open, and the time it took to check
+        '''
+        start = time.perf_counter()
+        is_open = is_port_open(desc.host, desc.port, timeout=self.port_check_timeout)
+        return is_open, time.perf_counter() - start
+
+    def preflight(self, descs):
+        '''
+        Test each distinct host once, and check that none of the ports of the apps are already used.
+        All the checks are done concurrently.
+        '''
+        host_args = {}
+        for desc in descs.values():
+            host_args.setdefault(desc.host, self.host_ssh_args(desc.host)+self.ssh_conf)
+
+        n_workers = max(1, min(self.max_preflight_workers, len(host_args)+len(descs)))
+        with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='ssh-preflight') as executor:
+            host_futures = {host: executor.submit(self.test_host, host, args) for host, args in host_args.items()}
+            port_futures = {name: executor.submit(self.test_port, desc) for name, desc in descs.items()}
+
+        failed_hosts = []
+        for host, future in host_futures.items():
+            try:
+                dt = future.result()
+                self.boot_timings['hosts'][host] = dt
+                self.log.info(f'ssh to {host} tested in {dt:.2f}s')
+            except Exception:
+                failed_hosts.append(host)
 
-        #ssh_args += [cmd]
+        if failed_hosts:
+            raise RuntimeError(f'Cannot ssh to {", ".join(failed_hosts)}')
 
-        desc = AppProcessDescriptor(app_name)
-        desc.logfile = log_file
-        desc.cmd = cmd
-        desc.ssh_args = ssh_args
-        desc.host = host
-        desc.port = app_conf["port"]
-        desc.conf = app_conf.copy()
-        return desc
+        apps_running = []
+        for name, future in port_futures.items():
+            is_open, dt = future.result()
+            self.boot_timings['apps'].setdefault(name, {})['port_check'] = dt
+            if is_open:
+                desc = descs[name]
+                apps_running += [f"{name} ({desc.host}:{desc.port})"]
+
+        if apps_running:
+            raise RuntimeError(f"ERROR: apps already running? {apps_running}")
+
+    def launch(self, name, desc, parent_exit_signal=True):
+        '''
+        Start the process of the app/service in the background, returns the time it took
+        '''
+        start = time.perf_counter()
+        ssh_args=desc.ssh_args + [desc.cmd]
+        kwargs = {}
+        if parent_exit_signal:
+            kwargs['_preexec_fn'] = on_parent_exit(signal.SIGTERM)
+        proc = self.ssh_cmd(
+            *ssh_args,
+            _env=self.ssh_env,
+            _out = file_logger(desc.logfile) if not self.log_path else None,
+            _bg = True,
+            _bg_exc = False,
+            _new_session = True,
+            **kwargs
+        )
+        self.watch(name, proc)
+        desc.proc = proc
+        return time.perf_counter() - start
 
-    def boot(self, boot_info, conf_loc, timeout):
+    def launch_all(self, descs, parent_exit_signal=True):
+        if not descs:
+            return
+
+        n_workers = max(1, min(self.max_preflight_workers, len(descs)))
+        with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='ssh-launch') as executor:
+            futures = {name: executor.submit(self.launch, name, desc, parent_exit_signal) for name, desc in descs.items()}
+
+        for name, future in futures.items():
+            dt = future.result()
+            self.boot_timings['apps'].setdefault(name, {})['launch'] = dt
+            self.log.debug(f'{name} launched in {dt:.3f}s (port check: {self.boot_timings["apps"][name].get("port_check", 0):.3f}s)')
+
+    def boot(self, boot_info, conf_loc, timeout, show_progress=True):
 
         if self.apps:
             raise RuntimeError(
@@ -289,49 +475,26 @@ class SSHProcessManager(object):
         apps = boot_info["apps"]
 
 
+        self.boot_timings = {'hosts': {}, 'apps': {}}
+        boot_start = time.perf_counter()
+
         self.console.print(f'Looking for services')
-        services = boot_info.get("services")
-        if services:
-            for srv_name, srv_conf in services.items():
-                desc=self.setup_app(srv_name, srv_conf, conf_loc)
-                self.services[srv_name] = desc
-                ssh_args=desc.ssh_args + [desc.cmd]
-                proc = self.ssh_cmd(
-                    *ssh_args,
-                    _out=file_logger(desc.logfile) if not self.log_path else None,
-                    _bg=True,
-                    _bg_exc=False,
-                    _new_session=True,
-                    _env=self.ssh_env,
-                    #_preexec_fn=on_parent_exit(signal.SIGTERM), # should be here too
-                )
-                self.watch(srv_name, proc)
-                desc.proc = proc
+        services = {}
+        for srv_name, srv_conf in boot_info.get("services", {}).items():
+            services[srv_name] = self.setup_app(srv_name, srv_conf, conf_loc)
 
+        apps_desc = {}
         for app_name, app_conf in apps.items():
-            desc=self.setup_app(app_name, app_conf, conf_loc)
-            self.apps[app_name] = desc
+            apps_desc[app_name] = self.setup_app(app_name, app_conf, conf_loc)
 
-        apps_running = []
-        for name, desc in self.apps.items():
-            if is_port_open(desc.host, desc.port):
-                apps_running += [f"{name} ({desc.host}:{desc.port})"]
-        if apps_running:
-            raise RuntimeError(f"ERROR: apps already running? {apps_running}")
+        self.preflight({**services, **apps_desc})
+        preflight_time = time.perf_counter() - boot_start
 
-        for name, desc in self.apps.items():
-            ssh_args=desc.ssh_args + [desc.cmd]
-            proc = self.ssh_cmd(
-                *ssh_args,
-                _env=self.ssh_env,
-                _out = file_logger(desc.logfile) if not self.log_path else None,
-                _bg = True,
-                _bg_exc = False,
-                _new_session = True,
-                _preexec_fn = on_parent_exit(signal.SIGTERM)
-            )
-            self.watch(name, proc)
-            desc.proc = proc
+        self.services = services
+        self.launch_all(self.services, parent_exit_signal=False) # should have the parent exit signal too
+        self.apps = apps_desc
+        self.launch_all(self.apps)
+        self.log.info(f'Pre-flight checks of {len(self.boot_timings["hosts"])} hosts took {preflight_time:.2f}s, {len(self.services)+len(self.apps)} processes launched in {time.perf_counter()-boot_start-preflight_time:.2f}s')
 
         with Progress(
             SpinnerColumn(),
@@ -341,6 +504,7 @@ class SSHProcessManager(object):
             TimeRemainingColumn(),
             TimeElapsedColumn(),
             console=self.console,
+            disable=not show_progress,
         ) as progress:
             total = progress.add_task("[yellow]# apps started", total=len(apps))
             apps_tasks = {
@@ -429,13 +593,15 @@ class SSHProcessManager(object):
             if os.path.exists(pid_file):
                 with open(pid_file, "r") as pf:
                     pid=pf.read().replace('\n', '')
-                ssh_args=desc.ssh_args + [f"kill {pid}"]
+                ssh_args=self.host_ssh_args(desc.host) + self.ssh_conf + [f"kill {pid}"]
                 try:
-                    sh.ssh(*ssh_args)
+                    self.ssh_cmd(*ssh_args, _env=self.ssh_env)
                 except Exception as e:
                     self.log.error(f'Couldn\'t kill the connectivity service on pid {pid}, it may already be dead?')
 
         self.services = {}
+        self.control_masters.stop()
+
     def kill(self):
         for name, desc in self.apps.items():
             if desc.proc is not None and desc.proc.is_alive():
@@ -454,12 +620,13 @@ class SSHProcessManager(object):
             if os.path.exists(pid_file):
                 with open(pid_file, "r") as pf:
                     pid=pf.read().replace('\n', '')
-                ssh_args=desc.ssh_args + [f"kill -9 {pid}"]
+                ssh_args=self.host_ssh_args(desc.host) + self.ssh_conf + [f"kill -9 {pid}"]
                 try:
-                    sh.ssh(*ssh_args)
+                    self.ssh_cmd(*ssh_args, _env=self.ssh_env)
                 except Exception as e:
                     self.log.error(f'Couldn\'t kill the connectivity service on pid {pid}, it may already be dead?')
         self.services = {}
+        self.control_masters.stop()
 
 # Cleanup before exiting
 def __goodbye(*args, **kwargs):
@@ -3,7 +3,8 @@ from typing import Union, NoReturn
 import logging
 from enum import IntEnum
 import threading
-from queue import Queue
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from transitions.core import MachineError
 import time
 from .fsm import FSM
@@ -226,40 +227,105 @@ class StatefulNode(NodeMixin):
         self.log.error(etext)
         self.errored = True
 
-    def _on_enter_callback(self, event):
-        command = event.event.name
-        self.log.debug(f"'{self.name}' received command '{command}'")
-        source_state = event.transition.source
-        force = event.kwargs.get('force')
-
+    def _get_stages(self, command) -> list:
+        '''
+        Each entry of the order is either the name of a child, or a list of children names.
+        All the children of a list (a stage) can execute the command concurrently.
+        '''
         if command in self.order:
             self.log.debug(f'Propagating to the included children nodes in the order {self.order[command]}')
         else:
             self.order[command] = [c.name for c in self.children]
             self.log.debug(f'Propagating to children nodes in the order: {self.order[command]}')
 
-        status = ErrorCode.Success
-        failed = []
+        return [entry if isinstance(entry, list) else [entry] for entry in self.order[command]]
 
-        for cn in self.order[command]:
-            child = [c for c in self.children if c.name == cn][0]
-            if not child.included: continue
+    def _execute_stage(self, command, children, kwargs) -> dict:
+        '''
+        Trigger the command on all the children of the stage, returns a dictionary child name -> exception
+        '''
+        exceptions = {}
+
+        if len(children) == 1:
+            child = children[0]
             self.log.debug(f'Sending {command} to {child.name}')
             try:
-                child.trigger(command, **event.kwargs)
-                for _ in range(event.kwargs["timeout"]):
-                    response = self.status_receiver_queue.get()
-                    if response:
-                        if response["node"] == child.name:
-                            if response["status_code"] != ErrorCode.Success:
-                                failed+=[child.name]
-                                raise RuntimeError(f"Failed to {command} {child.name}, error {str(response)}")
-                            else:
-                                break
-
-                    time.sleep(1)
-
+                child.trigger(command, **kwargs)
             except Exception as e:
+                exceptions[child.name] = e
+            return exceptions
+
+        self.log.debug(f'Sending {command} concurrently to {[c.name for c in children]}')
+        # progress bars of concurrent children would fight for the console
+        kwargs = dict(kwargs, show_progress=False)
+        with ThreadPoolExecutor(max_workers=len(children), thread_name_prefix=f'{self.name}-stage') as executor:
+            futures = {executor.submit(child.trigger, command, **kwargs): child for child in children}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    exceptions[futures[future].name] = e
+        return exceptions
+
+    def _collect_responses(self, names, timeout) -> dict:
+        '''
+        Get the responses of the children called names from the status_receiver_queue
+        '''
+        responses = {}
+        missing = set(names)
+        deadline = time.monotonic() + timeout
+
+        while missing:
+            try:
+                response = self.status_receiver_queue.get(timeout=max(0, deadline-time.monotonic()))
+            except Empty:
+                break
+            if response and response["node"] in missing:
+                responses[response["node"]] = response
+                missing.remove(response["node"])
+
+        return responses
+
+    def _on_enter_callback(self, event):
+        command = event.event.name
+        self.log.debug(f"'{self.name}' received command '{command}'")
+        source_state = event.transition.source
+        force = event.kwargs.get('force')
+
+        status = ErrorCode.Success
+        failed = []
+        children = {c.name: c for c in self.children}
+
+        for stage in self._get_stages(command):
+            stage_children = []
+            for cn in stage:
+                if cn not in children:
+                    self.log.error(f'\'{cn}\' is not a child of \'{self.name}\', not sending {command} to it')
+                    continue
+                if not children[cn].included: continue
+                stage_children.append(children[cn])
+
+            if not stage_children: continue
+
+            exceptions = self._execute_stage(command, stage_children, event.kwargs)
+            responses = self._collect_responses(
+                [c.name for c in stage_children if c.name not in exceptions],
+                event.kwargs["timeout"],
+            )
+
+            for child in stage_children:
+                e = exceptions.get(child.name)
+                if e is None:
+                    response = responses.get(child.name)
+                    if response is None:
+                        e = RuntimeError(f"No response from {child.name} to {command}")
+                    elif response["status_code"] != ErrorCode.Success:
+                        failed+=[child.name]
+                        e = RuntimeError(f"Failed to {command} {child.name}, error {str(response)}")
+
+                if e is None:
+                    continue
+
                 if force:
                     self.log.error(f'Failed to send \'{command}\' to \'{child.name}\', --force was specified so continuing anyway, {str(e)}')
                     continue
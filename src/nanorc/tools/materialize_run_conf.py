@@ -0,0 +1,42 @@
+from pathlib import Path
+import click
+from rich.console import Console
+
+console = Console()
+
+
+@click.command()
+@click.argument('cfg_dumpdir', type=click.Path(exists=True, file_okay=False), required=True)
+@click.argument('run', type=int, required=True)
+@click.argument('outdir', type=click.Path(), required=True)
+@click.option('--link', is_flag=True, type=bool, default=False, help='Hard link the configuration files instead of copying them (don\'t modify them!)')
+@click.option('--verbose', is_flag=True, type=bool, default=False)
+def materialize_run_conf(cfg_dumpdir, run, outdir, link, verbose):
+    '''
+    Rebuild the configuration of RUN, saved by nanorc in CFG_DUMPDIR, in OUTDIR
+    '''
+    from nanorc.cfgstore import materialize_run
+
+    run_dir = Path(cfg_dumpdir)/f'RunConf_{run}'
+    if not run_dir.exists():
+        raise click.BadParameter(f'There is no configuration for run {run} in {cfg_dumpdir}')
+
+    files = materialize_run(run_dir, Path(outdir), link=link)
+
+    if verbose:
+        for f in files:
+            console.print(str(f))
+    console.print(f'Configuration of run {run} written in {outdir} ({len(files)} files)')
+
+
+def main():
+    try:
+        materialize_run_conf()
+    except Exception as e:
+        console.log("[bold red]Exception caught[/bold red]")
+        console.log(e)
+        console.print_exception()
+
+
+if __name__ == '__main__':
+    main()
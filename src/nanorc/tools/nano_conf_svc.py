@@ -41,6 +41,8 @@ def svc(json_dir, name, port):
         cs.terminate()
 
     signal.signal(signal.SIGINT, signal_handler)
+    # the service runs in a thread of this process
+    signal.pause()
 
 def main():
     try:
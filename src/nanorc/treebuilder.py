@@ -2,6 +2,7 @@ from .statefulnode import StatefulNode
 from .node import SubsystemNode
 from .cfgmgr import ConfigManager
 import os
+import time
 import copy as cp
 import json
 from pathlib import Path
@@ -10,6 +11,7 @@ from collections import OrderedDict
 from json import JSONDecoder
 from pathlib import Path
 from anytree import PreOrderIter
+from concurrent.futures import ThreadPoolExecutor
 
 def dict_raise_on_duplicates(ordered_pairs):
     count=0
@@ -30,7 +32,69 @@ class ConfigManagerCreationFailed(Exception):
 
 
 class TreeBuilder:
-    def extract_json_to_nodes(self, js, mother, fsm_conf) -> StatefulNode:
+    def collect_subsystems(self, js, path=()) -> list:
+        '''
+        List of (path in the tree, configuration url) of the subsystems, in the order of the tree
+        '''
+        ret = []
+        for n,d in js.items():
+            if isinstance(d, dict):
+                ret += self.collect_subsystems(d, path+(n,))
+            elif isinstance(d, ParseResult):
+                ret += [(path+(n,), d)]
+            else:
+                self.log.error(f"ERROR processing the tree {n}: {d} I don't know what that's supposed to mean?")
+                exit(1)
+        return ret
+
+    def load_configuration(self, name, config_url, port_offset):
+        start = time.perf_counter()
+        try:
+            cfgmgr = ConfigManager(
+                log = self.log,
+                process_manager_description = self.process_manager_description,
+                config_url = config_url,
+                session = self.session,
+                port_offset = port_offset,
+                upload_to = self.conf_server,
+                lazy = getattr(self.process_manager_description, 'lazy_config', False),
+            )
+        except Exception as e:
+            raise ConfigManagerCreationFailed(name) from e
+        return cfgmgr, time.perf_counter() - start
+
+    def load_configurations(self, js) -> dict:
+        '''
+        Builds the configuration managers of all the subsystems concurrently.
+        The port offsets are assigned in the order of the tree, as if they were built one after the other.
+        Returns path in the tree -> configuration manager
+        '''
+        subsystems = self.collect_subsystems(js)
+        if not subsystems:
+            return {}
+
+        port_offsets = {}
+        for path, _ in subsystems:
+            port_offsets[path] = self.port_offset+self.subsystem_port_offset
+            self.subsystem_port_offset += self.subsystem_port_increment
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_config_workers, len(subsystems))), thread_name_prefix='cfgmgr') as executor:
+            futures = {
+                path: executor.submit(self.load_configuration, path[-1], config_url, port_offsets[path])
+                for path, config_url in subsystems
+            }
+
+        cfgmgrs = {}
+        for path, future in futures.items():
+            # raises the first error, in the order of the tree
+            cfgmgr, load_time = future.result()
+            self.log.info(f'Loaded the configuration of {path[-1]} in {load_time:.2f}s')
+            cfgmgrs[path] = cfgmgr
+        self.log.info(f'Loaded {len(cfgmgrs)} configurations in {time.perf_counter()-start:.2f}s')
+        return cfgmgrs
+
+    def extract_json_to_nodes(self, js, mother, fsm_conf, cfgmgrs, path=()) -> StatefulNode:
         for n,d in js.items():
             if isinstance(d, dict):
                 child = StatefulNode(
@@ -40,33 +104,17 @@ class TreeBuilder:
                     fsm_conf = fsm_conf
                 )
 
-                self.extract_json_to_nodes(d, child, fsm_conf = fsm_conf)
+                self.extract_json_to_nodes(d, child, fsm_conf = fsm_conf, cfgmgrs = cfgmgrs, path = path+(n,))
 
             elif isinstance(d, ParseResult):
-                try:
-                    cfgmgr = ConfigManager(
-                        log = self.log,
-                        process_manager_description = self.process_manager_description,
-                        config_url = d,
-                        session = self.session,
-                        port_offset = self.port_offset+self.subsystem_port_offset,
-                        upload_to = self.conf_server
-                    )
-                except Exception as e:
-                    raise ConfigManagerCreationFailed(n) from e
-
                 node = SubsystemNode(
                     name = n,
                     log = self.log,
-                    cfgmgr = cfgmgr,
+                    cfgmgr = cfgmgrs[path+(n,)],
                     console = self.console,
                     fsm_conf = fsm_conf,
                     parent = mother
                 )
-                self.subsystem_port_offset += self.subsystem_port_increment
-            else:
-                self.log.error(f"ERROR processing the tree {n}: {d} I don't know what that's supposed to mean?")
-                exit(1)
 
     def get_custom_commands(self):
         ret = {}
@@ -93,6 +141,7 @@ class TreeBuilder:
         self.port_offset = port_offset
         self.subsystem_port_offset = 0
         self.subsystem_port_increment = 50
+        self.max_config_workers = getattr(process_manager_description, 'max_config_workers', 8)
         from .confserver import ConfServer
         self.conf_server = ConfServer(8547+port_offset)
         self.initial_top_cfg = top_cfg
@@ -123,7 +172,8 @@ class TreeBuilder:
         self.extract_json_to_nodes(
             self.top_cfg,
             self.topnode,
-            fsm_conf=self.fsm_conf
+            fsm_conf=self.fsm_conf,
+            cfgmgrs=self.load_configurations(self.top_cfg),
         )
 
 
@@ -261,54 +261,260 @@ class TaskEnqueuerThread(threading.Thread):
                 raise e
 
             time.sleep(0.1)
+
+
+def execute_script_on_hosts(ssh_cmd, hosts, ssh_args, cmd:str, ssh_env:dict=None, timeout:float=None, max_workers:int=16) -> dict:
+    """
+    Runs a command over ssh on several hosts concurrently
+
+    Args:
+        ssh_cmd: the ssh sh.Command
+        hosts: hosts on which to run the command
+        ssh_args: function returning the ssh arguments for a host
+        cmd (str): the command to run
+        ssh_env (dict): environment of the ssh process (none by default)
+        timeout (float): timeout of the command on each host, in seconds
+        max_workers (int): maximum number of hosts the command runs on simultaneously
+
+    Returns:
+        dict: host -> {'success', 'exit_code', 'stdout', 'stderr', 'time'}
+    """
+    import sh
+    from concurrent.futures import ThreadPoolExecutor
+
+    if ssh_env is None:
+        ssh_env = {}
+
+    def decode(data):
+        if isinstance(data, bytes):
+            return data.decode('utf-8', errors='replace')
+        return data if data else ''
+
+    def run(host):
+        ret = {'success': False, 'exit_code': None, 'stdout': '', 'stderr': ''}
+        start = time.perf_counter()
+        try:
+            proc = ssh_cmd(ssh_args(host) + [cmd], _env=ssh_env, _timeout=timeout)
+            ret['success'] = True
+            ret['exit_code'] = 0
+            ret['stdout'] = decode(getattr(proc, 'stdout', proc))
+            ret['stderr'] = decode(getattr(proc, 'stderr', ''))
+        except sh.ErrorReturnCode as e:
+            ret['exit_code'] = e.exit_code
+            ret['stdout'] = decode(e.stdout)
+            ret['stderr'] = decode(e.stderr)
+        except sh.TimeoutException:
+            ret['stderr'] = f'timed out after {timeout}s'
+        except Exception as e:
+            ret['stderr'] = str(e)
+        ret['time'] = time.perf_counter() - start
+        return ret
+
+    hosts = list(hosts)
+    if not hosts:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(hosts))), thread_name_prefix='script') as executor:
+        results = list(executor.map(run, hosts))
+
+    return dict(zip(hosts, results))
+
+
+def log_script_results(log, script:str, results:dict) -> NoReturn:
+    for host, result in results.items():
+        if result['success']:
+            log.info(f'{script} script executed on \'{host}\' in {result["time"]:.2f}s')
+            if result['stdout']:
+                log.debug(f'{host}: {result["stdout"].strip()}')
+        else:
+            log.error(f'{script} script failed on \'{host}\' (exit code: {result["exit_code"]}): {result["stderr"] or result["stdout"]}')
+
+
 def get_random_string(length):
     import random
     import string
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(length))
 
-def get_json_recursive(path):
+def get_json_loads():
+    '''
+    orjson's loads if it is installed (much faster on large files), json's otherwise.
+    orjson rejects NaN and Infinity, which json accepts, so these files are parsed again with json.
+    '''
+    import json
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+
+    def loads(content):
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return json.loads(content)
+    return loads
+
+
+class LazyJSONDict(dict):
+    '''
+    Dictionary of JSON files, each of them is only read and parsed when its key is first accessed.
+
+    It's a dict, so the isinstance checks, json.dump and pickle (which parse everything) work on it,
+    the entries not parsed yet hold a placeholder in the underlying dict storage.
+    '''
+    _not_loaded = object()
+
+    def __init__(self, paths:dict):
+        super().__init__({key: self._not_loaded for key in paths})
+        self._paths = dict(paths)
+        self._lock = threading.Lock()
+
+    def loaded(self, key) -> bool:
+        return super().__getitem__(key) is not self._not_loaded
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if value is self._not_loaded:
+            with self._lock:
+                value = super().__getitem__(key)
+                if value is self._not_loaded:
+                    with open(self._paths[key], 'rb') as f:
+                        value = get_json_loads()(f.read())
+                    super().__setitem__(key, value)
+        return value
+
+    def __iter__(self):
+        # also stops dict() and {**} from copying the storage directly
+        return iter(list(self.keys()))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def to_dict(self) -> dict:
+        return {key: self[key] for key in self.keys()}
+
+    def copy(self) -> dict:
+        return self.to_dict()
+
+    def __eq__(self, other):
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+    def __repr__(self):
+        return f'LazyJSONDict({self.to_dict()!r})'
+
+
+def get_json_recursive(path, lazy:bool=False, max_workers:int=16) -> dict:
+    '''
+    Loads all the JSON files of a configuration directory.
+
+    The files are read and parsed concurrently. "data/<app>_<cmd>.json" end up in data[app][cmd],
+    with lazy=True data[app] is a LazyJSONDict, and each command is only parsed when it is accessed.
+    '''
     from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
+    import os
 
-    if not path is Path:
-        path = Path(path)
+    log = logging.getLogger('get_json_recursive')
+    loads = get_json_loads()
+    path = Path(path)
 
-    import json, os
+    # list everything first, (keys in the returned dict, file, is it a data file)
+    files = []
+    lazy_files = {}
 
-    data = {}
-    boot = path/"boot.json"
-    if os.path.isfile(boot):
-        with open(boot,'r') as f:
-            data['boot'] = json.load(f)
-
-    for filename in os.listdir(path):
-        if os.path.isfile(path/filename):
-            file_base, _ = os.path.splitext(filename)
-            with open(path/filename,'r') as f:
-                try:
-                    data[file_base] = json.load(f)
-                except:
-                    print(f'WARNING: ignoring non-json file: {path/filename}')
-        elif os.path.isdir(path/filename):
-            if filename == 'data':continue # this one is special and handled below
-            data[filename] = get_json_recursive(path/filename)
-
-    if not os.path.isdir(path/'data'):
-        return data
-
-    for filename in os.listdir(path/"data"):
-        with open(path/'data'/filename,'r') as f:
+    def walk(path, keys):
+        filenames = os.listdir(path)
+        if 'boot.json' in filenames:
+            filenames.remove('boot.json')
+            filenames.insert(0, 'boot.json')
+
+        for filename in filenames:
+            if os.path.isfile(path/filename):
+                file_base, _ = os.path.splitext(filename)
+                files.append((keys+(file_base,), path/filename, False))
+            elif os.path.isdir(path/filename):
+                if filename == 'data':continue # this one is special and handled below
+                walk(path/filename, keys+(filename,))
+
+        if not os.path.isdir(path/'data'):
+            return
+
+        for filename in os.listdir(path/'data'):
             app_cmd = filename.replace('.json', '').split('_')
             app = app_cmd[0]
             cmd = "_".join(app_cmd[1:])
-
-            if not app in data:
-                data[app] = {
-                    cmd: json.load(f)
-                }
+            if lazy:
+                lazy_files.setdefault(keys+(app,), {})[cmd] = path/'data'/filename
             else:
-                data[app][cmd]=json.load(f)
+                files.append((keys+(app, cmd), path/'data'/filename, True))
 
+    walk(path, ())
+
+    not_json = object()
+    def parse(entry):
+        keys, file, is_data = entry
+        with open(file, 'rb') as f:
+            content = f.read()
+        try:
+            return loads(content)
+        except Exception:
+            if is_data:
+                raise
+            log.warning(f'Ignoring non-json file: {file}')
+            return not_json
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files))), thread_name_prefix='json') as executor:
+        parsed = list(executor.map(parse, files))
+
+    data = {}
+    def insert(keys, value):
+        d = data
+        for key in keys[:-1]:
+            d = d.setdefault(key, {})
+        d[keys[-1]] = value
+
+    for (keys, file, is_data), value in zip(files, parsed):
+        if value is not_json:
+            continue
+        insert(keys, value)
+
+    for keys, paths in lazy_files.items():
+        d = data
+        for key in keys[:-1]:
+            d = d.setdefault(key, {})
+        lazy_dict = LazyJSONDict(paths)
+        for key, value in d.get(keys[-1], {}).items():
+            if key not in paths:
+                lazy_dict[key] = value
+        d[keys[-1]] = lazy_dict
+
+    log.debug(f'Loaded {len(files)} files from {path} in {time.perf_counter()-start:.3f}s')
     return data
 
 
@@ -1,6 +1,7 @@
 from http import server
 
-from flask import Flask, render_template
+import logging
+from flask import Flask, render_template, cli
 import requests
 from flask_cors import CORS, cross_origin
 
@@ -37,6 +38,9 @@ class WebServer:
     def run(self):
         if not self.host or not self.port:
             raise RuntimeError('WebUI: no host or port specified!')
+        # don't print the flask banner and every request in the console
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        cli.show_server_banner = lambda *_: None
         self.app.run(host=self.host, port=self.port,
                      debug=True, use_reloader=False,
                      threaded=True)
@@ -0,0 +1,166 @@
+import json
+import pytest
+import threading
+from nanorc.archiver import ArchivalQueue, JobDeferred, get_spool_dir
+
+
+def make_queue(spool_dir, process, **kwargs):
+    kwargs.setdefault('max_retries', 3)
+    kwargs.setdefault('retry_delay', 0.01)
+    return ArchivalQueue('test', process, spool_dir=spool_dir, **kwargs)
+
+
+def fail(job):
+    raise RuntimeError('service down')
+
+
+def run_queue(q, timeout=5):
+    q.start()
+    assert q.flush(timeout)
+    q.stop()
+
+
+def test_spool_dir_per_session(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path))
+    assert get_spool_dir('elisa') == tmp_path/'nanorc'/'spool'/'elisa'/'default_0'
+    assert get_spool_dir('elisa', 'np04', 100) == tmp_path/'nanorc'/'spool'/'elisa'/'np04_100'
+    assert get_spool_dir('elisa', 'np04', 0) != get_spool_dir('elisa', 'np02', 0)
+
+
+def test_retry_then_done(tmp_path):
+    attempts = []
+    def process(job):
+        attempts.append(job)
+        if len(attempts) < 3:
+            raise RuntimeError('service down')
+
+    q = make_queue(tmp_path/'spool', process)
+    seq = q.submit({'kind': 'insert', 'run': 1})
+    run_queue(q)
+
+    assert len(attempts) == 3
+    assert q.status()[seq]['status'] == 'done'
+    assert q.status()[seq]['attempt'] == 3
+    assert not ArchivalQueue._spooled_jobs(tmp_path/'spool')
+
+
+def test_failed_job_stays_spooled_and_is_resubmitted(tmp_path):
+    failures = []
+    q = make_queue(tmp_path/'spool', fail, on_failure=lambda job, error: failures.append((job['run'], error)))
+    seq = q.submit({'kind': 'insert', 'run': 2})
+    run_queue(q)
+
+    assert failures == [(2, 'service down')]
+    assert q.status(run=2)[seq]['status'] == 'failed'
+    assert len(ArchivalQueue._spooled_jobs(tmp_path/'spool')) == 1
+
+    done = []
+    q = make_queue(tmp_path/'spool', done.append)
+    assert [s['status'] for s in q.status().values()] == ['queued']
+    # the new jobs come after the resubmitted ones
+    assert q.submit({'kind': 'update', 'run': 2}) > seq
+    run_queue(q)
+
+    assert [(job['kind'], job['run']) for job in done] == [('insert', 2), ('update', 2)]
+    assert not ArchivalQueue._spooled_jobs(tmp_path/'spool')
+
+
+def test_deferred_job_is_not_retried(tmp_path):
+    calls = []
+    def process(job):
+        calls.append(job)
+        raise JobDeferred('the insert failed')
+
+    q = make_queue(tmp_path/'spool', process)
+    seq = q.submit({'kind': 'update', 'run': 3})
+    run_queue(q)
+
+    assert len(calls) == 1
+    assert q.status()[seq]['status'] == 'deferred'
+    assert len(ArchivalQueue._spooled_jobs(tmp_path/'spool')) == 1
+
+
+def test_payload_is_spooled_by_the_worker(tmp_path):
+    release = threading.Event()
+    payloads = []
+    def process(job):
+        release.wait(5)
+        payloads.append(job['payload'])
+
+    q = make_queue(tmp_path/'spool', process)
+    q.submit({'kind': 'insert', 'run': 4}, payload={'/boot.json': {'apps': {}}})
+    path, = ArchivalQueue._spooled_jobs(tmp_path/'spool')
+    with open(path) as f:
+        assert 'payload' not in json.load(f)
+
+    q.start()
+    release.set()
+    assert q.flush(5)
+    q.stop()
+    assert payloads == [{'/boot.json': {'apps': {}}}]
+    assert not list((tmp_path/'spool').glob('*.payload'))
+
+
+def test_payload_of_resubmitted_job(tmp_path):
+    q = make_queue(tmp_path/'spool', fail, max_retries=1)
+    q.submit({'kind': 'insert', 'run': 5}, payload={'a': 1})
+    run_queue(q)
+    assert len(list((tmp_path/'spool').glob('*.payload'))) == 1
+
+    payloads = []
+    q = make_queue(tmp_path/'spool', lambda job: payloads.append(job['payload']))
+    run_queue(q)
+    assert payloads == [{'a': 1}]
+    assert [p.name for p in (tmp_path/'spool').iterdir()] == ['.lock']
+
+
+def test_lost_payload_fails(tmp_path):
+    q = make_queue(tmp_path/'spool', lambda job: None)
+    q.submit({'kind': 'insert', 'run': 6}, payload={'a': 1})
+    q.stop(0) # never started, the payload isn't written
+
+    failures = []
+    q = make_queue(tmp_path/'spool', lambda job: None, on_failure=lambda job, error: failures.append(job['run']))
+    run_queue(q)
+    assert failures == [6]
+    assert [s['status'] for s in q.status().values()] == ['failed']
+    assert not ArchivalQueue._spooled_jobs(tmp_path/'spool')
+
+
+def test_running_instance_spool_is_not_shared(tmp_path):
+    spool_dir = tmp_path/'elisa'/'np04_0'
+    first = make_queue(spool_dir, lambda job: None)
+    second = make_queue(spool_dir, lambda job: None)
+    try:
+        assert first.spool_dir == spool_dir
+        assert second.spool_dir != spool_dir
+        assert second.own_spool_dir
+    finally:
+        second.stop(0)
+        first.stop(0)
+    # an instance's own directory is removed once it's empty
+    assert not second.spool_dir.exists()
+    assert spool_dir.exists()
+
+
+def test_orphaned_jobs_are_adopted(tmp_path):
+    running_dir = tmp_path/'elisa'/'np03_0'
+    running = make_queue(running_dir, lambda job: None)
+    running.submit({'kind': 'message', 'run': 8})
+
+    orphan_dir = tmp_path/'elisa'/'np02_0'
+    q = make_queue(orphan_dir, lambda job: None)
+    q.submit({'kind': 'message', 'run': 7})
+    q.stop(0)
+
+    adopted = []
+    done = []
+    q = make_queue(tmp_path/'elisa'/'np04_0', done.append, on_adopt=adopted.append)
+    run_queue(q)
+    running.stop(0)
+
+    # the jobs of a running nanorc are left alone
+    assert adopted == [orphan_dir]
+    assert [job['run'] for job in done] == [7]
+    assert not ArchivalQueue._spooled_jobs(orphan_dir)
+    assert len(ArchivalQueue._spooled_jobs(running_dir)) == 1
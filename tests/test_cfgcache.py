@@ -0,0 +1,134 @@
+import os
+import json
+import pytest
+from nanorc.cfgcache import ConfigCache, DBConfigCache, getenv_names, get_cache_dir
+
+
+def write_conf(path, files):
+    for rel_path, data in files.items():
+        (path/rel_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path/rel_path, 'w') as f:
+            json.dump(data, f)
+    return path
+
+
+@pytest.fixture
+def conf(tmp_path):
+    return write_conf(tmp_path/'conf', {
+        'boot.json': {'env': {'DUNEDAQ_PARTITION': 'getenv', 'FOO': 'bar'}},
+        'data/a_conf.json': {'x': 1},
+    })
+
+
+def test_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert get_cache_dir() == tmp_path/'nanorc'/'config'
+    assert ConfigCache().cache_dir == tmp_path/'nanorc'/'config'
+    assert DBConfigCache().cache_dir == tmp_path/'nanorc'/'db'
+
+
+def test_key_stability(conf):
+    cache = ConfigCache()
+    key = cache.key(conf, port_offset=0, partition='p')
+    # the order of the parameters doesn't matter
+    assert cache.key(conf, partition='p', port_offset=0) == key
+    assert cache.key(conf, port_offset=100, partition='p') != key
+
+    os.utime(conf/'boot.json', (0, 0))
+    assert cache.key(conf, port_offset=0, partition='p') == key
+
+    write_conf(conf, {'data/a_conf.json': {'x': 2}})
+    assert cache.key(conf, port_offset=0, partition='p') != key
+
+
+def test_key_changes_with_new_file(conf):
+    cache = ConfigCache()
+    key = cache.key(conf)
+    write_conf(conf, {'data/b_conf.json': {}})
+    assert cache.key(conf) != key
+
+
+def test_getenv_names():
+    boot = {
+        'env': {'A': 'getenv', 'B': 'value'},
+        'scripts': {'s': {'env': {'C': 'getenv:default'}}},
+        'exec': {'e': {'env': {'D': 'getenv_ifset', 'A': 'getenv'}}},
+    }
+    assert getenv_names(boot) == ['A', 'C', 'D']
+
+
+def test_env_invalidation(tmp_path, conf, monkeypatch):
+    cache = ConfigCache(tmp_path/'cache')
+    key = cache.key(conf)
+    monkeypatch.setenv('DUNEDAQ_PARTITION', 'p1')
+    cache.store(key, {'boot': 1}, env_names=['DUNEDAQ_PARTITION'])
+    assert cache.load(key) == {'boot': 1}
+
+    monkeypatch.setenv('DUNEDAQ_PARTITION', 'p2')
+    assert cache.load(key) is None
+
+    monkeypatch.delenv('DUNEDAQ_PARTITION')
+    assert cache.load(key) is None
+
+
+def test_unreadable_entry(tmp_path):
+    cache = ConfigCache(tmp_path/'cache')
+    cache.cache_dir.mkdir()
+    with open(cache.cache_dir/'abc.pickle', 'wb') as f:
+        f.write(b'not a pickle')
+    assert cache.load('abc') is None
+    assert cache.load('missing') is None
+
+
+def test_lru_eviction(tmp_path):
+    cache = ConfigCache(tmp_path/'cache', max_entries=2)
+    cache.store('a', {'a': 1})
+    os.utime(cache.cache_dir/'a.pickle', (1, 1))
+    cache.store('b', {'b': 1})
+    os.utime(cache.cache_dir/'b.pickle', (2, 2))
+    assert cache.load('a') == {'a': 1} # now the most recently used
+
+    cache.store('c', {'c': 1})
+    assert cache.load('b') is None
+    assert cache.load('a') == {'a': 1}
+    assert cache.load('c') == {'c': 1}
+    assert not list(cache.cache_dir.glob('*.tmp'))
+
+
+def test_db_cache_versions(tmp_path):
+    cache = DBConfigCache(tmp_path/'db')
+    assert cache.load('conf') is None
+
+    cache.store('conf', None, b'latest', etag='"e1"', last_modified='yesterday')
+    cache.store('conf', '2', b'version 2')
+
+    content, meta = cache.load('conf')
+    assert content == b'latest'
+    assert meta['etag'] == '"e1"'
+    assert meta['last_modified'] == 'yesterday'
+    assert cache.load('conf', '2')[0] == b'version 2'
+    assert cache.load('conf', '3') is None
+    assert cache.load('other', '2') is None
+
+
+def test_db_cache_truncated_entry(tmp_path):
+    cache = DBConfigCache(tmp_path/'db')
+    cache.store('conf', '1', b'0123456789')
+    data_path, _ = cache._entry_paths('conf', '1')
+    with open(data_path, 'wb') as f:
+        f.write(b'01234')
+    assert cache.load('conf', '1') is None
+
+
+def test_db_cache_lru_eviction(tmp_path):
+    cache = DBConfigCache(tmp_path/'db', max_bytes=25)
+    for i, version in enumerate(['1', '2']):
+        cache.store('conf', version, b'x'*10)
+        os.utime(cache._entry_paths('conf', version)[0], (i, i))
+    assert cache.load('conf', '1') # now the most recently used
+
+    cache.store('conf', '3', b'x'*10)
+    assert cache.load('conf', '2') is None
+    assert not cache._entry_paths('conf', '2')[1].exists()
+    assert cache.load('conf', '1')
+    assert cache.load('conf', '3')
@@ -0,0 +1,41 @@
+import pytest
+from types import SimpleNamespace
+from nanorc.cfgmgr import ConfigManager, ConfigTransformationReport, touched_keys
+
+
+@pytest.mark.parametrize('uri, offset, expected', [
+    ('tcp://{host_a}:1234', 0, 'tcp://{host_a}:1234'),
+    ('tcp://{host_a}:1234', 100, 'tcp://{host_a}:1334'),
+    ('tcp://10.0.0.1:1234', 1000, 'tcp://10.0.0.1:2234'),
+    ('tcp://[::1]:1234', 1, 'tcp://[::1]:1235'),
+    ('tcp://host:1234/path?x=1', 1, 'tcp://host:1235/path?x=1'),
+])
+def test_offset_port(uri, offset, expected):
+    assert ConfigManager._offset_port(SimpleNamespace(port_offset=offset), uri) == expected
+
+
+def test_offset_port_without_port():
+    with pytest.raises(ValueError):
+        ConfigManager._offset_port(SimpleNamespace(port_offset=1), 'tcp://host')
+
+
+def test_touched_keys():
+    old = {'a': {'b': 1, 'c': [1, 2]}, 'd': 1, 'e': {'f': 1}}
+    new = {'a': {'b': 2, 'c': [1, 2]}, 'd': {'x': 1}, 'g': 3}
+    assert touched_keys(old, new) == {
+        'a.b': (1, 2),
+        'd': (1, {'x': 1}),
+        'e': ({'f': 1}, None), # a removed section is one key
+        'g': (None, 3),
+    }
+    assert touched_keys(old, old) == {}
+    assert touched_keys(old, new, 'boot') == {f'boot.{k}': v for k, v in touched_keys(old, new).items()}
+
+
+def test_report_diff():
+    report = ConfigTransformationReport()
+    report.add_step('offset', touched_keys({'uri': 'tcp://h:1'}, {'uri': 'tcp://h:2'}))
+    assert report.summary() == {'offset': ['uri']}
+    assert report.diff('offset') == {
+        'values_changed': {'uri': {'old_value': 'tcp://h:1', 'new_value': 'tcp://h:2'}}
+    }
@@ -0,0 +1,79 @@
+import json
+import pytest
+from nanorc.cfgstore import ConfigBlobStore, write_manifest, materialize_run, MANIFEST_NAME
+
+
+def test_blobs_are_stored_once(tmp_path):
+    store = ConfigBlobStore(tmp_path/'blobs')
+    content = b'{"a": 1}'
+    blob_hash = store.put(content)
+
+    assert blob_hash == ConfigBlobStore.hash(content)
+    assert store.path(blob_hash) == tmp_path/'blobs'/blob_hash[:2]/f'{blob_hash}.json'
+    assert store.contains(blob_hash)
+    assert store.get(blob_hash) == content
+
+    mtime = store.path(blob_hash).stat().st_mtime_ns
+    assert store.put(content) == blob_hash
+    assert store.path(blob_hash).stat().st_mtime_ns == mtime
+    assert len(list((tmp_path/'blobs').rglob('*.json'))) == 1
+    assert not list((tmp_path/'blobs').rglob('*.tmp'))
+
+
+def save_run(root, run, files, runtime_files={}):
+    store = ConfigBlobStore(root/'blobs')
+    run_dir = root/f'run{run}'
+    run_dir.mkdir()
+    manifest = {}
+    for rel_path, data in files.items():
+        manifest[rel_path] = store.put(json.dumps(data).encode())
+    for rel_path, data in runtime_files.items():
+        with open(run_dir/rel_path, 'w') as f:
+            json.dump(data, f)
+    write_manifest(run_dir, run, manifest)
+    return run_dir, store
+
+
+@pytest.mark.parametrize('link', [False, True])
+def test_materialize_run(tmp_path, link):
+    files = {
+        '/boot.json': {'apps': {'a': {}}},
+        '/data/a_conf.json': {'x': 1},
+    }
+    run_dir, store = save_run(tmp_path, 12, files, {'runtime.json': {'start_time': 0}})
+    written = materialize_run(run_dir, tmp_path/'out', link=link)
+
+    assert sorted(p.relative_to(tmp_path/'out').as_posix() for p in written) == ['boot.json', 'data/a_conf.json', 'runtime.json']
+    for rel_path, data in files.items():
+        with open(tmp_path/'out'/rel_path.lstrip('/')) as f:
+            assert json.load(f) == data
+    assert not (tmp_path/'out'/MANIFEST_NAME).exists()
+
+    with open(run_dir/MANIFEST_NAME) as f:
+        manifest = json.load(f)
+    assert manifest['run'] == 12
+    boot_blob = store.path(manifest['files']['/boot.json'])
+    assert ((tmp_path/'out'/'boot.json').stat().st_ino == boot_blob.stat().st_ino) == link
+
+
+def test_runs_share_blobs(tmp_path):
+    save_run(tmp_path, 1, {'/boot.json': {'a': 1}, '/data/a_conf.json': {'x': 1}})
+    save_run(tmp_path, 2, {'/boot.json': {'a': 1}, '/data/a_conf.json': {'x': 2}})
+    assert len(list((tmp_path/'blobs').rglob('*.json'))) == 3
+
+
+def test_materialize_missing_blob(tmp_path):
+    run_dir, store = save_run(tmp_path, 3, {'/boot.json': {'a': 1}})
+    store.path(ConfigBlobStore.hash(b'{"a": 1}')).unlink()
+    with pytest.raises(RuntimeError):
+        materialize_run(run_dir, tmp_path/'out')
+
+
+def test_materialize_run_without_manifest(tmp_path):
+    run_dir = tmp_path/'run4'
+    (run_dir/'data').mkdir(parents=True)
+    with open(run_dir/'data'/'a_conf.json', 'w') as f:
+        json.dump({'x': 1}, f)
+
+    written = materialize_run(run_dir, tmp_path/'out')
+    assert written == [tmp_path/'out'/'data'/'a_conf.json']
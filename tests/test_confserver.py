@@ -0,0 +1,105 @@
+import gzip
+import json
+import pytest
+from flask import Flask
+from flask_restful import Api
+from nanorc.confserver import ConfigurationEndpoint, SerializedConfiguration, supported_encodings
+from nanorc.utils import get_json_recursive
+
+
+CONF = {
+    'boot': {'apps': {'a': {}, 'b': {}}},
+    'a': {'conf': {'x': 1}, 'start': {}},
+    'b': {},
+}
+
+
+@pytest.fixture(params=[False, True], ids=['eager', 'lazy'])
+def client(request, tmp_path):
+    if request.param:
+        (tmp_path/'data').mkdir()
+        with open(tmp_path/'boot.json', 'w') as f:
+            json.dump(CONF['boot'], f)
+        for cmd, data in CONF['a'].items():
+            with open(tmp_path/'data'/f'a_{cmd}.json', 'w') as f:
+                json.dump(data, f)
+        conf = get_json_recursive(tmp_path, lazy=True)
+        conf['b'] = {}
+    else:
+        conf = json.loads(json.dumps(CONF))
+
+    app = Flask('test')
+    Api(app).add_resource(
+        ConfigurationEndpoint, '/configuration',
+        resource_class_kwargs = {
+            'config_data': {'conf': conf},
+            'serialized_data': {'conf': SerializedConfiguration(conf)},
+            'encodings': supported_encodings(),
+        }
+    )
+    return app.test_client()
+
+
+def get(client, headers={}, **args):
+    return client.get('/configuration', query_string={'name': 'conf', **args}, headers=headers)
+
+
+def test_pieces(client):
+    assert get(client).json == CONF
+    assert get(client, app_name='a').json == CONF['a']
+    assert get(client, app_name='a', cmd_name='conf').json == {'x': 1}
+    assert client.get('/configuration').json == ['conf']
+
+
+def test_empty_or_missing_pieces(client):
+    assert get(client, app_name='b').status_code == 404
+    assert get(client, app_name='a', cmd_name='start').status_code == 404
+    assert get(client, app_name='a', cmd_name='scrap').status_code == 404
+    assert get(client, app_name='c').status_code == 404
+    assert client.get('/configuration', query_string={'name': 'other'}).status_code == 404
+
+
+def test_etag(client):
+    res = get(client, app_name='a', cmd_name='conf')
+    etag = res.headers['ETag']
+    assert res.headers['Vary'] == 'Accept-Encoding'
+
+    res = get(client, {'If-None-Match': etag}, app_name='a', cmd_name='conf')
+    assert res.status_code == 304
+    assert res.data == b''
+
+    res = get(client, {'If-None-Match': f'"other", {etag}'}, app_name='a', cmd_name='conf')
+    assert res.status_code == 304
+
+    assert get(client, {'If-None-Match': etag}, app_name='a').status_code == 200
+
+
+def test_gzip(client):
+    res = get(client, {'Accept-Encoding': 'gzip'}, app_name='a')
+    assert res.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(res.data)) == CONF['a']
+
+    res = get(client, app_name='a')
+    assert 'Content-Encoding' not in res.headers
+    assert res.json == CONF['a']
+
+
+def test_zstd(client):
+    zstandard = pytest.importorskip('zstandard')
+    res = get(client, {'Accept-Encoding': 'gzip;q=0.5, zstd'}, app_name='a')
+    assert res.headers['Content-Encoding'] == 'zstd'
+    assert json.loads(zstandard.ZstdDecompressor().decompress(res.data)) == CONF['a']
+
+
+def test_lazy_serialization(tmp_path):
+    (tmp_path/'data').mkdir()
+    for cmd in ['conf', 'start']:
+        with open(tmp_path/'data'/f'a_{cmd}.json', 'w') as f:
+            json.dump({'cmd': cmd}, f)
+    conf = get_json_recursive(tmp_path, lazy=True)
+
+    serialized = SerializedConfiguration(conf)
+    assert not serialized.blobs
+    assert json.loads(serialized.get('a', 'conf').body) == {'cmd': 'conf'}
+    assert conf['a'].loaded('conf')
+    assert not conf['a'].loaded('start')
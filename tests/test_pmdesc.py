@@ -0,0 +1,46 @@
+import click
+import pytest
+from nanorc.pmdesc import pm_desc
+
+
+def test_defaults():
+    pm = pm_desc('k8s://np04-srv-015:31000')
+    assert pm.use_k8spm()
+    assert (pm.address, pm.port) == ('np04-srv-015', 31000)
+    for name, default in pm_desc.options.items():
+        assert getattr(pm, name) == default
+
+    pm = pm_desc('kind://')
+    assert (pm.address, pm.port) == ('localhost', 31000)
+
+
+def test_options():
+    pm = pm_desc('k8s://host:31000?fast_terminate=true&server_side_apply=YES&max_create_workers=4&health_cache_ttl=0.5')
+    assert pm.fast_terminate is True
+    assert pm.server_side_apply is True
+    assert pm.max_create_workers == 4
+    assert pm.health_cache_ttl == 0.5
+
+    pm = pm_desc('ssh://?control_master=0&max_preflight_workers=1&health_cache_ttl=0&lazy_config=no')
+    assert pm.use_sshpm()
+    assert pm.control_master is False
+    assert pm.max_preflight_workers == 1
+    assert pm.health_cache_ttl == 0.
+    assert pm.lazy_config is False
+
+
+@pytest.mark.parametrize('pm_arg', [
+    'ftp://host',
+    'kind://host:31000',
+    'k8s://host:port',
+    'ssh://?unknown_option=1',
+    'ssh://?control_master=maybe',
+    'ssh://?max_command_fanout=many',
+    'ssh://?max_command_fanout=2.5',
+    'ssh://?max_command_fanout=0',
+    'ssh://?max_config_workers=-1',
+    'ssh://?health_cache_ttl=-1',
+])
+def test_bad_parameters(pm_arg):
+    with pytest.raises(click.BadParameter):
+        pm_desc(pm_arg)
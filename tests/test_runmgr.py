@@ -0,0 +1,74 @@
+import pytest
+import requests
+import threading
+from types import SimpleNamespace
+from nanorc.credmgr import credentials
+from nanorc.runmgr import DBRunNumberManager
+
+
+class FakeRunNumberDB:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_run = 100
+        self.requests = []
+        self.down = False
+
+    def session(self):
+        return SimpleNamespace(get=self.get)
+
+    def get(self, url, auth, timeout):
+        with self.lock:
+            self.requests.append((url, threading.current_thread().name))
+            if self.down:
+                raise requests.ConnectionError('down')
+            self.last_run += 1
+            return SimpleNamespace(raise_for_status=lambda: None, json=lambda run=self.last_run: [[[run]]])
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeRunNumberDB()
+    monkeypatch.setattr(credentials, 'get_login', lambda service: SimpleNamespace(username='user', password='pswd'))
+    monkeypatch.setattr(DBRunNumberManager, '_make_session', staticmethod(db.session))
+    return db
+
+
+def test_without_prefetch(db):
+    rnm = DBRunNumberManager('http://rundb')
+    assert rnm.get_run_number() == 101
+    assert rnm.next_run is None
+    assert db.requests == [('http://rundb/runnumber/getnew', 'MainThread')]
+
+    rnm.request_run_number()
+    rnm.request_run_number() # only one request at a time
+    assert rnm.get_run_number() == 102
+    assert rnm.run == 102
+    assert len(db.requests) == 2
+    assert db.requests[1][1].startswith('run-number')
+    assert rnm.next_run is None
+    assert len(rnm.latencies) == 2
+
+
+def test_with_prefetch(db):
+    rnm = DBRunNumberManager('http://rundb', prefetch=True)
+    assert rnm.get_run_number() == 101
+    # the next one is already being reserved
+    assert rnm.next_run.result(timeout=1) == 102
+    assert rnm.get_run_number() == 102
+    assert rnm.get_run_number() == 103
+    assert rnm.next_run.result(timeout=1) == 104
+    assert len(db.requests) == 4
+
+
+def test_failed_request(db):
+    rnm = DBRunNumberManager('http://rundb')
+    db.down = True
+    with pytest.raises(RuntimeError):
+        rnm.get_run_number()
+
+    # a failed background request is replaced by a direct one
+    rnm.request_run_number()
+    assert isinstance(rnm.next_run.exception(timeout=1), RuntimeError)
+    db.down = False
+    assert rnm.get_run_number() == 101
+    assert db.requests[-1][1] == 'MainThread'
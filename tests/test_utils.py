@@ -0,0 +1,113 @@
+import json
+import math
+import pickle
+import pytest
+from nanorc.utils import get_json_recursive, get_json_loads, LazyJSONDict
+
+
+def baseline_get_json_recursive(path):
+    '''
+    get_json_recursive before it read the files concurrently
+    '''
+    import os
+    data = {}
+    boot = path/"boot.json"
+    if os.path.isfile(boot):
+        with open(boot,'r') as f:
+            data['boot'] = json.load(f)
+
+    for filename in os.listdir(path):
+        if os.path.isfile(path/filename):
+            file_base, _ = os.path.splitext(filename)
+            with open(path/filename,'r') as f:
+                try:
+                    data[file_base] = json.load(f)
+                except:
+                    pass
+        elif os.path.isdir(path/filename):
+            if filename == 'data':continue
+            data[filename] = baseline_get_json_recursive(path/filename)
+
+    if not os.path.isdir(path/'data'):
+        return data
+
+    for filename in os.listdir(path/"data"):
+        with open(path/'data'/filename,'r') as f:
+            app_cmd = filename.replace('.json', '').split('_')
+            app = app_cmd[0]
+            cmd = "_".join(app_cmd[1:])
+            if not app in data:
+                data[app] = {cmd: json.load(f)}
+            else:
+                data[app][cmd]=json.load(f)
+    return data
+
+
+def write_files(root, files):
+    for rel_path, content in files.items():
+        (root/rel_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(root/rel_path, 'w') as f:
+            f.write(content if isinstance(content, str) else json.dumps(content))
+    return root
+
+
+@pytest.fixture
+def conf(tmp_path):
+    return write_files(tmp_path/'conf', {
+        'boot.json': {'apps': {'ru': {}, 'trigger': {}}},
+        'info.json': {'version': 1},
+        'README.md': '# not json',
+        'data/ru_conf.json': {'x': 1},
+        'data/ru_start.json': {'y': [1.5, None]},
+        'data/ru_record_data.json': {'z': 'a'},
+        'data/trigger_conf.json': {},
+        'trigger/data/tc_conf.json': {'w': 1},
+        'trigger/boot.json': {'apps': {}},
+        'ru.json': {'extra': 1},
+    })
+
+
+def test_same_as_baseline(conf):
+    assert get_json_recursive(conf) == baseline_get_json_recursive(conf)
+    assert get_json_recursive(conf, max_workers=1) == baseline_get_json_recursive(conf)
+    assert list(get_json_recursive(conf))[0] == 'boot'
+
+
+def test_lazy(conf):
+    data = get_json_recursive(conf, lazy=True)
+    ru = data['ru']
+    assert isinstance(ru, LazyJSONDict)
+    assert not ru.loaded('conf')
+    assert sorted(ru) == ['conf', 'extra', 'record_data', 'start']
+    assert not ru.loaded('conf')
+
+    assert ru['conf'] == {'x': 1}
+    assert ru.loaded('conf')
+    assert not ru.loaded('start')
+    assert ru.get('missing') is None
+
+    expected = baseline_get_json_recursive(conf)
+    assert data == expected
+    assert json.loads(json.dumps(data)) == expected
+    unpickled = pickle.loads(pickle.dumps(data['trigger']))
+    assert unpickled == expected['trigger']
+    assert type(unpickled['tc']) is dict
+
+
+def test_nan_fallback(tmp_path):
+    write_files(tmp_path, {
+        'boot.json': '{"rate": NaN, "max": Infinity}',
+        'data/ru_conf.json': '{"threshold": -Infinity}',
+    })
+    data = get_json_recursive(tmp_path)
+    assert math.isnan(data['boot']['rate'])
+    assert data['boot']['max'] == math.inf
+    assert data['ru']['conf']['threshold'] == -math.inf
+
+    assert get_json_loads()(b'{"a": [1, 2]}') == {'a': [1, 2]}
+
+
+def test_bad_data_file(tmp_path):
+    write_files(tmp_path, {'data/ru_conf.json': '{'})
+    with pytest.raises(ValueError):
+        get_json_recursive(tmp_path)